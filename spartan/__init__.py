@@ -34,6 +34,7 @@ from .expr import *
 from . import config
 from .config import FLAGS
 from .cluster import start_cluster
+from .blob_ctx import job
 
 
 CTX = None
@@ -0,0 +1,208 @@
+'''
+Pinning of local worker processes to CPUs and NUMA nodes.
+
+The CPU topology is read from ``/sys/devices/system/cpu`` and
+``/sys/devices/system/node``.  Each worker on a machine is assigned a set of
+CPUs according to ``--cpu_affinity``:
+
+``compact``
+  Fill one NUMA node before moving to the next; workers get one logical
+  CPU each, with hyperthread siblings used before the next core.
+``scatter``
+  Spread workers round-robin across NUMA nodes, one logical CPU each;
+  hyperthread siblings are only used once every core has a worker.
+``physical``
+  One physical core (all of its hyperthreads) per worker, filling one
+  NUMA node before moving to the next.
+
+If there are more workers than slots, assignments wrap around.
+
+Pinning applies to the calling thread and the threads it creates later, so
+it must happen before the worker starts its thread pools.  Memory is
+allocated on first touch on the node of the touching CPU (the Linux
+default); if ``libnuma`` is available we also set the worker's preferred
+node so that tile buffers stay local.
+'''
+
+import ctypes
+import ctypes.util
+import glob
+import os
+import re
+
+from . import util
+from .config import FLAGS, StrFlag
+
+FLAGS.add(StrFlag('cpu_affinity', default='physical',
+                  help='How local workers are pinned to CPUs: compact, scatter or physical'))
+
+SYS_CPU = '/sys/devices/system/cpu'
+SYS_NODE = '/sys/devices/system/node'
+
+
+def _read(path):
+  with open(path) as f:
+    return f.read().strip()
+
+
+def parse_cpulist(s):
+  '''Parse a kernel cpu list such as ``0-3,8,10-11`` into a list of ints.'''
+  cpus = []
+  for part in s.split(','):
+    part = part.strip()
+    if not part:
+      continue
+    if '-' in part:
+      lo, hi = part.split('-')
+      cpus.extend(range(int(lo), int(hi) + 1))
+    else:
+      cpus.append(int(part))
+  return cpus
+
+
+class Topology(object):
+  '''
+  The CPUs of this machine, grouped by NUMA node and physical core.
+
+  ``nodes`` maps from node id to a list of cores; each core is a sorted list
+  of the logical CPUs (hyperthreads) which share it.
+  '''
+  def __init__(self, nodes):
+    self.nodes = nodes
+
+  @staticmethod
+  def discover(cpu_root=SYS_CPU, node_root=SYS_NODE):
+    '''Read the topology from sysfs.  Returns a single-node topology if unavailable.'''
+    cpu_node = {}
+    for path in glob.glob(os.path.join(node_root, 'node[0-9]*')):
+      node = int(re.search(r'node(\d+)$', path).group(1))
+      try:
+        for cpu in parse_cpulist(_read(os.path.join(path, 'cpulist'))):
+          cpu_node[cpu] = node
+      except IOError:
+        continue
+
+    cores = {}
+    for path in glob.glob(os.path.join(cpu_root, 'cpu[0-9]*')):
+      cpu = int(re.search(r'cpu(\d+)$', path).group(1))
+      try:
+        package = int(_read(os.path.join(path, 'topology', 'physical_package_id')))
+        core = int(_read(os.path.join(path, 'topology', 'core_id')))
+      except (IOError, ValueError):
+        # offline cpus have no topology directory.
+        if os.path.exists(os.path.join(path, 'online')) and _read(os.path.join(path, 'online')) == '0':
+          continue
+        package, core = 0, cpu
+      node = cpu_node.get(cpu, package if not cpu_node else 0)
+      cores.setdefault((node, package, core), []).append(cpu)
+
+    if not cores:
+      cpus = range(os.sysconf('SC_NPROCESSORS_ONLN'))
+      return Topology({0: [[c] for c in cpus]})
+
+    nodes = {}
+    for (node, package, core) in sorted(cores, key=lambda k: (k[0], min(cores[k]))):
+      nodes.setdefault(node, []).append(sorted(cores[(node, package, core)]))
+    return Topology(nodes)
+
+  def node_of(self, cpu):
+    for node, cores in self.nodes.iteritems():
+      for core in cores:
+        if cpu in core:
+          return node
+    return None
+
+  def slots(self, policy):
+    '''
+    Return the CPU sets workers are assigned to under ``policy``, in order.
+
+    :param policy: one of 'compact', 'scatter' or 'physical'.
+    :rtype: list of (node, [cpu]) pairs.
+    '''
+    node_ids = sorted(self.nodes)
+    if policy == 'physical':
+      return [(node, core) for node in node_ids for core in self.nodes[node]]
+    if policy == 'compact':
+      return [(node, [cpu]) for node in node_ids
+              for core in self.nodes[node] for cpu in core]
+    if policy == 'scatter':
+      # the first logical cpu of every core, then the second, and so on.
+      per_node = []
+      for node in node_ids:
+        cores = self.nodes[node]
+        depth = max(len(core) for core in cores)
+        per_node.append([(node, [core[i]]) for i in range(depth)
+                         for core in cores if i < len(core)])
+      slots = []
+      for i in range(max(len(p) for p in per_node)):
+        for p in per_node:
+          if i < len(p):
+            slots.append(p[i])
+      return slots
+    raise ValueError('Unknown cpu affinity policy: %s' % policy)
+
+  def assign(self, local_id, policy):
+    '''Return the (node, cpus) slot for the ``local_id``-th worker on this machine.'''
+    slots = self.slots(policy)
+    return slots[local_id % len(slots)]
+
+
+class _CpuSet(ctypes.Structure):
+  _fields_ = [('bits', ctypes.c_ulong * (1024 / (8 * ctypes.sizeof(ctypes.c_ulong))))]
+
+
+def _load_library(name):
+  path = ctypes.util.find_library(name)
+  if path is None:
+    return None
+  try:
+    return ctypes.CDLL(path, use_errno=True)
+  except OSError:
+    return None
+
+
+def set_cpu_affinity(cpus):
+  '''
+  Restrict the calling thread (and threads it creates afterwards) to ``cpus``.
+
+  Returns True on success.
+  '''
+  libc = _load_library('c')
+  if libc is None or not hasattr(libc, 'sched_setaffinity'):
+    return False
+  mask = _CpuSet()
+  word_bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+  for cpu in cpus:
+    mask.bits[cpu / word_bits] |= 1 << (cpu % word_bits)
+  # pid 0 is the calling thread.
+  if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+    util.log_warn('sched_setaffinity(%s) failed: %s', cpus, os.strerror(ctypes.get_errno()))
+    return False
+  return True
+
+
+def set_preferred_node(node):
+  '''
+  Prefer allocating memory for the calling thread on ``node``.
+
+  A no-op (returning False) if libnuma is not installed.
+  '''
+  libnuma = _load_library('numa')
+  if libnuma is None or libnuma.numa_available() < 0:
+    return False
+  libnuma.numa_set_preferred(node)
+  return True
+
+
+def pin_worker(local_id, policy=None):
+  '''
+  Pin the ``local_id``-th worker on this machine according to ``policy``
+  (defaults to ``--cpu_affinity``).
+  '''
+  policy = policy or FLAGS.cpu_affinity
+  topology = Topology.discover()
+  node, cpus = topology.assign(local_id, policy)
+  if set_cpu_affinity(cpus):
+    set_preferred_node(node)
+    util.log_info('Worker %d pinned to node %d, cpus %s', local_id, node, cpus)
+  return node, cpus
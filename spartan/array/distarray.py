@@ -2,6 +2,7 @@
 
 import itertools
 import collections
+import time
 import traceback
 
 import appdirs
@@ -17,6 +18,10 @@ from .. import master
 
 # number of elements per tile
 DEFAULT_TILE_SIZE = 100000
+# Density assumed for sparse arrays whose density is unknown.
+SPARSE_DENSITY = 0.01
+# Bytes per stored entry of a sparse tile (value and index).
+SPARSE_ENTRY_BYTES = 12
 
 def take_first(a,b):
   return a
@@ -105,8 +110,54 @@ def compute_extents(shape, tile_hint=None, num_shards=-1):
 
   return result
 
-def _tile_mapper(tile_id, blob, array=None, user_fn=None, **kw):
-  '''Invoke ``user_fn`` on ``blob``, and construct tiles from the results.'''
+def splittable(fn):
+  '''
+  Mark ``fn``, a mapper function taking ``(extent, **kw)``, as being able to
+  run on any sub-extent of a tile.
+
+  Kernels using such functions can have their tiles split between
+  workers when load balancing.
+  '''
+  fn.splittable = True
+  return fn
+
+def side_effect_free(fn):
+  '''
+  Mark ``fn``, a mapper function taking ``(extent, **kw)``, as only creating
+  new tiles: running it twice for the same extent is harmless.
+
+  Straggling tiles of kernels using such functions may be re-executed
+  on another worker (see ``--speculative_execution``).
+  '''
+  fn.side_effect_free = True
+  return fn
+
+def batchable(check):
+  '''
+  Mark a mapper function taking ``(extent, **kw)`` as being able to run once 
+  over the union of several contiguous tiles (see ``--tile_batch_size``).
+
+  Batched calls receive the union extent, and the list of tile extents it
+  covers as ``_batch``.  ``check(kw)`` is called with the keyword arguments
+  of a kernel, and decides if that kernel may be batched.
+  '''
+  def decorator(fn):
+    fn.batchable = check
+    return fn
+  return decorator
+
+def _batch_mapper(tile_ids, array=None, user_fn=None, **kw):
+  '''Invoke ``user_fn`` once over the tiles ``tile_ids``, which must be contiguous along axis 0.'''
+  exs = sorted([array.extent_for_blob(tile_id) for tile_id in tile_ids], key=lambda ex: ex.ul[0])
+  union = extent.create(exs[0].ul, exs[-1].lr, exs[0].array_shape)
+  return user_fn(union, _batch=exs, **kw)
+
+def _tile_mapper(tile_id, blob, array=None, user_fn=None, _extent=None, **kw):
+  '''Invoke ``user_fn`` on ``blob``, and construct tiles from the results.
+
+  If ``_extent`` is specified, only that part of the tile is processed.'''
+  if _extent is not None:
+    return user_fn(_extent, **kw)
   ex = array.extent_for_blob(tile_id)
   return user_fn(ex, **kw)
 
@@ -136,7 +187,7 @@ class DistArray(object):
   def update(self, ex, data):
     raise NotImplementedError
 
-  def foreach_tile(self, mapper_fn, kw):
+  def foreach_tile(self, mapper_fn, kw, combiner=None):
     raise NotImplementedError
 
   def extent_for_blob(self, id):
@@ -196,12 +247,18 @@ class DistArray(object):
     return self.select(np.index_exp[:])
 
   def map_to_array(self, mapper_fn, kw=None):
+    if kw is None: kw = {}
     results = self.foreach_tile(mapper_fn=mapper_fn, kw=kw)
     extents = {}
+    producers = {}
     for tile_id, d in results.iteritems():
       for ex, id in d:
         extents[ex] = id
-    return from_table(extents)
+        producers[ex] = tile_id
+    array = from_table(extents)
+    if isinstance(self, DistArrayImpl):
+      array.lineage = Lineage.create(self, kw, producers)
+    return array
 
   def __hash__(self):
     return id(self)
@@ -210,6 +267,126 @@ class DistArray(object):
   def ndim(self):
     return len(self.shape)
 
+
+def _input_arrays(value):
+  '''Return the `DistArrayImpl` objects referenced by ``value`` (unwrapping views).'''
+  if isinstance(value, DistArray):
+    while not isinstance(value, DistArrayImpl) and isinstance(getattr(value, 'base', None), DistArray):
+      value = value.base
+    return [value] if isinstance(value, DistArrayImpl) else []
+  if isinstance(value, dict):
+    value = value.values()
+  if isinstance(value, (list, tuple)):
+    return util.flatten([_input_arrays(v) for v in value])
+  return []
+
+
+class Lineage(object):
+  '''
+  Records how the tiles of an array were computed, so lost tiles can be
+  recomputed (see `recover`).
+
+  The tiles were produced by running `_tile_mapper` with keyword arguments
+  ``kw`` over the tiles of ``source``; ``producers`` maps from each output
+  extent to the extent of the source tile which produced it.  ``inputs`` are
+  the other arrays read by the kernel.
+  '''
+  def __init__(self, source, kw, producers, inputs, depth):
+    self.source = source
+    self.kw = kw
+    self.producers = producers
+    self.inputs = inputs
+    self.depth = depth
+
+  @staticmethod
+  def create(source, kw, producers):
+    '''
+    Return the lineage of a `map_to_array` over ``source``, or None if
+    it would be more than ``--lineage_depth`` kernels deep.
+
+    :param producers: dictionary from output extent to source `TileId`.
+    '''
+    inputs = [a for a in _input_arrays(kw.values()) if a is not source]
+    depth = 1
+    for a in [source] + inputs:
+      if getattr(a, 'lineage', None) is not None:
+        depth = max(depth, a.lineage.depth + 1)
+    # limiting the depth bounds the number of intermediate arrays kept alive.
+    if depth > FLAGS.lineage_depth:
+      return None
+    producers = dict((ex, _producer(source, ex, tile_id))
+                     for ex, tile_id in producers.iteritems())
+    return Lineage(source, kw, producers, inputs, depth)
+
+
+def _producer(source, ex, tile_id):
+  '''
+  Return the extent of the source tile to rerun to recompute output ``ex``,
+  which was reported by the kernel run on ``tile_id``.
+  '''
+  # batched kernels report several outputs under one tile; rerunning
+  # the matching tile is enough to recompute each of them.
+  if ex in source.tiles:
+    return ex
+  return source.extent_for_blob(tile_id)
+
+
+def recover(array, extents=None):
+  '''
+  Recompute lost tiles of ``array`` using its lineage.
+
+  Only the source tiles which produced the lost tiles are rerun (on the
+  workers holding them); lost source tiles are recovered first, in turn.
+
+  :param array: `DistArray`
+  :param extents: the extents which must be valid (default: all of them).
+  :rtype: True if none of ``extents`` are lost afterwards.
+  '''
+  if not isinstance(array, DistArrayImpl):
+    # views (slices, broadcasts...) are recovered through their base array.
+    return all(recover(base) for base in _input_arrays(array)) and not array.bad_tiles
+
+  lost = [ex for ex in set(array.bad_tiles) if extents is None or ex in extents]
+  if not lost:
+    return True
+
+  lineage = getattr(array, 'lineage', None)
+  if lineage is None or any(ex not in lineage.producers for ex in lost):
+    return False
+
+  source = lineage.source
+  rerun = set(lineage.producers[ex] for ex in lost)
+  if not recover(source, rerun) or any(ex not in source.tiles for ex in rerun):
+    return False
+  for other in lineage.inputs:
+    if not recover(other):
+      return False
+
+  util.log_info('Recomputing %d lost tiles from %d source tiles', len(lost), len(rerun))
+  kw = dict(lineage.kw)
+  kw['array'] = source
+  results = blob_ctx.get().map([source.tiles[ex] for ex in rerun],
+                               mapper_fn=_tile_mapper, kw=kw)
+
+  shared = set(source.tiles.values())
+  for ex, src_ex in lineage.producers.items():
+    if src_ex not in rerun:
+      continue
+    del lineage.producers[ex]
+    tile_id = array.tiles.pop(ex)
+    array.blob_to_ex.pop(tile_id, None)
+    if ex in array.bad_tiles:
+      array.bad_tiles = [bad for bad in array.bad_tiles if bad != ex]
+    elif tile_id not in shared:
+      _pending_destructors.append(tile_id)
+
+  for src_tile_id, d in results.iteritems():
+    for ex, tile_id in d:
+      array.tiles[ex] = tile_id
+      array.blob_to_ex[tile_id] = ex
+      lineage.producers[ex] = _producer(source, ex, src_tile_id)
+  return all(ex not in array.bad_tiles for ex in lost)
+
 ID_COUNTER = iter(xrange(10000000))
 
 # List of tiles to be destroyed at the next safe point.
@@ -239,6 +416,7 @@ class DistArrayImpl(DistArray):
 
     self.tiles = tiles
     self.id = ID_COUNTER.next()
+    self.lineage = None
 
     if self.ctx.is_master():
       #util.log_info('New array: %s, %s, %s tiles', shape, dtype, len(tiles))
@@ -276,7 +454,7 @@ class DistArrayImpl(DistArray):
 
     return sorted(scounts.items(), key=lambda kv: (kv[1], kv[0]))[-1][0]
 
-  def foreach_tile(self, mapper_fn, kw=None):
+  def foreach_tile(self, mapper_fn, kw=None, combiner=None):
     ctx = blob_ctx.get()
 
     if kw is None: kw = {}
@@ -285,7 +463,31 @@ class DistArrayImpl(DistArray):
 
     return ctx.map(self.tiles.values(),
                    mapper_fn = _tile_mapper,
-                   kw=kw)
+                   kw=kw,
+                   combiner=combiner)
+
+  def pipelined_map_to_array(self, mapper_fn, kw=None):
+    '''
+    Like `map_to_array`, but return before ``mapper_fn`` has finished.
+
+    The tile ids of the result are reserved in advance and passed to 
+    ``mapper_fn`` as ``out_tiles`` (a dictionary from extent to `TileId`); 
+    ``mapper_fn`` must store the tile for ``ex`` under ``out_tiles[ex]``.
+    Reads of a tile of the result wait until it has been created, so 
+    kernels using the result can start on the tiles which are ready.
+
+    The kernel is waited for by `BlobCtx.join_pending`.
+    '''
+    ctx = blob_ctx.get()
+    out_tiles = dict((ex, ctx.new_pipelined_tile_id(tile_id.worker))
+                     for ex, tile_id in self.tiles.iteritems())
+
+    if kw is None: kw = {}
+    kw['out_tiles'] = out_tiles
+    kw['array'] = self
+    kw['user_fn'] = mapper_fn
+    ctx.map(self.tiles.values(), mapper_fn=_tile_mapper, kw=kw, wait=False)
+    return from_table(out_tiles)
 
   def fetch(self, region):
     '''
@@ -318,6 +520,7 @@ class DistArrayImpl(DistArray):
     #util.log_info('Fetching %d tiles', len(splits))
 
     futures = []
+    start = time.time()
     for ex, intersection in splits:
       tile_id = self.tiles[ex]
       futures.append(ctx.get(tile_id, extent.offset_slice(ex, intersection), wait=False))
@@ -326,6 +529,9 @@ class DistArrayImpl(DistArray):
     # if we have any masked tiles, then we need to create a masked array.
     # otherwise, create a dense array.
     results = [r.data for r in rpc.wait_for_all(futures)]
+    ctx.record_transfer(sum([getattr(r, 'nbytes', 0) for (ex, _), r in zip(splits, results)
+                             if self.tiles[ex].worker != ctx.worker_id]),
+                        time.time() - start)
 
     DENSE = 0
     MASKED = 1
@@ -420,13 +626,36 @@ class DistArrayImpl(DistArray):
     else:
       return rpc.FutureGroup(futures)
 
+def _assign_by_score(num_tiles, worker_scores):
+  '''
+  Give each worker a share of ``num_tiles`` tiles proportional to its score.
+
+  :param worker_scores: list of ``(worker_id, score)`` pairs (see `Master.get_worker_scores`).
+  :rtype: list of the worker to place each tile on.
+  '''
+  worker_scores = [(worker_id, max(float(score), 1e-9)) for worker_id, score in worker_scores]
+  assigned = collections.defaultdict(int)
+  workers = []
+  for i in range(num_tiles):
+    worker_id = min(worker_scores, key=lambda w: (assigned[w[0]] + 1) / w[1])[0]
+    assigned[worker_id] += 1
+    workers.append(worker_id)
+  return workers
+
 def create(shape,
            dtype=np.float,
            sharder=None,
            reducer=None,
            tile_hint=None,
-           sparse=False):
-  '''Make a new, empty DistArray'''
+           sparse=False,
+           kernel_type=None):
+  '''
+  Make a new, empty DistArray.
+
+  With ``--tile_assignment_strategy=performance``, tiles are placed by the 
+  measured speed of workers running ``kernel_type``, the kernel which
+  will fill the array (see `Master.get_worker_scores`).
+  '''
   ctx = blob_ctx.get()
   dtype = np.dtype(dtype)
   shape = tuple(shape)
@@ -441,11 +670,11 @@ def create(shape,
                     tile.from_shape(ex.shape, dtype, tile_type=tile_type),
                     hint=i)
   elif FLAGS.tile_assignment_strategy == 'performance':
-    worker_scores = master.get().get_worker_scores()
+    workers = _assign_by_score(len(extents), master.get().get_worker_scores(kernel_type))
     for ex, i in extents.iteritems():
       tiles[ex] = ctx.create(
                   tile.from_shape(ex.shape, dtype, tile_type=tile_type),
-                  hint=worker_scores[i%len(worker_scores)][0])
+                  hint=workers[i])
   elif FLAGS.tile_assignment_strategy == 'serpentine':
     for ex, i in extents.iteritems():
       j = i % ctx.num_workers
@@ -580,12 +809,16 @@ class LocalWrapper(DistArray):
   def map_to_array(self, mapper_fn, kw=None):
     return self.foreach_tile(mapper_fn=mapper_fn, kw=kw)
 
-  def foreach_tile(self, mapper_fn, kw=None):
+  def foreach_tile(self, mapper_fn, kw=None, combiner=None):
     #print 'Mapping: ', mapper_fn, ' over ', self._data
     if kw is None: kw = {}
     map_result = mapper_fn(self._ex, **kw)
     result = map_result.result
 
+    if combiner is not None:
+      # there is only one tile: nothing to combine.
+      return result
+
     assert len(result) == 1
     result_ex, tile_id = result[0]
 
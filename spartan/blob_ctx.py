@@ -7,13 +7,75 @@ running user-defined *kernel functions* on tile data.
 
 
 from . import util, rpc, core
+from .config import FLAGS
+import sys
 import threading
+import time
 from .util import Assert
+import numpy as np
 import random
 
 MASTER_ID = 65536
 ID_COUNTER = iter(xrange(10000000))
 
+# Tile ids handed out by the master for the output of pipelined kernels
+# (see `BlobCtx.new_pipelined_tile_id`); reads of such tiles wait until
+# they have been created.
+PIPELINED_ID_BASE = 1 << 30
+PIPELINED_ID_COUNTER = iter(xrange(PIPELINED_ID_BASE, 2 * PIPELINED_ID_BASE - 1))
+
+
+_jobs = threading.local()
+
+class job(object):
+  '''
+  Kernels started by the current thread inside a ``with job(...)`` block
+  belong to job ``job_id``.
+
+  Workers run the kernels of higher ``priority`` jobs first, pausing 
+  lower priority kernels between tiles.  Jobs of equal priority share
+  workers in proportion to their ``weight``.
+  '''
+  def __init__(self, job_id, session_id='', priority=0, weight=1.0):
+    Assert.gt(weight, 0)
+    self.job_id = str(job_id)
+    self.session_id = str(session_id)
+    self.priority = priority
+    self.weight = float(weight)
+
+  def __enter__(self):
+    _job_stack().append(self)
+    return self
+
+  def __exit__(self, *args):
+    _job_stack().pop()
+
+def _job_stack():
+  if not hasattr(_jobs, 'stack'):
+    _jobs.stack = []
+  return _jobs.stack
+
+def current_job():
+  '''Return the innermost `job` of the calling thread, or None.'''
+  stack = _job_stack()
+  return stack[-1] if stack else None
+
+def set_job(job):
+  '''Make ``job`` (or None) the current job of the calling thread.'''
+  _jobs.stack = [job] if job is not None else []
+
+
+def concat(a, b):
+  '''
+  Default result combiner: concatenate two partial kernel results.
+
+  Numpy arrays are joined along their first axis, anything else is
+  treated as a sequence.
+  '''
+  if isinstance(a, np.ndarray) and isinstance(b, np.ndarray):
+    return np.concatenate((a, b))
+  return list(a) + list(b)
+
 
 class BlobCtx(object):
   def __init__(self, worker_id, workers, local_worker=None):
@@ -36,6 +98,13 @@ class BlobCtx(object):
     self.id_map = {}
     self.local_worker = local_worker
     self.active = True
+    # kernels started without waiting, per calling thread.
+    self._pending = threading.local()
+    # per-thread bytes fetched/updated, and kernel stats being collected.
+    self._io = threading.local()
+    self._profiling = threading.local()
+    # moving average of the rate (bytes/s) of reads from other workers.
+    self.net_throughput = None
 
     #util.log_info('New blob ctx.  Worker=%s', self.worker_id)
     
@@ -115,6 +184,39 @@ class BlobCtx(object):
     # Don't need to wait for the result.
     self._send_all('destroy', req, wait=False)
 
+  def record_transfer(self, nbytes, seconds):
+    '''Record that ``nbytes`` were read from other workers in ``seconds``.'''
+    if nbytes > 0 and seconds > 0:
+      self.net_throughput = util.ewma(self.net_throughput, nbytes / seconds)
+
+  def io_counters(self):
+    '''
+    Return the bytes fetched (by `get`) and updated (by `update`) by the
+    calling thread, as a dict with keys ``fetched`` and ``updated``.
+    '''
+    if not hasattr(self._io, 'counters'):
+      self._io.counters = {'fetched': 0, 'updated': 0}
+    return self._io.counters
+
+  def reset_io_counters(self):
+    '''Zero the counters returned by `io_counters` for the calling thread.'''
+    self._io.counters = {'fetched': 0, 'updated': 0}
+
+  def collect_kernel_stats(self, kernels):
+    '''
+    Append a record of each kernel `map` runs in the calling thread to
+    ``kernels`` (None stops collecting).
+
+    Kernels are run with ``profile`` set, and waited for; each record is a
+    dict with the number of ``tiles`` and the ``tile_stats`` returned by
+    the workers (see `core.KernelProfileResp`).
+
+    Returns the list previously collected into.
+    '''
+    previous = getattr(self._profiling, 'kernels', None)
+    self._profiling.kernels = kernels
+    return previous
+
   def destroy(self, tile_id):
     '''
     Destroy a tile.
@@ -138,7 +240,12 @@ class BlobCtx(object):
     req = core.GetReq(id=tile_id, subslice=subslice)
 
     if wait:
-      return self._send(tile_id, 'get', req, wait=True, timeout=timeout).data
+      start = time.time()
+      data = self._send(tile_id, 'get', req, wait=True, timeout=timeout).data
+      self.io_counters()['fetched'] += getattr(data, 'nbytes', 0)
+      if tile_id.worker != self.worker_id:
+        self.record_transfer(getattr(data, 'nbytes', 0), time.time() - start)
+      return data
     else:
       return self._send(tile_id, 'get', req, wait=False)
 
@@ -156,7 +263,9 @@ class BlobCtx(object):
     req = core.GetReq(id=tile_id, subslice=subslice)
 
     if wait:
-      return self._send(tile_id, 'get_flatten', req, wait=True, timeout=timeout).data
+      data = self._send(tile_id, 'get_flatten', req, wait=True, timeout=timeout).data
+      self.io_counters()['fetched'] += getattr(data, 'nbytes', 0)
+      return data
     else:
       return self._send(tile_id, 'get_flatten', req, wait=False)
     
@@ -176,6 +285,7 @@ class BlobCtx(object):
     '''
 
     req = core.UpdateReq(id=tile_id, region=region, data=data, reducer=reducer)
+    self.io_counters()['updated'] += getattr(data, 'nbytes', 0)
     return self._send(tile_id, 'update', req, wait=wait, timeout=timeout)
   
   def new_tile_id(self):
@@ -187,6 +297,17 @@ class BlobCtx(object):
     '''
     assert not self.is_master()
     return core.TileId(worker=self.worker_id, id=ID_COUNTER.next())
+
+  def new_pipelined_tile_id(self, worker_id):
+    '''
+    Reserve an id for a tile which will be created on ``worker_id`` by a
+    running kernel.  Reads of the tile wait until it has been created.
+
+    Returns:
+      `TileId`: Id of the future tile.
+    '''
+    Assert.eq(self.worker_id, MASTER_ID)
+    return core.TileId(worker=worker_id, id=PIPELINED_ID_COUNTER.next())
   
   def heartbeat(self, worker_status, timeout=None):
     '''
@@ -198,27 +319,67 @@ class BlobCtx(object):
     req = core.HeartbeatReq(worker_id=self.worker_id, worker_status=worker_status)
     return self._send_to_worker(MASTER_ID, 'heartbeat', req, wait=False, timeout=timeout)
   
-  def maybe_steal_tile(self, old_tile_id, new_tile_id):
+  def maybe_steal_tiles(self, kernel_id, allow_backup=False, finished_backups=(), kernel_type=None):
+    '''
+    Ask the master for a batch of unstarted tiles of kernel ``kernel_id`` from other workers.
+    
+    :param kernel_id: the kernel this worker has finished its local tiles for.
+    :param allow_backup: if True, the master may instead hand out a backup copy
+      of a straggling tile which is running on another worker.
+    :param finished_backups: backup tiles completed since the last request.
+    :param kernel_type: the name worker speeds are measured under for the kernel.
+    :rtype: `TileListMessage`; ``tiles`` is empty if there is nothing to steal.
+    '''
+    req = core.StealTilesReq(worker_id=self.worker_id, kernel_id=kernel_id,
+                             allow_backup=allow_backup,
+                             finished_backups=list(finished_backups),
+                             kernel_type=kernel_type or '')
+    return self._send_to_worker(MASTER_ID, 'maybe_steal_tiles', req)
+
+  def cancel_tiles(self, worker_id, kernel_id, tiles):
     '''
-    Update the migrated tile info to distarray in master, and apply a new tile for execution.
+    Cancel tiles from the kernel remain tile list. The tiles will not be executed in the specific worker.
     
-    :param old_tile_id: the previous tile_id of the migrated tile.
-    :param new_tile_id: the new tile_id of the migrated tile.
+    :param worker_id: the worker that the tiles should be removed from.
+    :param kernel_id: the kernel the tiles belong to.
+    :param tiles: tiles to be canceled.
+    :rtype: the list of tiles which were actually canceled.
     '''
-    req = core.UpdateAndStealTileReq(worker_id=self.worker_id, old_tile_id=old_tile_id, new_tile_id=new_tile_id)
-    return self._send_to_worker(MASTER_ID, 'maybe_steal_tile', req)
+    req = core.TileListMessage(kernel_id=kernel_id, tiles=tiles)
+    return self._send_to_worker(worker_id, 'cancel_tiles', req)
 
-  def cancel_tile(self, worker_id, tile_id):
+  def abandon_tiles(self, worker_id, kernel_id, tiles):
     '''
-    Cancel the tile from the kernel remain tile list. The tile will not be executed in the specific worker.
+    Tell ``worker_id`` that ``tiles`` have been completed by a backup execution.
     
-    :param worker_id: the worker that the tile should be removed from.
-    :param tile_id: tile_id of the tile to be canceled.
+    :param worker_id: the worker running the original copies of the tiles.
+    :param kernel_id: the kernel the tiles belong to.
+    :param tiles: tiles to be abandoned.
+    '''
+    req = core.TileListMessage(kernel_id=kernel_id, tiles=tiles)
+    return self._send_to_worker(worker_id, 'abandon_tiles', req)
+
+  def split_tile(self, worker_id, kernel_id, tile, keep):
+    '''
+    Restrict a queued tile on ``worker_id`` to the sub-extent ``keep``.
+
+    :rtype: True if the tile was still queued and has been split.
     '''
-    req = core.TileIdMessage(tile_id=tile_id)
-    return self._send_to_worker(worker_id, 'cancel_tile', req)
+    req = core.SplitTileReq(kernel_id=kernel_id, tile=tile, keep=keep)
+    return self._send_to_worker(worker_id, 'split_tile', req)
 
-  def create(self, data, hint=None, timeout=None):
+  def aggregate(self, worker_id, kernel_id, result):
+    '''
+    Send a partial kernel result to ``worker_id``, our parent in the reduction tree.
+
+    :param worker_id: the parent worker.
+    :param kernel_id: the kernel which produced ``result``.
+    :param result: the combined result of this worker and its children (or None).
+    '''
+    req = core.AggregateReq(kernel_id=kernel_id, worker_id=self.worker_id, result=result)
+    return self._send_to_worker(worker_id, 'aggregate', req)
+
+  def create(self, data, hint=None, timeout=None, tile_id=None):
     '''
     Create a new tile to hold ``data``.
     
@@ -227,12 +388,16 @@ class BlobCtx(object):
       hint (int): Optional.  Worker to store data on.  
         If not specified, workers are chosen in round-robin order.
       timeout (float):
+      tile_id (TileId): Optional.  Id of the new tile, as reserved by
+        `new_pipelined_tile_id`.
     '''
     assert self.worker_id >= 0, self.worker_id
 
     # workers create blobs locally; master dispatches to a 
     # worker in round-robin order.
-    if self.is_master():
+    if tile_id is not None:
+      worker_id, id = tile_id.worker, tile_id.id
+    elif self.is_master():
       if hint is None:
         worker_id = ID_COUNTER.next() % len(self.workers)
       else:
@@ -253,7 +418,7 @@ class BlobCtx(object):
     req = core.CreateTileReq(tile_id=tile_id, data=data)
     return self._send(tile_id, 'create', req, wait=False, timeout=timeout)
 
-  def map(self, tile_ids, mapper_fn, kw, timeout=None):
+  def map(self, tile_ids, mapper_fn, kw, timeout=None, combiner=None, wait=True):
     '''
     Run ``mapper_fn`` on all tiles in ``tile_ids``.
     
@@ -262,18 +427,100 @@ class BlobCtx(object):
       mapper_fn (function): Function taking (extent, kw)
       kw (dict): Keywords to supply to ``mapper_fn``.
       timeout: optional RPC timeout.
+      combiner (function): Optional. Function from (result, result) -> result.
+        If supplied, tile results are merged on the workers along a reduction
+        tree (see `concat`), and only the final value is sent to the master.
+      wait (bool): If False, return immediately; the kernel is waited
+        for by `join_pending`.  Tiles are then run on the worker holding them.
       
     Returns:
-      dict: mapping from (source_tile, result of ``mapper_fn``)
+      dict: mapping from (source_tile, result of ``mapper_fn``), or the combined
+      result if ``combiner`` is specified.  None if ``wait`` is False.
     '''
     req = core.RunKernelReq(blobs=tile_ids, mapper_fn=mapper_fn, kw=kw)
+    req.kernel_id = ID_COUNTER.next()
+    job = current_job()
+    if job is not None:
+      req.job_id = job.job_id
+      req.session_id = job.session_id
+      req.priority = job.priority
+      req.weight = job.weight
+    if combiner is not None:
+      req.combiner = combiner
+      req.reduce_tree = list(self.local_worker.get_available_workers())
+      req.tree_fanout = max(1, FLAGS.aggregation_fanout)
+
+    profile = getattr(self._profiling, 'kernels', None)
+    if profile is not None:
+      # profiled kernels are waited for, so their stats are known on return.
+      # Combined kernels only report their tile count.
+      req.profile = combiner is None
+      if not wait:
+        req.pinned = True
+        wait = True
+      stats = {'kernel_id': req.kernel_id, 'tiles': len(tile_ids), 'tile_stats': []}
+      profile.append(stats)
+
+    if not wait:
+      req.pinned = True
+      futures = self._send_all('run_kernel', req, targets=None, wait=False, timeout=timeout)
+      self._pending_kernels().append(futures)
+      return None
+
     futures = self._send_all('run_kernel', req, targets=None, timeout=timeout)
+    if combiner is not None:
+      # only the root of the reduction tree returns a value.
+      for is_root, combined in futures:
+        if is_root:
+          return combined
+      return None
+
     result = {}
     for f in futures:
+      if isinstance(f, core.KernelProfileResp):
+        stats['tile_stats'].extend(f.tiles)
+        f = f.result
       for source_tile, map_result in f.iteritems():
+        if source_tile in result:
+          # the tile was run speculatively on two workers; keep the first result.
+          self._discard_duplicate(result[source_tile], map_result)
+          continue
         result[source_tile] = map_result
     return result
 
+  def _pending_kernels(self):
+    # futures must be waited for in the thread which created them.
+    if not hasattr(self._pending, 'kernels'):
+      self._pending.kernels = []
+    return self._pending.kernels
+
+  def join_pending(self):
+    '''
+    Wait for the kernels started with ``map(..., wait=False)`` by this thread.
+
+    Raises the first exception raised by any of the kernels.
+    '''
+    pending = self._pending_kernels()
+    error = None
+    while pending:
+      try:
+        pending.pop(0).wait()
+      except Exception:
+        if error is None:
+          error = sys.exc_info()
+    if error is not None:
+      raise error[0], error[1], error[2]
+
+  def _discard_duplicate(self, kept, duplicate):
+    '''Destroy the tiles created by ``duplicate`` which are not shared with ``kept``.'''
+    if not isinstance(duplicate, list):
+      return
+    kept_ids = set(tile_id for _, tile_id in kept)
+    ids = [tile_id for _, tile_id in duplicate
+           if isinstance(tile_id, core.TileId) and tile_id not in kept_ids]
+    if ids:
+      self.destroy_all(ids)
+
   def tile_op(self, tile_id, fn):
     '''Run ``fn`` on a single tile.
     
@@ -51,7 +51,8 @@ FLAGS.add(HostListFlag('hosts', default=[('localhost', 8)]))
 FLAGS.add(BoolFlag('xterm', default=False, help='Run workers in xterm'))
 FLAGS.add(BoolFlag('oprofile', default=False, help='Run workers inside of operf'))
 FLAGS.add(AssignModeFlag('assign_mode', default=AssignMode.BY_NODE))
-FLAGS.add(BoolFlag('use_single_core', default=True))
+FLAGS.add(BoolFlag('use_single_core', default=True,
+                   help='Pin each worker to its own CPUs (see --cpu_affinity)'))
 
 FLAGS.add(BoolFlag(
   'use_threads',
@@ -133,11 +133,27 @@ FLAGS.add(StrFlag('tile_assignment_strategy', default='round_robin', help='Decid
 FLAGS.add(StrFlag('checkpoint_path', default='/tmp/spartan/checkpoint/', help='Path for saving checkpoint information'))
 FLAGS.add(IntFlag('default_rpc_timeout', default=60))
 FLAGS.add(IntFlag('max_zeromq_sockets', default=4096))
+FLAGS.add(IntFlag('send_queue_high_watermark', default=256 * 1024 * 1024,
+                  help='Bytes queued on a server socket at which senders block and reads are paused'))
+FLAGS.add(IntFlag('send_queue_low_watermark', default=64 * 1024 * 1024,
+                  help='Queued bytes below which blocked senders on a server socket resume'))
 
 FLAGS.add(BoolFlag('opt_keep_stack', default=False))
 FLAGS.add(BoolFlag('capture_expr_stack', default=False))
 FLAGS.add(BoolFlag('dump_timers', default=False))
 FLAGS.add(BoolFlag('load_balance', default=False))
+FLAGS.add(BoolFlag('steal_split_tiles', default=False,
+                   help='When load balancing, allow splitting a worker\'s last tile with an idle worker'))
+FLAGS.add(BoolFlag('speculative_execution', default=False,
+                   help='When load balancing, run backup copies of straggling tiles on idle workers'))
+FLAGS.add(IntFlag('speculation_slowdown', default=3,
+                  help='A running tile is a straggler once it has taken this many times the median tile time'))
+FLAGS.add(BoolFlag('pipeline_kernels', default=False,
+                   help='Start kernels consuming the output of a map before the map has finished'))
+FLAGS.add(IntFlag('lineage_depth', default=0,
+                  help='Number of map kernels remembered for recomputing lost tiles; '
+                       'keeps the source arrays of those kernels alive (0 to disable)'))
+FLAGS.add(IntFlag('aggregation_fanout', default=2, help='Number of children of each worker in the tree used to combine kernel results'))
 
 # print flags in sorted order
 # from http://stackoverflow.com/questions/12268602/sort-argparse-help-alphabetically
@@ -8,7 +8,7 @@ running a function on array data (`KernelReq`, `ResultResp`), registering and in
 workers (`RegisterReq`, `InitializeReq`).
 '''
 
-from traits.api import Function, Instance, Dict, Int, HasTraits, Tuple, PythonValue, List, Float, Str, Trait
+from traits.api import Function, Instance, Dict, Int, HasTraits, Tuple, PythonValue, List, Float, Str, Trait, Bool
 import numpy as np
 from spartan.array.tile import Tile
 from node import Node
@@ -42,15 +42,30 @@ cdef class TileId(object):
 
 
 cdef class WorkerStatus(object):
-  '''Status information sent to the master in a heartbeat message.''' 
+  '''Status information sent to the master in a heartbeat message.
+  
+  ``kernel_running_tiles`` is a list of ``(tile, seconds running)`` for the tiles of
+  kernel ``kernel_id`` currently executing, and ``avg_tile_time`` the average
+  time taken by the finished tiles of that kernel.
+
+  ``tile_throughput`` maps from kernel type (the name of the mapper function)
+  to the measured rate in bytes/s at which the worker processes tiles, and
+  ``net_throughput`` is the measured rate of reads from other workers.
+  ''' 
   cdef public long total_physical_memory
   cdef public int num_processors
   cdef public float mem_usage, cpu_usage
   cdef public double last_report_time
   cdef public list kernel_remain_tiles, task_failures
+  cdef public int kernel_id
+  cdef public list kernel_running_tiles
+  cdef public double avg_tile_time
+  cdef public dict tile_throughput
+  cdef public double net_throughput
   
   def __init__(self, phy_memory, num_processors, mem_usage, cpu_usage, last_report_time, 
-  			   kernel_remain_tiles, task_failures):
+  			   kernel_remain_tiles, task_failures, kernel_id=-1, kernel_running_tiles=None,
+           avg_tile_time=0.0, tile_throughput=None, net_throughput=0.0):
     self.total_physical_memory = phy_memory
     self.num_processors = num_processors
     self.mem_usage = mem_usage
@@ -58,23 +73,39 @@ cdef class WorkerStatus(object):
     self.last_report_time = last_report_time
     self.kernel_remain_tiles = kernel_remain_tiles
     self.task_failures = task_failures
+    self.kernel_id = kernel_id
+    self.kernel_running_tiles = kernel_running_tiles if kernel_running_tiles is not None else []
+    self.avg_tile_time = avg_tile_time
+    self.tile_throughput = tile_throughput if tile_throughput is not None else {}
+    self.net_throughput = net_throughput
 
   def __reduce__(self):
     return (WorkerStatus, (self.total_physical_memory, self.num_processors, 
                            self.mem_usage, self.cpu_usage, self.last_report_time, 
-                           self.kernel_remain_tiles, self.task_failures))
+                           self.kernel_remain_tiles, self.task_failures,
+                           self.kernel_id, self.kernel_running_tiles, self.avg_tile_time,
+                           self.tile_throughput, self.net_throughput))
       
-  def update_status(self, mem_usage, cpu_usage, report_time, kernel_remain_tiles):
+  def update_status(self, mem_usage, cpu_usage, report_time, kernel_remain_tiles,
+                    kernel_id=-1, kernel_running_tiles=None, avg_tile_time=0.0,
+                    tile_throughput=None, net_throughput=0.0):
     self.mem_usage = mem_usage
     self.cpu_usage = cpu_usage
     self.last_report_time = report_time
     self.kernel_remain_tiles = kernel_remain_tiles
+    self.kernel_id = kernel_id
+    self.kernel_running_tiles = kernel_running_tiles if kernel_running_tiles is not None else []
+    self.avg_tile_time = avg_tile_time
+    if tile_throughput is not None:
+      self.tile_throughput = tile_throughput
+    self.net_throughput = net_throughput
   
   def add_task_failure(self, task_req):
     self.task_failures.append(task_req)
     
   def clean_status(self):
     self.kernel_remain_tiles = []
+    self.kernel_running_tiles = []
     self.task_failures = []
     
   def __repr__(WorkerStatus self):
@@ -174,11 +205,47 @@ class RunKernelReq(Message):
   
   For efficiency (since Python serialization is slow), the same message
   is sent to all workers. 
+
+  If ``combiner`` is set, workers merge their tile results with it and
+  forward the partial result up the tree of workers in ``reduce_tree``
+  (each worker has ``tree_fanout`` children); only the root returns the
+  combined value to the master.
+
+  If ``pinned`` is set, tiles are only run by the worker holding them
+  (they are not stolen by other workers when load balancing).
+
+  If ``profile`` is set, workers reply with a `KernelProfileResp` holding
+  the time and I/O of each tile (ignored for combined kernels).
+
+  ``job_id`` and ``session_id`` name the job issuing the kernel (see 
+  `spartan.blob_ctx.job`).  Workers run kernels with a higher ``priority``
+  first, interrupting lower priority kernels between tiles; kernels of
+  equal priority share workers between jobs in proportion to ``weight``.
   '''
-  #_members = ['blobs', 'mapper_fn', 'kw']
+  #_members = ['blobs', 'mapper_fn', 'kw', 'kernel_id', 'combiner', 'reduce_tree', 'tree_fanout', 'pinned',
+  #            'job_id', 'session_id', 'priority', 'weight', 'profile']
   blobs = List
   mapper_fn = Function(None)
   kw = Dict
+  kernel_id = Int(-1)
+  combiner = PythonValue(None)
+  reduce_tree = List
+  tree_fanout = Int(2)
+  pinned = Bool(False)
+  job_id = Str('')
+  session_id = Str('')
+  priority = Int(0)
+  weight = Float(1.0)
+  profile = Bool(False)
+
+class AggregateReq(Message):
+  '''
+  A partial kernel result sent from a worker to its parent in the reduction tree.
+  '''
+  #_members = ['kernel_id', 'worker_id', 'result']
+  kernel_id = Int
+  worker_id = Int
+  result = PythonValue(None)
 
 class RunKernelResp(Message):
   '''The result returned from running a kernel function.
@@ -188,6 +255,17 @@ class RunKernelResp(Message):
   #_members = ['result']
   result = PythonValue
 
+class KernelProfileResp(Message):
+  '''
+  The result of a kernel run with ``profile`` set.
+
+  ``tiles`` lists a ``(tile, seconds, bytes fetched, bytes updated)``
+  tuple for each tile the worker ran.
+  '''
+  #_members = ['result', 'tiles']
+  result = PythonValue
+  tiles = List
+
 class CreateTileReq(Message):
   #_members = ['tile_id', 'data']
   tile_id = Instance(TileId)
@@ -202,11 +280,42 @@ class HeartbeatReq(Message):
   worker_id = Int
   worker_status = Instance(WorkerStatus)
 
-class UpdateAndStealTileReq(Message):
-  #_members = ['worker_id', 'old_tile_id', 'new_tile_id']
+class StealTilesReq(Message):
+  '''
+  Sent by an idle worker to the master to ask for more work from kernel ``kernel_id``.
+
+  ``allow_backup`` is set if tiles of the kernel may be run speculatively;
+  ``finished_backups`` lists backup tiles this worker has completed.
+  ``kernel_type`` names the kernel for comparing worker speeds (see
+  `Master.worker_speed`).
+  '''
+  #_members = ['worker_id', 'kernel_id', 'allow_backup', 'finished_backups', 'kernel_type']
   worker_id = Int
-  old_tile_id = Instance(TileId)
-  new_tile_id = Instance(TileId)
+  kernel_id = Int
+  allow_backup = Bool(False)
+  finished_backups = List
+  kernel_type = Str('')
+
+class TileListMessage(Message):
+  '''
+  A batch of tiles of a running kernel.
+
+  Entries are either a `TileId`, or a ``(TileId, TileExtent)`` pair
+  naming part of a tile which has been split between workers.
+  '''
+  #_members = ['kernel_id', 'tiles', 'backup']
+  kernel_id = Int
+  tiles = List
+  backup = Bool(False)
+
+class SplitTileReq(Message):
+  '''
+  Ask a worker to only process the ``keep`` sub-extent of the queued tile ``tile``.
+  '''
+  #_members = ['kernel_id', 'tile', 'keep']
+  kernel_id = Int
+  tile = PythonValue(None)
+  keep = PythonValue(None)
   
 class TileOpReq(Message):
   #_members = ['tile_id', 'fn']
@@ -20,10 +20,12 @@ live in their own modules:
 * Apply a stencil/convolution to an array `spartan.expr.stencil`
 * Slicing/indexing `spartan.expr.index`.
 
-Optimizations on DAGs live in `spartan.expr.optimize`.
+Optimizations on DAGs live in `spartan.expr.optimize`, and the evaluation
+of DAGs in `spartan.expr.scheduler`; `explain` reports on both.
 """
 
-from base import Expr, evaluate, optimized_dag, glom, eager, lazify, as_array, force, NotShapeable, newaxis
+from base import Expr, evaluate, optimized_dag, glom, eager, truncate, lazify, as_array, force, keep, NotShapeable, newaxis, symbolic_shapes
+from . import scheduler
 from .builtins import *
 from .assign import assign
 from .map import map, map2
@@ -41,7 +43,8 @@ from .fio import save, load, pickle, unpickle, partial_load, partial_unpickle
 from .reshape import reshape
 from .retile import retile
 from .transpose import transpose
-from .dot import dot
+from .dot import dot, gram, explain_dot
+from .explain import explain
 from .sort import sort, argsort, argpartition, partition
 
 Expr.outer = outer
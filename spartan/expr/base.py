@@ -4,9 +4,13 @@ well as common subclasses for collections.
 '''
 
 import collections
+import itertools
+import os
+import shutil
 import weakref
 
 import sys
+import threading
 import traceback
 import numpy as np
 
@@ -14,11 +18,27 @@ from ..node import Node, indent
 from .. import blob_ctx, node, util
 from ..util import Assert, copy_docstring
 from ..array import distarray
-from ..config import FLAGS, BoolFlag
-from ..rpc import TimeoutException
+from ..config import FLAGS, BoolFlag, IntFlag
 from traits.api import Any, Instance, Int, PythonValue
 
 FLAGS.add(BoolFlag('opt_expression_cache', True, 'Enable expression caching.'))
+FLAGS.add(IntFlag('eval_cache_bytes', default=0,
+                  help='Bytes of cached expression results kept across the cluster (0 for no limit)'))
+FLAGS.add(BoolFlag('eval_cache_spill', default=False,
+                   help='Spill evicted results to --checkpoint_path when reloading is cheaper than recomputing'))
+FLAGS.add(BoolFlag('evaluate_shapes', default=True,
+                   help='Evaluate expressions whose shape cannot be inferred when their shape is asked for'))
+FLAGS.add(IntFlag('max_expr_depth', default=200,
+                  help='Evaluate the inputs of a new expression whose chain of unevaluated '
+                       'expressions is longer than this; kernels then run when the '
+                       'expression is constructed (0 for no limit)'))
+FLAGS.add(IntFlag('max_expr_nodes', default=0,
+                  help='Evaluate the inputs of a new expression which depends on more '
+                       'distinct unevaluated expressions than this; kernels then run when '
+                       'the expression is constructed (0 for no limit)'))
+
+# Rate at which spilled results are written and read back, in bytes per second.
+SPILL_BYTES_PER_SEC = 2e8
 
 class newaxis(object):
   '''
@@ -31,6 +51,41 @@ class NotShapeable(Exception):
   first evaluating the expression.
   '''
 
+_shapes = threading.local()
+
+class symbolic_shapes(object):
+  '''
+  Within this context, `Expr.shape` never evaluates an expression: if the
+  shape cannot be inferred, `NotShapeable` is raised instead.
+
+  The optimizer runs its passes in this context.
+  '''
+  def __enter__(self):
+    self.previous = getattr(_shapes, 'symbolic', False)
+    _shapes.symbolic = True
+    return self
+
+  def __exit__(self, *args):
+    _shapes.symbolic = self.previous
+
+_truncation = threading.local()
+
+class no_truncation(object):
+  '''
+  Within this context, new expressions are never truncated (see
+  `Expr._truncate`).
+
+  The optimizer copies graphs in this context: copies are no deeper than
+  the graphs they are made from.
+  '''
+  def __enter__(self):
+    self.previous = getattr(_truncation, 'disabled', False)
+    _truncation.disabled = True
+    return self
+
+  def __exit__(self, *args):
+    _truncation.disabled = self.previous
+
 unique_id = iter(xrange(10000000))
 
 def _map(*args, **kw):
@@ -63,6 +118,28 @@ def expr_like(expr, **kw):
   #util.log_info('Copied %s', new_expr)
   return new_expr
 
+def _cached_bytes(value):
+  '''Estimate the memory held by a cached result.'''
+  if isinstance(value, np.ndarray):
+    return value.nbytes
+  if not isinstance(value, distarray.DistArrayImpl):
+    # scalars, and views which share the tiles of another array.
+    return 0
+  nbytes = int(np.prod(value.shape)) * np.dtype(value.dtype).itemsize
+  if value.sparse:
+    nbytes = int(np.prod(value.shape) * distarray.SPARSE_DENSITY * distarray.SPARSE_ENTRY_BYTES)
+  return nbytes
+
+
+class _CacheEntry(object):
+  def __init__(self, nbytes, cost, recomputable):
+    self.nbytes = nbytes
+    self.cost = cost
+    self.recomputable = recomputable
+    self.priority = 0.0
+    self.spilled = False
+
+
 # Pulled out as a class so that we can add documentation.
 class EvalCache(object):
   '''
@@ -77,17 +154,65 @@ class EvalCache(object):
   no longer directly linked to an expressions lifetime, we have to
   manually track reference counts here, and clear items from the
   cache when the reference count hits zero.
+
+  The cache also tracks the size of each result and the time it took to
+  compute.  If the results exceed ``--eval_cache_bytes``, entries are
+  evicted by cost-aware LRU (GreedyDual-Size): an entry's priority is the
+  clock at its last use plus its recompute cost per byte, the entry with
+  the lowest priority is evicted, and the clock advances to its priority.
+  Evicted results are recomputed from their expression when next needed,
+  or, with ``--eval_cache_spill``, saved to disk when reloading them is
+  cheaper than recomputing (or recomputing would give a different result).
   '''
   def __init__(self):
     self.refs = collections.defaultdict(int)
     self.cache = {}
+    self.entries = {}
+    self.total_bytes = 0
+    self.clock = 0.0
+    self._evicting = False
+    # results are set from concurrently evaluated expressions (see
+    # `scheduler`), and spilling evaluates expressions while locked.
+    self._lock = threading.RLock()
+
+  def set(self, exprid, value, cost=0.0, recomputable=True):
+    '''
+    Cache ``value`` as the result of ``exprid``.
 
-  def set(self, exprid, value):
+    :param cost: seconds it took to compute ``value``.
+    :param recomputable: False if evaluating the expression again would
+      not give the same result; such entries are only evicted by spilling.
+    '''
     #assert not exprid in self.cache, 'Trying to replace an existing cache entry!'
-    self.cache[exprid] = value
+    with self._lock:
+      self.release(exprid)
+      self.cache[exprid] = value
+      entry = _CacheEntry(_cached_bytes(value), cost, recomputable)
+      self.entries[exprid] = entry
+      self.total_bytes += entry.nbytes
+      self._touch(entry)
+      self._evict(exclude=exprid)
 
   def get(self, exprid):
-    return self.cache.get(exprid, None)
+    with self._lock:
+      entry = self.entries.get(exprid)
+      if entry is None:
+        return None
+      if exprid not in self.cache and not self._reload(exprid, entry):
+        return None
+      self._touch(entry)
+      return self.cache.get(exprid, None)
+
+  def __contains__(self, exprid):
+    '''True if a result is cached (or spilled) for ``exprid``; does not count as a use.'''
+    return exprid in self.entries
+
+  def release(self, exprid):
+    '''Drop the cached value for ``exprid``, while the expression stays registered.'''
+    with self._lock:
+      self._drop(exprid)
+      self._remove_spill(exprid)
+      self.entries.pop(exprid, None)
 
   def register(self, exprid):
     self.refs[exprid] += 1
@@ -96,13 +221,91 @@ class EvalCache(object):
     self.refs[expr_id] -= 1
     if self.refs[expr_id] == 0:
       #util.log_debug('Destroying... %s', expr_id)
-      if expr_id in self.cache:
+      if expr_id in self.cache or expr_id in self.entries:
         #import objgraph
         #objgraph.show_backrefs([self.cache[expr_id]], filename='%s-refs.png' % expr_id)
-        del self.cache[expr_id]
+        self.release(expr_id)
 
       del self.refs[expr_id]
 
+  def _touch(self, entry):
+    entry.priority = self.clock + entry.cost / max(entry.nbytes, 1)
+
+  def _drop(self, exprid):
+    '''Remove the in-memory value for ``exprid``, keeping its entry.'''
+    if exprid in self.cache:
+      del self.cache[exprid]
+      self.total_bytes -= self.entries[exprid].nbytes
+
+  def _spill_path(self, exprid):
+    return os.path.join(FLAGS.checkpoint_path, 'eval_cache'), 'expr%d' % exprid
+
+  def _should_spill(self, entry, value):
+    if not FLAGS.eval_cache_spill or not isinstance(value, distarray.DistArrayImpl):
+      return False
+    return not entry.recomputable or entry.cost > 2 * entry.nbytes / SPILL_BYTES_PER_SEC
+
+  def _evict(self, exclude):
+    budget = FLAGS.eval_cache_bytes
+    if budget <= 0 or self.total_bytes <= budget or self._evicting:
+      return
+    self._evicting = True
+    try:
+      candidates = [(entry.priority, exprid) for exprid, entry in self.entries.iteritems()
+                    if exprid in self.cache and exprid != exclude and entry.nbytes > 0 and
+                    (entry.recomputable or FLAGS.eval_cache_spill)]
+      candidates.sort()
+      for priority, exprid in candidates:
+        if self.total_bytes <= budget:
+          break
+        self.clock = max(self.clock, priority)
+        self._evict_entry(exprid)
+    finally:
+      self._evicting = False
+
+  def _evict_entry(self, exprid):
+    entry = self.entries.get(exprid)
+    if entry is None or exprid not in self.cache:
+      # released while spilling another entry.
+      return
+    if not entry.spilled and self._should_spill(entry, self.cache[exprid]):
+      from .fio import save
+      path, prefix = self._spill_path(exprid)
+      try:
+        save(self.cache[exprid], prefix, path=path)
+        entry.spilled = True
+      except Exception:
+        util.log_warn('Failed to spill expression %d', exprid, exc_info=1)
+    if not entry.spilled and not entry.recomputable:
+      return
+
+    util.log_debug('Evicting %d (%d bytes, spilled=%s)', exprid, entry.nbytes, entry.spilled)
+    self._drop(exprid)
+    if not entry.spilled:
+      del self.entries[exprid]
+
+  def _reload(self, exprid, entry):
+    from .fio import load
+    path, prefix = self._spill_path(exprid)
+    util.log_debug('Reloading spilled expression %d', exprid)
+    try:
+      value = load(prefix, path=path).evaluate()
+    except IOError:
+      util.log_warn('Spilled result of expression %d is missing', exprid)
+      del self.entries[exprid]
+      return False
+    self.cache[exprid] = value
+    self.total_bytes += entry.nbytes
+    self._evict(exclude=exprid)
+    return True
+
+  def _remove_spill(self, exprid):
+    entry = self.entries.get(exprid)
+    if entry is None or not entry.spilled:
+      return
+    path, prefix = self._spill_path(exprid)
+    shutil.rmtree(os.path.join(path, prefix), ignore_errors=True)
+
 class ExprTrace(object):
   '''
   Captures the stack trace for an expression.
@@ -148,6 +351,43 @@ class ExprTrace(object):
 
 eval_cache = EvalCache()
 
+def _pending(value):
+  '''Return the depth, and the ids of the nodes, of the unevaluated graph computing ``value``.'''
+  if not isinstance(value, Expr) or value.expr_id in eval_cache:
+    return 0, frozenset()
+  return value._depth, value._pending_ids
+
+def _collapse(values):
+  '''Evaluate the expressions in ``values``, returning a list of `Val` nodes.'''
+  if not values:
+    return []
+  with no_truncation():
+    results = evaluate(TupleExpr(vals=tuple(values)))
+  return [Val(val=v) for v in results]
+
+# expr_id -> an expression whose result user code may still need: one it
+# evaluated, or passed to `keep`.  Entries go away with the expression.
+# Copies made by the optimizer (see `expr_like`) share the id.
+_user_held = weakref.WeakValueDictionary()
+
+def keep(*exprs):
+  '''
+  Keep the results of ``exprs`` cached while they are alive, when they are
+  evaluated as part of another expression (see ``--release_intermediates``).
+
+  Expressions which are evaluated directly are kept automatically.
+  '''
+  for e in exprs:
+    Assert.isinstance(e, Expr)
+    _user_held[e.expr_id] = e
+
+def user_held(nodes):
+  '''
+  Return the ids of the expressions in ``nodes`` whose results user code
+  holds on to (see `keep`).
+  '''
+  return set(node.expr_id for node in nodes if node.expr_id in _user_held)
+
 class Expr(Node):
   '''
   Base class for all expressions.
@@ -169,6 +409,11 @@ class Expr(Node):
 
   optimized_expr = None
 
+  # length of the longest chain, and number, of unevaluated expressions
+  # this expression depends on (including itself).
+  _depth = 0
+  _pending_ids = frozenset()
+
   @property
   def ndim(self):
     return len(self.shape)
@@ -181,12 +426,15 @@ class Expr(Node):
     '''
     Return a cached value for this `Expr`.
 
-    If a cached value is not available, or the cached array is
-    invalid (missing tiles), returns None.
+    If the cached array is missing tiles, they are recomputed from its
+    lineage or reloaded from a checkpoint.  If a cached value is not
+    available, or it cannot be repaired, returns None.
     '''
     result = eval_cache.get(self.expr_id)
     if result is not None and len(result.bad_tiles) == 0:
       return result
+    if result is not None and distarray.recover(result):
+      return result
     return self.load_data(result)
 
     # get distarray from eval_cache
@@ -256,48 +504,107 @@ class Expr(Node):
     eval_cache.register(self.expr_id)
     self.needs_cache = self.needs_cache and FLAGS.opt_expression_cache
 
+    self._count_pending()
+    if self._truncate():
+      self._count_pending()
+
+  def _count_pending(self):
+    counts = [_pending(v) for v in self.dependencies().itervalues()]
+    self._depth = max([d for d, _ in counts] or [0])
+    if not isinstance(self, CollectionExpr):
+      self._depth += 1
+
+    # shared nodes are counted once.  Only ``--max_expr_nodes`` + 1 ids are
+    # kept: enough to tell that the limit is exceeded.
+    limit = FLAGS.max_expr_nodes
+    if limit <= 0:
+      self._pending_ids = frozenset()
+      return
+    ids = set()
+    if not isinstance(self, CollectionExpr):
+      ids.add(self.expr_id)
+    for _, pending in counts:
+      ids.update(pending)
+    if len(ids) > limit + 1:
+      ids = itertools.islice(ids, limit + 1)
+    self._pending_ids = frozenset(ids)
+
+  @property
+  def _size(self):
+    '''Number of distinct unevaluated expressions this depends on (up to ``--max_expr_nodes`` + 1).'''
+    return len(self._pending_ids)
+
+  def _truncate(self):
+    '''
+    Truncate the graph of a new expression if it is too large.
+
+    Lazy loops (e.g. ``x = (b - dot(R, x)) / D``) build a longer graph
+    every iteration, which makes optimizing and evaluating it slower (and
+    can eventually exceed the recursion limit).  If this expression depends
+    on a chain of more than ``--max_expr_depth`` unevaluated expressions,
+    or on more than ``--max_expr_nodes`` distinct ones, its inputs are evaluated
+    together and replaced by `Val` nodes holding their results.
+
+    Collections are not truncated themselves: the expression using them is.
+
+    Returns:
+      bool: True if the inputs were replaced.
+    '''
+    if getattr(_truncation, 'disabled', False) or isinstance(self, CollectionExpr):
+      return False
+    too_deep = FLAGS.max_expr_depth > 0 and self._depth > FLAGS.max_expr_depth
+    too_large = FLAGS.max_expr_nodes > 0 and self._size > FLAGS.max_expr_nodes
+    if not too_deep and not too_large:
+      return False
+
+    def collapsible(v):
+      return isinstance(v, Expr) and not isinstance(v, (Val, AsArray)) and _pending(v)[0] > 0
+
+    inputs = []
+    for k in self.members:
+      v = getattr(self, k)
+      if isinstance(v, CollectionExpr):
+        inputs.extend(c for c in v.dependencies().itervalues() if collapsible(c))
+      elif collapsible(v):
+        inputs.append(v)
+    if not inputs:
+      return False
+
+    util.log_info('Truncating %s: depth=%d, size=%d', self.typename(), self._depth, self._size)
+    collapsed = dict(zip([id(v) for v in inputs], _collapse(inputs)))
+    replace = lambda v: collapsed.get(id(v), v)
+    for k in self.members:
+      v = getattr(self, k)
+      if isinstance(v, DictExpr):
+        setattr(self, k, DictExpr(vals=dict((dk, replace(dv)) for dk, dv in v.vals.iteritems())))
+      elif isinstance(v, CollectionExpr):
+        setattr(self, k, v.__class__(vals=type(v.vals)(replace(c) for c in v.vals)))
+      elif id(v) in collapsed:
+        setattr(self, k, collapsed[id(v)])
+    return True
+
   def evaluate(self):
     '''
     Evaluate an `Expr`.
 
-    Dependencies are evaluated prior to evaluating the expression.
-    The result of the evaluation is stored in the expression cache,
-    future calls to evaluate will return the cached value.
+    Dependencies are evaluated prior to evaluating the expression
+    (see `spartan.expr.scheduler`).  The result of the evaluation is 
+    stored in the expression cache, future calls to evaluate will 
+    return the cached value.
 
     Returns:
       DistArray:
     '''
 
+    # the caller may use this result again, e.g. in a later expression.
+    _user_held.setdefault(self.expr_id, self)
     cache = self.cache()
     if cache is not None:
       util.log_debug('Retrieving %d from cache' % self.expr_id)
       return cache
 
-    ctx = blob_ctx.get()
-    #util.log_info('Evaluting deps for %s', prim)
-    deps = {}
-    for k, vs in self.dependencies().iteritems():
-      if isinstance(vs, Expr):
-        deps[k] = vs.evaluate()
-      else:
-        #assert not isinstance(vs, (dict, list)), vs
-        deps[k] = vs
-    try:
-      value = self._evaluate(ctx, deps)
-      #value = self.optimized()._evaluate(ctx, deps)
-    except TimeoutException:
-      util.log_info('%s %d need to retry', self.__class__, self.expr_id)
-      return self.evaluate()
-    except Exception:
-      print >>sys.stderr, 'Error executing expression'
-      self.stack_trace.dump()
-      raise
-
-    if self.needs_cache:
-      #util.log_info('Caching %s -> %s', prim.expr_id, value)
-      eval_cache.set(self.expr_id, value)
-
-    return value
+    from . import scheduler
+    return scheduler.evaluate_dag(self)
 
   def _evaluate(self, ctx, deps):
     '''
@@ -440,7 +747,10 @@ class Expr(Node):
   def shape(self):
     '''Try to compute the shape of this expression.
 
-    If the value has been computed already this always succeeds.
+    If the value has been computed already this always succeeds.  If the
+    shape cannot be inferred, the expression is evaluated, unless called
+    within `symbolic_shapes` or with ``--evaluate_shapes=false``; then
+    `NotShapeable` is raised.
 
     :rtype: `tuple`
 
@@ -452,9 +762,22 @@ class Expr(Node):
     try:
       return self.compute_shape()
     except NotShapeable:
+      if getattr(_shapes, 'symbolic', False) or not FLAGS.evaluate_shapes:
+        raise
       util.log_debug('Not shapeable: %s', self)
       return evaluate(self).shape
 
+  def static_shape(self):
+    '''
+    Return the shape of this expression if it is known without evaluating
+    anything, else None.
+    '''
+    with symbolic_shapes():
+      try:
+        return self.shape
+      except NotShapeable:
+        return None
+
   @property
   def size(self):
     return np.prod(self.shape)
@@ -682,6 +1005,35 @@ def eager(node):
   return Val(val=result)
 
 
+def truncate(value):
+  '''
+  Mark an iteration boundary: evaluate the expressions in ``value``
+  together, and return them as `Val` nodes.
+
+  Iterative programs call this at the end of each iteration to keep the
+  graph (and the cost of optimizing it) from growing, e.g.::
+
+    for i in range(n):
+      galaxy['x'] += dt * galaxy['vx']
+      galaxy = expr.truncate(galaxy)
+
+  See also ``--max_expr_depth``, which truncates long graphs automatically.
+
+  :param value: `Expr`, or a list, tuple or dict of them.
+  :rtype: ``value`` with each `Expr` replaced by a `Val`.
+  '''
+  if isinstance(value, dict):
+    keys = value.keys()
+    return dict(zip(keys, truncate([value[k] for k in keys])))
+  if isinstance(value, (list, tuple)):
+    exprs = [v for v in value if isinstance(v, Expr)]
+    collapsed = dict(zip([id(v) for v in exprs], _collapse(exprs)))
+    return type(value)(collapsed.get(id(v), v) for v in value)
+  if isinstance(value, Expr):
+    return _collapse([value])[0]
+  return value
+
+
 def lazify(val):
   '''
   Lift ``val`` into an Expr node.
@@ -58,7 +58,7 @@ class Broadcast(distarray.DistArray):
     '''
     return np.prod(self.base.shape) - 1
 
-  def foreach_tile(self, mapper_fn, kw=None):
+  def foreach_tile(self, mapper_fn, kw=None, combiner=None):
     ctx = blob_ctx.get()
 
     if kw is None: kw = {}
@@ -67,7 +67,8 @@ class Broadcast(distarray.DistArray):
 
     return ctx.map(self.base.tiles.values(),
                    mapper_fn = _broadcast_mapper,
-                   kw=kw)
+                   kw=kw,
+                   combiner=combiner)
 
   def _base_ex(self, ex):
     # Convert ex (by dropping or shrinking dimensions) to map onto the base array.
@@ -21,7 +21,7 @@ from .map import map, map2
 from .map_with_location import map_with_location
 from .outer import outer
 from .ndarray import ndarray
-from .optimize import disable_parakeet, not_idempotent
+from .optimize import disable_parakeet, not_idempotent, tile_generator
 from .reduce import reduce
 import __builtin__
 
@@ -367,10 +367,12 @@ def tocoo(array):
   return map(array, fn=_tocoo)
 
 
+@tile_generator
 def _make_ones(input):
   return np.ones(input.shape, input.dtype)
 
 
+@tile_generator
 def _make_zeros(input):
   return np.zeros(input.shape, input.dtype)
 
@@ -401,6 +403,7 @@ def ones(shape, dtype=np.float, tile_hint=None):
              fn=_make_ones)
 
 
+@tile_generator
 @disable_parakeet
 def _arange_mapper(tile, ex, start, stop, step, dtype=None):
   pos = extent.ravelled_pos(ex[0], ex[2])
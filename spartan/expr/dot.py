@@ -1,19 +1,59 @@
 '''
 Dot expr.
+
+`dot` picks one of several physical strategies using a simple cost model
+(see `plan_dot` and `explain_dot`):
+
+``map2``
+  join the column slabs of ``a`` with the row slabs of ``b``; each slab
+  produces a partial result the size of the output.
+``outer``
+  join every row slab of ``a`` with every column slab of ``b``; ``b`` is
+  read once per tile of ``a``, the output is written once.
+``rows``
+  for each tile of ``a``, fetch the matching rows of ``b`` (`DotExpr`);
+  this path has a specialized kernel for sparse ``a`` times a vector.
+``broadcast``
+  ``b`` is a local (numpy) array which is sent to every worker.
+``gram``
+  one operand is a transpose, e.g. ``dot(transpose(Y), Y)``; each tile
+  multiplies with the matching slab of the other operand, and the partial
+  products are summed on the workers (`GramExpr`).
 '''
 
 import numpy as np
 import scipy.sparse as sp
+from scipy.linalg import get_blas_funcs
 from . import outer, map
-from .. import blob_ctx, util, sparse, rpc
+from .. import blob_ctx, master, util, sparse, rpc
+from ..array.tile import TYPE_SPARSE
 from .base import Expr, lazify
+from .ndarray import NdArrayExpr
 from .shuffle import target_mapper, notarget_mapper
+from .transpose import TransposeExpr
 from ..util import is_iterable, Assert
 from ..array import extent, tile, distarray
 from ..core import LocalKernelResult
 from traits.api import PythonValue, HasTraits
 
 
+def _dot_coo_vector(a, b):
+  '''
+  Multiply the coo matrix ``a`` by the dense vector (or column) ``b``.
+
+  `sparse.dot_coo_dense_unordered_map` takes float32 data with int32
+  indices and a float32 column; other inputs use scipy.
+  '''
+  if a.dtype != np.float32 or a.row.dtype != np.int32 or a.col.dtype != np.int32:
+    return a.dot(b)
+  column = np.asarray(b, dtype=np.float32).reshape(b.shape[0], 1)
+  result = sparse.dot_coo_dense_unordered_map(a, column).toarray()
+  result = result.astype(np.result_type(a.dtype, b.dtype), copy=False)
+  if len(b.shape) == 1:
+    return result.reshape(a.shape[0])
+  return result
+
+
 def _dot_mapper(inputs, ex, av, bv):
   ex_a = ex
   if len(av.shape) == 1:
@@ -48,8 +88,9 @@ def _dot_mapper(inputs, ex, av, bv):
 
   util.log_debug('Fetched...ax:%s in %s, bx:%s in %s', ex_a, time_a, ex_b, time_b)
 
-  if isinstance(a, sp.coo_matrix) and (len(b.shape) == 1 or b.shape[1] == 1):
-    result = sparse.dot_coo_dense_unordered_map(a, b)
+  if (isinstance(a, sp.coo_matrix) and not sp.issparse(b) and
+      (len(b.shape) == 1 or b.shape[1] == 1)):
+    result = _dot_coo_vector(a, b)
   else:
     result = a.dot(b)
 
@@ -140,7 +181,7 @@ class DotExpr(Expr):
 
     if nptype:
       target = distarray.create(shape, dtype=av.dtype, tile_hint=tile_hint,
-                                reducer=np.add)
+                                reducer=np.add, kernel_type=target_mapper.__name__)
       fn_kw = dict(numpy_data=bv)
       av.foreach_tile(mapper_fn=target_mapper, kw=dict(source=av,
                                                        map_fn=_dot_numpy,
@@ -149,7 +190,8 @@ class DotExpr(Expr):
     else:
       sparse = (av.sparse and bv.sparse)
       target = distarray.create(shape, dtype=av.dtype, tile_hint=tile_hint,
-                                reducer=np.add, sparse=sparse)
+                                reducer=np.add, sparse=sparse,
+                                kernel_type=target_mapper.__name__)
       fn_kw = dict(av=av, bv=bv)
       av.foreach_tile(mapper_fn=target_mapper, kw=dict(map_fn=_dot_mapper,
                                                        source=av,
@@ -235,49 +277,382 @@ def dot_outer_mapper(ex_a, tile_a, ex_b, tile_b):
   #TODO: Sparse array
 
 
+def _syrk(x):
+  '''Return ``x.T.dot(x)``; for dense floating point tiles only the upper triangle is computed.'''
+  if sp.issparse(x) or x.dtype not in (np.float32, np.float64):
+    return x.T.dot(x)
+  # x.T is fortran ordered, so blas reads it without a copy.
+  return get_blas_funcs('syrk', (x,))(1.0, x.T)
+
+
+def _gram_mapper(ex, av=None, bv=None, axis=0):
+  '''
+  Multiply the tile ``ex`` of ``av`` with the slab of ``bv`` (``av`` if
+  ``bv`` is None) covering the same range of ``axis``, summing over ``axis``.
+
+  Returns the product as a partial result of the full output.
+  '''
+  other = 1 - axis
+  y_src = av if bv is None else bv
+  shape = (av.shape[other], y_src.shape[other])
+
+  x = av.fetch(ex)
+  if sp.issparse(x):
+    x = x.tocsr()
+  if axis == 1:
+    x = x.T
+
+  symmetric = bv is None and ex.shape[other] == av.shape[other]
+  if symmetric:
+    product = _syrk(x)
+  else:
+    ul, lr = [0, 0], list(y_src.shape)
+    ul[axis], lr[axis] = ex.ul[axis], ex.lr[axis]
+    y = y_src.fetch(extent.create(ul, lr, y_src.shape))
+    if sp.issparse(y):
+      y = y.tocsr()
+    if axis == 1:
+      y = y.T
+    if sp.issparse(y) and not sp.issparse(x):
+      product = y.T.dot(x).T
+    else:
+      product = x.T.dot(y)
+
+  if sp.issparse(product):
+    product = product.toarray()
+  partial = np.zeros(shape, dtype=np.result_type(av.dtype, y_src.dtype))
+  partial[ex.ul[other]:ex.lr[other]] = np.asarray(product)
+  return LocalKernelResult(result=partial, futures=None)
+
+
+class GramExpr(Expr):
+  '''
+  ``dot(transpose(a), b)`` (``axis`` 0) or ``dot(a, transpose(b))`` (``axis`` 1).
+
+  Each tile of ``a`` is multiplied with the matching slab of ``b``, and the
+  products are summed along the reduction tree of the workers, so only
+  results of the output's size are sent over the network.  If ``b`` is None
+  the product of ``a`` with itself is computed; it is symmetric, so only its
+  upper triangle is used, and dense tiles spanning the whole output only
+  compute that triangle.
+  '''
+  matrix_a = PythonValue(None, desc="Expr")
+  matrix_b = PythonValue(None, desc="Expr or None")
+  axis = PythonValue(0, desc="Integer")
+  tile_hint = PythonValue(None, desc="Tuple or None")
+
+  def __str__(self):
+    return 'Gram[%s, %s, %s]' % (self.matrix_a, self.matrix_b, self.axis)
+
+  def compute_shape(self):
+    # May raise NotShapeable
+    b = self.matrix_a if self.matrix_b is None else self.matrix_b
+    other = 1 - self.axis
+    return (self.matrix_a.shape[other], b.shape[other])
+
+  def _evaluate(self, ctx, deps):
+    av = deps['matrix_a']
+    bv = deps['matrix_b']
+    b = av if bv is None else bv
+    other = 1 - self.axis
+    shape = (av.shape[other], b.shape[other])
+    dtype = np.result_type(av.dtype, b.dtype)
+
+    result = av.foreach_tile(mapper_fn=_gram_mapper,
+                             kw=dict(av=av, bv=bv, axis=self.axis),
+                             combiner=np.add)
+    if result is None:
+      result = np.zeros(shape, dtype=dtype)
+    if bv is None:
+      result = np.triu(result) + np.triu(result, 1).T
+
+    target = distarray.create(shape, dtype=dtype, tile_hint=self.tile_hint or shape)
+    target.update(extent.create((0, 0), shape, shape), result.astype(dtype))
+    return target
+
+
+# Machine parameters for the cost model.  The network rate is replaced by
+# the throughput measured by the workers once it is known.
+NETWORK_BYTES_PER_SEC = 1e8
+FLOPS_PER_SEC = 1e9
+SPARSE_DENSITY = distarray.SPARSE_DENSITY
+SPARSE_ENTRY_BYTES = distarray.SPARSE_ENTRY_BYTES
+# Operations per stored entry to convert a sparse tile to csr.
+SPARSE_CONVERT_FLOPS = 10
+
+
+class DotOperand(object):
+  '''What the dot cost model knows about an operand.'''
+  def __init__(self, shape, itemsize, sparse, density, grid, local):
+    self.shape = tuple(shape)
+    self.itemsize = itemsize
+    self.sparse = sparse
+    self.density = density
+    # number of tiles along each axis
+    self.grid = tuple(grid)
+    # True if the operand is a local (numpy) value
+    self.local = local
+
+  @property
+  def num_tiles(self):
+    return int(np.prod(self.grid))
+
+  @property
+  def nbytes(self):
+    size = np.prod(self.shape)
+    if self.sparse:
+      return size * self.density * SPARSE_ENTRY_BYTES
+    return size * self.itemsize
+
+  def __repr__(self):
+    return 'shape=%s %s grid=%s' % (
+      self.shape, 'sparse(%.3g)' % self.density if self.sparse else 'dense', self.grid)
+
+
+def _tile_density(t):
+  if t.type != TYPE_SPARSE or t.data is None:
+    return 1.0
+  return float(t.data.nnz) / max(1, np.prod(t.shape))
+
+
+def _default_grid(shape, tile_hint=None):
+  if tile_hint is None:
+    tile_hint = distarray.good_tile_shape(shape, blob_ctx.get().num_workers)
+  return [len(s) for s in distarray.compute_splits(shape, tile_hint)]
+
+
+def _describe(v):
+  '''Return a `DotOperand` for ``v``, without evaluating it.'''
+  if isinstance(v, np.ndarray):
+    return DotOperand(v.shape, v.dtype.itemsize, False, 1.0, [1] * v.ndim, True)
+  if sp.issparse(v):
+    return DotOperand(v.shape, v.dtype.itemsize, True,
+                      float(v.nnz) / max(1, np.prod(v.shape)), [1] * len(v.shape), True)
+
+  value = v.cache() if isinstance(v, Expr) else v
+  if isinstance(value, distarray.DistArrayImpl):
+    shape = value.shape
+    splits = [set() for _ in shape]
+    for ex in value.tiles.iterkeys():
+      for i in range(len(shape)):
+        splits[i].add(ex.ul[i])
+    density = 1.0
+    if value.sparse and value.tiles:
+      # sample a single tile.
+      tile_id = value.tiles.itervalues().next()
+      density = blob_ctx.get().tile_op(tile_id, _tile_density).result
+    return DotOperand(shape, np.dtype(value.dtype).itemsize, value.sparse, density,
+                      [len(s) for s in splits], False)
+
+  # not evaluated yet: look for the array the expression was created from.
+  shape = v.shape
+  density = None
+  source = v
+  while isinstance(source, map.MapExpr):
+    density = density or (getattr(source.op, 'kw', None) or {}).get('density')
+    source = source.children[0]
+  if isinstance(source, NdArrayExpr) and source.shape == shape:
+    sparse = source.sparse
+    grid = _default_grid(shape, source.tile_hint)
+    itemsize = np.dtype(source.dtype).itemsize
+  else:
+    sparse, grid, itemsize = False, _default_grid(shape), 8
+  if not sparse:
+    density = 1.0
+  return DotOperand(shape, itemsize, sparse, density or SPARSE_DENSITY, grid, False)
+
+
+def _network_rate():
+  m = master.get()
+  if m is not None:
+    rates = [s.net_throughput for s in m._worker_statuses.values() if s.net_throughput > 0]
+    if rates:
+      return sum(rates) / len(rates)
+  return NETWORK_BYTES_PER_SEC
+
+
+def _gram_operands(a, b):
+  '''
+  Return ``(x, y, axis)`` if ``dot(a, b)`` is ``gram(x, y, axis)``, i.e. one
+  operand is a transpose; ``y`` is None if both operands read ``x``.
+  Returns None otherwise.
+  '''
+  if not isinstance(a, Expr) or not isinstance(b, Expr):
+    return None
+  if len(a.shape) != 2 or len(b.shape) != 2:
+    return None
+  if isinstance(a, TransposeExpr):
+    x, y, axis = a.array, b, 0
+  elif isinstance(b, TransposeExpr):
+    x, y, axis = a, b.array, 1
+  else:
+    return None
+  return x, (None if y is x else y), axis
+
+
+class DotPlan(object):
+  '''The estimated cost of each dot strategy, and the one chosen.'''
+  def __init__(self, a, b, costs, num_workers, gram=None):
+    self.a = a
+    self.b = b
+    # list of (seconds, strategy, network bytes, flops), cheapest first
+    self.costs = sorted(costs)
+    self.num_workers = num_workers
+    # (x, y, axis) operands of the 'gram' strategy, if it applies
+    self.gram = gram
+
+  @property
+  def strategy(self):
+    return self.costs[0][1]
+
+  def __str__(self):
+    lines = ['dot: a %s, b %s, %d workers' % (self.a, self.b, self.num_workers)]
+    for seconds, strategy, net, flops in self.costs:
+      lines.append('  %s %-9s network=%.3gB flops=%.3g est=%.3gs' % (
+        '*' if strategy == self.strategy else ' ', strategy, net, flops, seconds))
+    return '\n'.join(lines)
+
+
+def plan_dot(a, b):
+  '''
+  Estimate the cost of each strategy for ``dot(a, b)``.
+
+  The estimate counts the bytes moved over the network and the flops
+  required, using the shapes, tiling and placement of ``a`` and ``b``
+  and the density of sparse operands.
+
+  :param a: `Expr` or `DistArray` (2 dimensional)
+  :param b: `Expr`, `DistArray` or `numpy.ndarray`
+  :rtype: `DotPlan`
+  '''
+  da, db = _describe(a), _describe(b)
+  num_workers = max(1, blob_ctx.get().num_workers)
+  m, k = da.shape
+  n = db.shape[1] if len(db.shape) > 1 else 1
+  row_tiles, col_tiles = da.grid[0], da.grid[1]
+
+  if da.sparse and db.sparse:
+    out_density = min(1.0, da.density * db.density * k)
+    out_bytes = m * n * out_density * SPARSE_ENTRY_BYTES
+  else:
+    out_bytes = m * n * max(da.itemsize, db.itemsize)
+  flops = 2.0 * m * k * n * da.density * db.density
+  nnz_a = m * k * da.density
+
+  # fraction of fetched data which lives on another worker
+  remote = (num_workers - 1.0) / num_workers
+  candidates = {}
+  if db.local:
+    candidates['broadcast'] = (num_workers * db.nbytes + col_tiles * out_bytes, flops)
+  else:
+    convert = SPARSE_CONVERT_FLOPS * nnz_a if da.sparse else 0
+    candidates['map2'] = (remote * (da.nbytes + db.nbytes) + da.num_tiles * out_bytes,
+                          flops + convert)
+    candidates['outer'] = (remote * (da.nbytes + da.num_tiles * db.nbytes) + out_bytes,
+                           flops + convert * db.num_tiles)
+    if not da.local:
+      # the row kernel runs over the tiles of ``a``.
+      candidates['rows'] = (remote * row_tiles * db.nbytes + col_tiles * out_bytes, flops)
+
+  gram = _gram_operands(a, b)
+  if gram is not None:
+    x, y, axis = gram
+    # each tile of x along the output axis reads a slab of y; if y is x
+    # and the tiles span the output axis, the slab is the tile itself.
+    dx = _describe(x)
+    slabs = dx.grid[1 - axis]
+    fetch = 0 if y is None and slabs == 1 else remote * slabs * db.nbytes
+    # every tile produces a partial result of the output's size; they are
+    # summed on the workers, and each worker sends one up the reduction tree.
+    candidates['gram'] = (fetch + max(dx.num_tiles, num_workers) * out_bytes,
+                          flops / 2 if y is None else flops)
+
+  rate = _network_rate()
+  costs = [(net / rate + f / (FLOPS_PER_SEC * num_workers), strategy, net, f)
+           for strategy, (net, f) in candidates.iteritems()]
+  return DotPlan(da, db, costs, num_workers, gram)
+
+
+def explain_dot(a, b):
+  '''Return a description of the strategies considered for ``dot(a, b)``, and the choice.'''
+  return str(plan_dot(a, b))
+
+
 def dot(a, b, tile_hint=None):
   '''
   Compute the dot product (matrix multiplication) of 2 arrays.
 
+  The physical strategy is chosen by `plan_dot`; see `explain_dot`.
+
   :param a: `Expr` or `numpy.ndarray`
   :param b: `Expr` or `numpy.ndarray`
   :rtype: `Expr`
   '''
-  #if isinstance(b, np.ndarray):
-    #return DotExpr(matrix_a=a, matrix_b=b, tile_hint=tile_hint)
+  if isinstance(a, np.ndarray) and isinstance(b, Expr):
+    # every strategy runs over the tiles of ``a``.
+    from .write_array import from_numpy
+    a = from_numpy(a)
 
-  if isinstance(b, np.ndarray):
-    if len(a.shape) == 1 and len(b.shape) == 1:
+  if isinstance(b, np.ndarray) and len(a.shape) == 1:
+    if len(b.shape) == 1:
       shape = (1, )
-    elif len(a.shape) > 1 and len(b.shape) == 1:
-      shape = (a.shape[0], )
     else:
       shape = (a.shape[0], b.shape[1])
     return map.map2(a, axes=[0], fn=dot_map2_np_mapper, fn_kw={'array2': b},
                     shape=shape, reducer=np.add)
+
+  if len(a.shape) == 1 and len(b.shape) == 1:
+    if a.shape[0] != b.shape[0]:
+      raise ValueError("objects are not aligned")
+    return map.map2((a, b), fn=dot_map2_vec_mapper, shape=(1, ), reducer=np.add)
+  elif len(a.shape) > 1 and len(b.shape) == 1:
+    if a.shape[1] != b.shape[0]:
+      raise ValueError("objects are not aligned")
+    shape = (a.shape[0], )
+  elif len(a.shape) > 1 and len(b.shape) > 1:
+    if tile_hint is None and not isinstance(b, np.ndarray):
+      tile_hint = (a.shape[0], b.shape[1])
+    shape = (a.shape[0], b.shape[1])
   else:
-    if len(a.shape) == 1 and len(b.shape) == 1:
-      if a.shape[0] != b.shape[0]:
-        raise ValueError("objects are not aligned")
-      return map.map2((a, b), fn=dot_map2_vec_mapper, shape=(1, ), reducer=np.add)
-    elif len(a.shape) > 1 and len(b.shape) == 1:
-      if a.shape[1] != b.shape[0]:
-        raise ValueError("objects are not aligned")
-      shape = (a.shape[0], )
-    elif len(a.shape) > 1 and len(b.shape) > 1:
-      if tile_hint is None:
-        tile_hint = (a.shape[0], b.shape[1])
-      shape = (a.shape[0], b.shape[1])
-    else:
-      raise ValueError
+    raise ValueError
+
+  plan = plan_dot(a, b)
+  util.log_debug('%s', plan)
+  if plan.strategy == 'gram':
+    x, y, axis = plan.gram
+    return GramExpr(matrix_a=x, matrix_b=y, axis=axis, tile_hint=tile_hint)
+  if plan.strategy == 'broadcast':
+    return map.map2(a, axes=[0], fn=dot_map2_np_mapper, fn_kw={'array2': b},
+                    shape=shape, reducer=np.add)
+  if plan.strategy == 'outer':
+    return outer.outer((a, b), (0, 1), dot_outer_mapper, shape=shape,
+                       tile_hint=tile_hint, reducer=np.add)
+  if plan.strategy == 'rows':
+    return DotExpr(matrix_a=a, matrix_b=b, tile_hint=tile_hint)
+  return map.map2((a, b), (1, 0), dot_map2_mapper, shape=shape,
+                  tile_hint=tile_hint, reducer=np.add)
 
-    if a.shape[0] > a.shape[1]:
-      # Use outer(join) to implement dot
-      util.log_warn('Using outer to do dot')
-      return outer.outer((a, b), (0, 1), dot_outer_mapper, shape=shape,
-                         tile_hint=tile_hint, reducer=np.add)
-    else:
-      # Use map2(join) to implement dot
-      util.log_warn('Using map2 to do dot')
-      return map.map2((a, b), (1, 0), dot_map2_mapper, shape=shape,
-                      tile_hint=tile_hint, reducer=np.add)
+
+def gram(a, b=None, axis=0, tile_hint=None):
+  '''
+  Compute ``dot(transpose(a), b)`` (``axis=0``) or ``dot(a, transpose(b))``
+  (``axis=1``) without transposing either array.
+
+  Only the output is sent over the network, which makes this much cheaper
+  than `dot` for tall-skinny (``axis=0``) or short-fat (``axis=1``) arrays.
+  `dot` uses this automatically where the cost model prefers it.
+
+  :param a: `Expr` (2 dimensional)
+  :param b: `Expr` (2 dimensional); defaults to ``a``.
+  :param axis: The axis summed over.
+  :rtype: `Expr`
+  '''
+  a = lazify(a)
+  b = a if b is None else lazify(b)
+  if len(a.shape) != 2 or len(b.shape) != 2:
+    raise ValueError('gram expects 2 dimensional arrays')
+  if axis not in (0, 1):
+    raise ValueError('axis must be 0 or 1, got %s' % axis)
+  if a.shape[axis] != b.shape[axis]:
+    raise ValueError("objects are not aligned")
+  return GramExpr(matrix_a=a, matrix_b=None if b is a else b, axis=axis, tile_hint=tile_hint)
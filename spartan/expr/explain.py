@@ -0,0 +1,184 @@
+'''
+Reports on how an expression is optimized and evaluated.
+
+`explain` optimizes an expression and describes each node of the
+resulting plan: its shape and tiling, and the optimizer passes which
+created or rewrote it.  With ``analyze=True`` the plan is also evaluated,
+and each node reports:
+
+* the wall time of its evaluation,
+* the number of kernels and tiles it ran, and its slowest tile,
+* the bytes its tiles fetched from, and wrote (via updates) to, the cluster,
+* whether its value came from the evaluation cache.
+
+Kernels are waited for while analyzing (see `BlobCtx.collect_kernel_stats`),
+so pipelined plans may run slower than usual.
+
+The report prints as text, and `ExplainReport.to_json` returns it as JSON.
+'''
+
+import json
+import time
+
+from . import optimize, scheduler
+from .base import Expr, CollectionExpr, eval_cache
+
+
+def _fmt_bytes(nbytes):
+  return '%.3gB' % nbytes
+
+
+def _inputs(node):
+  '''Return the ids of the expressions ``node`` reads, looking through collections.'''
+  ids = []
+  stack = [node]
+  while stack:
+    deps = [v for v in stack.pop().dependencies().itervalues() if isinstance(v, Expr)]
+    for d in deps:
+      if isinstance(d, CollectionExpr):
+        stack.append(d)
+      elif d.expr_id not in ids:
+        ids.append(d.expr_id)
+  return ids
+
+
+def _label(node):
+  op = getattr(node, 'op', None)
+  fn_name = getattr(op, 'fn_name', None)
+  if callable(fn_name):
+    try:
+      return '%s(%s)' % (node.typename(), fn_name())
+    except Exception:
+      pass
+  return node.typename()
+
+
+def _shape(node):
+  shape = node.static_shape()
+  return tuple(shape) if shape is not None else None
+
+
+def _describe(node, rewrites):
+  tile_hint = getattr(node, 'tile_hint', None)
+  return {
+    'id': node.expr_id,
+    'type': _label(node),
+    'inputs': _inputs(node),
+    'shape': _shape(node),
+    'tile_hint': list(tile_hint) if tile_hint is not None else None,
+    'passes': rewrites.get(node.expr_id, []),
+  }
+
+
+def _analyze(report, profile):
+  '''Fill in the evaluation stats of ``report`` from a `scheduler.profile_nodes` record.'''
+  stats = profile.get(report['id'])
+  report['evaluated'] = stats is not None
+  if stats is None:
+    return
+
+  tiles = [t for k in stats['kernels'] for t in k['tile_stats']]
+  report['seconds'] = stats['seconds']
+  report['kernels'] = len(stats['kernels'])
+  report['tiles'] = sum(k['tiles'] for k in stats['kernels'])
+  report['bytes_fetched'] = sum(t[2] for t in tiles)
+  report['bytes_updated'] = sum(t[3] for t in tiles)
+  report['slowest_tile'] = None
+  if tiles:
+    tile, seconds = max(tiles, key=lambda t: t[1])[:2]
+    if isinstance(tile, tuple):
+      # part of a split tile: (tile id, extent).
+      tile = tile[0]
+    report['slowest_tile'] = {'tile': str(tile), 'seconds': seconds}
+
+
+class ExplainReport(object):
+  '''
+  The result of `explain`.
+
+  :ivar nodes: a dict per node of the plan, dependencies first.
+  :ivar seconds: total wall time of the evaluation, or None if the plan
+    was not evaluated.
+  '''
+  def __init__(self, nodes, seconds=None):
+    self.nodes = nodes
+    self.seconds = seconds
+
+  def to_dict(self):
+    return {'seconds': self.seconds, 'nodes': self.nodes}
+
+  def to_json(self, **kw):
+    '''Return the report as a JSON string; ``kw`` is passed to `json.dumps`.'''
+    return json.dumps(self.to_dict(), **kw)
+
+  def _node_lines(self, n):
+    desc = '%s[%d]' % (n['type'], n['id'])
+    if n['shape'] is not None:
+      desc += ' shape=%s' % (n['shape'],)
+    if n['tile_hint'] is not None:
+      desc += ' tile_hint=%s' % (n['tile_hint'],)
+    if n['inputs']:
+      desc += ' inputs=%s' % (n['inputs'],)
+    if n['passes']:
+      desc += ' passes=%s' % ','.join(n['passes'])
+    lines = [desc]
+
+    if 'cached' not in n:
+      return lines
+    if n['cached']:
+      lines.append('  cached')
+    elif not n['evaluated']:
+      lines.append('  not evaluated')
+    else:
+      stats = '  time=%.3gs kernels=%d tiles=%d fetched=%s updated=%s' % (
+        n['seconds'], n['kernels'], n['tiles'],
+        _fmt_bytes(n['bytes_fetched']), _fmt_bytes(n['bytes_updated']))
+      if n['slowest_tile'] is not None:
+        stats += ' slowest=%.3gs(%s)' % (n['slowest_tile']['seconds'], n['slowest_tile']['tile'])
+      lines.append(stats)
+    return lines
+
+  def __str__(self):
+    lines = ['explain: %d nodes' % len(self.nodes)]
+    if self.seconds is not None:
+      lines[0] += ', %.3gs' % self.seconds
+    for n in self.nodes:
+      lines.extend(self._node_lines(n))
+    return '\n'.join(lines)
+
+
+def explain(expr, analyze=False):
+  '''
+  Describe the optimized plan of ``expr``.
+
+  :param expr: `Expr`
+  :param analyze: If True, evaluate the plan and report the cost of each node.
+  :rtype: `ExplainReport`
+  '''
+  if not isinstance(expr, Expr):
+    raise TypeError('explain expects an Expr, got %s' % type(expr))
+
+  rewrites = {}
+  plan = optimize.optimize(expr, rewrites=rewrites)
+  nodes = optimize.dag_nodes(plan)
+  reports = [_describe(node, rewrites) for node in nodes]
+  if not analyze:
+    return ExplainReport(reports)
+
+  for report in reports:
+    # cached values are either found at evaluation, or inlined by the optimizer.
+    report['cached'] = (eval_cache.get(report['id']) is not None or
+                        optimize.CollapsedCachedExpressions.name in report['passes'])
+
+  profile = {}
+  previous = scheduler.profile_nodes(profile)
+  start = time.time()
+  try:
+    plan.evaluate()
+  finally:
+    scheduler.profile_nodes(previous)
+  seconds = time.time() - start
+
+  for report in reports:
+    _analyze(report, profile)
+  return ExplainReport(reports, seconds)
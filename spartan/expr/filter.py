@@ -30,13 +30,19 @@ class FilterExpr(Expr):
     assert not isinstance(self.idx, TupleExpr)
 
   def compute_shape(self):
-    if isinstance(self.idx, (int, slice, tuple)):
-      src_shape = self.src.compute_shape()
+    src_shape = self.src.shape
+    if isinstance(self.idx, (int, long, slice, tuple)):
       ex = extent.from_shape(src_shape)
       slice_ex = extent.compute_slice(ex, self.idx)
       return slice_ex.shape
-    else:
-      raise base.NotShapeable
+
+    # May raise NotShapeable.  A boolean mask (which has the shape of
+    # ``src``) masks entries in place; an integer index is 1-d, and
+    # selects rows.  For a 1-d ``src`` both give the shape of the index.
+    idx_shape = tuple(self.idx.shape)
+    if len(idx_shape) > 1:
+      return tuple(src_shape)
+    return idx_shape[:1] + tuple(src_shape[1:])
 
   def _evaluate(self, ctx, deps):
     src = deps['src']
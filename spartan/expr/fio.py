@@ -27,6 +27,7 @@ These include --
 
 import ast
 import os
+import re
 from struct import unpack, pack
 import sys
 
@@ -38,6 +39,7 @@ from spartan import util
 
 from .. import blob_ctx
 from ..array import distarray
+from ..array import extent
 from ..array import tile
 from ..util import Assert
 from .base import force
@@ -46,7 +48,7 @@ from .map import map
 from ..core import LocalKernelResult
 from .ndarray import ndarray
 from .reduce import reduce
-from .shuffle import shuffle
+from .shuffle import shuffle, tile_loader
 
 
 def save_filename(**kw):
@@ -156,9 +158,10 @@ def save(array, prefix, path = '.', iszip = False):
 
   return True if ret == 1 else False
 
-def _load_mapper(array, ex, prefix = None, path = None, sparse = None, dtype = None, iszip = None):
+def _read_tile(ul, lr, path, prefix, sparse, dtype, iszip):
+  '''Read the tile saved for the extent [ul, lr).'''
   kw = {'path' : path, 'prefix' : prefix, 'suffix' : '',
-        'ul' : ex.ul, 'lr' : ex.lr, 'ispickle' : False, 'isnp' : False}
+        'ul' : ul, 'lr' : lr, 'ispickle' : False, 'isnp' : False}
   if iszip:
     kw['iszip'] = True
     fn = save_filename(**kw)
@@ -180,15 +183,72 @@ def _load_mapper(array, ex, prefix = None, path = None, sparse = None, dtype = N
     fp.close()
     kw['isnp'] = True
     a = np.load(save_filename(**kw) + '.npz')
-    return [(ex, sp.coo_matrix((a['data'], (a['row'], a['col'])), a['shape']))]
+    return sp.coo_matrix((a['data'], (a['row'], a['col'])), a['shape'])
   else:
     if iszip:
       data = np.frombuffer(fp.read(), dtype=dtype)
     else:
       data = np.fromfile(fp, dtype=dtype)
-    data.shape = ex.shape
+    data.shape = tuple(l - u for u, l in zip(ul, lr))
     fp.close()
-    return [(ex, data)]
+    return data
+
+def _saved_extents(path, prefix, shape):
+  '''Return the extents of the tiles saved under ``prefix``.'''
+  pattern = re.compile(r'^%s_(\(.*?\))_(\(.*?\))_spf(bz2)?$' % re.escape(prefix))
+  extents = []
+  for name in os.listdir(path + "/" + prefix):
+    match = pattern.match(name)
+    if match is not None:
+      extents.append(extent.create(ast.literal_eval(match.group(1)),
+                                   ast.literal_eval(match.group(2)), shape))
+  return extents
+
+def _read_region(region, path, prefix, sparse, dtype, iszip):
+  '''Assemble ``region`` from the saved tiles overlapping it.'''
+  if sparse:
+    rows, cols, values = [], [], []
+  else:
+    data = np.empty(region.shape, dtype=dtype)
+  for saved, overlap in extent.find_overlapping(
+      _saved_extents(path, prefix, region.array_shape), region):
+    if 0 in overlap.shape:
+      continue
+    tile_data = _read_tile(saved.ul, saved.lr, path, prefix, sparse, dtype, iszip)
+    src = extent.offset_slice(saved, overlap)
+    if sparse:
+      piece = tile_data.tocsr()[src].tocoo()
+      rows.append(piece.row + overlap.ul[0] - region.ul[0])
+      cols.append(piece.col + overlap.ul[1] - region.ul[1])
+      values.append(piece.data)
+    else:
+      data[extent.offset_slice(region, overlap)] = tile_data[src]
+  if sparse:
+    return sp.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                         shape=region.shape, dtype=dtype)
+  return data
+
+@tile_loader
+def _load_mapper(array, ex, prefix = None, path = None, sparse = None, dtype = None, iszip = None,
+                 offset = None, shape = None):
+  '''
+  Load the extent ``ex`` of the array saved as ``prefix``.
+
+  Extents which were not saved as a tile (e.g. for `partial_load`) are
+  assembled from the saved tiles overlapping them.  With ``offset``, ``ex``
+  is an extent of the slice starting at ``offset`` of the saved array of
+  ``shape`` (see `SlicePushdown`).
+  '''
+  region = ex
+  if offset is not None:
+    region = extent.create(tuple(u + o for u, o in zip(ex.ul, offset)),
+                           tuple(l + o for l, o in zip(ex.lr, offset)), tuple(shape))
+
+  kw = {'path' : path, 'prefix' : prefix, 'suffix' : '', 'ul' : region.ul, 'lr' : region.lr,
+        'ispickle' : False, 'isnp' : False, 'iszip' : bool(iszip)}
+  if os.path.exists(save_filename(**kw)):
+    return [(ex, _read_tile(region.ul, region.lr, path, prefix, sparse, dtype, iszip))]
+  return [(ex, _read_region(region, path, prefix, sparse, dtype, iszip))]
 
 def _load(path, prefix, iszip):
   fn = path + "/" + prefix + "/" + prefix + "_dist.spf"
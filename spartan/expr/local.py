@@ -69,6 +69,29 @@ class LocalInput(LocalExpr):
     return [self.idx]
 
 
+class LocalConst(LocalExpr):
+  '''
+  A constant inlined into a local expression (see `ConstantFolding`).
+
+  Scalars are used as is.  Arrays are broadcast against the tile being
+  computed: the part covering the tile's extent is taken.
+  '''
+  val = PythonValue
+
+  def pretty_str(self):
+    if np.ndim(self.val) == 0:
+      return repr(self.val)
+    return 'const%s' % (self.val.shape,)
+
+  def evaluate(self, ctx):
+    if np.ndim(self.val) == 0:
+      return self.val
+    ex = ctx.inputs['extent']
+    offset = len(ex.ul) - self.val.ndim
+    return self.val[tuple(slice(None) if dim == 1 else slice(ex.ul[offset + i], ex.lr[offset + i])
+                          for i, dim in enumerate(self.val.shape))]
+
+
 class FnCallExpr(LocalExpr):
   '''Evaluate a function call.
 
@@ -144,6 +167,21 @@ class LocalMapLocationExpr(LocalMapExpr):
 class LocalReduceExpr(FnCallExpr):
   _op_type = 'reduce'
 
+def is_elementwise(op):
+  '''
+  True if ``op`` only applies Numpy ufuncs to its inputs, so the result for
+  a concatenation of inputs is the concatenation of the results.
+  '''
+  if isinstance(op, LocalInput):
+    return op.idx not in ('extent', 'axis')
+  if isinstance(op, LocalConst):
+    return np.ndim(op.val) == 0
+  if isinstance(op, BlockedExpr):
+    return True
+  if type(op) is LocalMapExpr and isinstance(op.fn, np.ufunc) and not op.kw:
+    return all(is_elementwise(d) for d in op.deps)
+  return False
+
 # track source that we have already compiled via parakeet.
 # parakeet requires the source file remain available in
 # order to compile.
@@ -199,6 +237,154 @@ class ParakeetExpr(LocalExpr):
     else:
       return fn(**kw_args)
 
-from spartan.config import FLAGS, BoolFlag
+
+try:
+  import numexpr
+except ImportError:
+  numexpr = None
+
+# numexpr syntax for the ufuncs it supports.
+_NUMEXPR_OPS = {
+  np.add: '(%s + %s)',
+  np.subtract: '(%s - %s)',
+  np.multiply: '(%s * %s)',
+  np.divide: '(%s / %s)',
+  np.true_divide: '(%s / %s)',
+  np.power: '(%s ** %s)',
+  np.negative: '(-%s)',
+  np.sqrt: 'sqrt(%s)',
+  np.exp: 'exp(%s)',
+  np.log: 'log(%s)',
+  np.sin: 'sin(%s)',
+  np.cos: 'cos(%s)',
+  np.tanh: 'tanh(%s)',
+  np.abs: 'abs(%s)',
+}
+
+
+def _numexpr_source(op, consts):
+  '''
+  Return ``op`` as a numexpr expression, or None if numexpr can't evaluate it.
+
+  Constants are added to ``consts``, by the name they are referred to.
+  '''
+  if isinstance(op, LocalInput):
+    return op.idx
+  if isinstance(op, LocalConst):
+    name = '_const%d' % len(consts)
+    consts[name] = op.val
+    return name
+  if op.fn not in _NUMEXPR_OPS:
+    return None
+  args = [_numexpr_source(d, consts) for d in op.deps]
+  if None in args:
+    return None
+  return _NUMEXPR_OPS[op.fn] % tuple(args)
+
+
+class BlockedExpr(LocalExpr):
+  '''
+  Evaluate an elementwise (see `is_elementwise`) tree of ufuncs in chunks.
+
+  Evaluating ``a + b + c`` node by node allocates a temporary the size of
+  the tile for every operation, and streams every tile through memory
+  once per operation.  Instead, the tree is evaluated over chunks of about
+  ``--local_block_bytes`` per buffer, reusing the same scratch buffers (via
+  the ufunc ``out`` argument) for every chunk, so temporaries stay in cache.
+
+  If numexpr is installed (and ``--use_numexpr`` is set), floating point
+  trees are handed to it instead, which does its own blocking.
+
+  Inputs which are not dense arrays (sparse tiles) or which need
+  broadcasting beyond scalars are evaluated normally.
+  '''
+
+  def pretty_str(self):
+    return 'blocked(%s)' % self.deps[0].pretty_str()
+
+  def fn_name(self):
+    return 'blocked'
+
+  def _inputs(self, ctx):
+    '''Return (shape, inputs) if chunked evaluation applies, else (None, None).'''
+    inputs = dict((name, ctx.inputs[name]) for name in self.input_names())
+    shape = None
+    for v in inputs.itervalues():
+      if not isinstance(v, np.ndarray):
+        if not np.isscalar(v):
+          return None, None
+      elif v.ndim > 0:
+        # arrays must all have the same shape; only scalars are broadcast.
+        if (shape is not None and v.shape != shape) or not v.flags.c_contiguous:
+          return None, None
+        shape = v.shape
+    return shape, inputs
+
+  def _eval_chunk(self, op, inputs, lo, hi, buffers, out):
+    if isinstance(op, LocalInput):
+      v = inputs[op.idx]
+      if isinstance(v, np.ndarray) and v.ndim > 0:
+        return v.reshape(-1)[lo:hi]
+      return v
+    if isinstance(op, LocalConst):
+      return op.val
+    args = [self._eval_chunk(d, inputs, lo, hi, buffers, None) for d in op.deps]
+    if out is None:
+      out = buffers.get(id(op))
+    if out is None:
+      # first chunk: let numpy pick the result type, then keep the buffer.
+      result = op.fn(*args)
+      if isinstance(result, np.ndarray) and result.shape == (hi - lo,):
+        buffers[id(op)] = result
+      else:
+        # a function of scalars only.
+        buffers[id(op)] = False
+      return result
+    if out is False:
+      return op.fn(*args)
+    return op.fn(*args, out=out[:hi - lo])
+
+  def _num_ops(self, op):
+    if isinstance(op, (LocalInput, LocalConst)):
+      return 0
+    return 1 + sum(self._num_ops(d) for d in op.deps)
+
+  def evaluate(self, ctx):
+    op = self.deps[0]
+    shape, inputs = self._inputs(ctx)
+    if shape is None or int(np.prod(shape)) == 0:
+      return op.evaluate(ctx)
+
+    if FLAGS.use_numexpr and numexpr is not None:
+      consts = {}
+      source = _numexpr_source(op, consts)
+      local_dict = dict(inputs, **consts)
+      if source is not None and all(np.asarray(v).dtype.kind == 'f' for v in local_dict.itervalues()):
+        return numexpr.evaluate(source, local_dict=local_dict)
+
+    size = int(np.prod(shape))
+    # inputs, scratch buffers and the output are touched for each chunk.
+    num_buffers = len(inputs) + self._num_ops(op)
+    itemsize = max(np.asarray(v).dtype.itemsize for v in inputs.itervalues())
+    chunk = max(1024, FLAGS.local_block_bytes / (itemsize * num_buffers))
+
+    buffers = {}
+    first = self._eval_chunk(op, inputs, 0, min(chunk, size), buffers, None)
+    if min(chunk, size) == size:
+      return first.reshape(shape)
+
+    result = np.empty(size, dtype=first.dtype)
+    result[:chunk] = first
+    for lo in range(chunk, size, chunk):
+      hi = min(lo + chunk, size)
+      self._eval_chunk(op, inputs, lo, hi, buffers, result[lo:hi])
+    return result.reshape(shape)
+
+
+from spartan.config import FLAGS, BoolFlag, IntFlag
 FLAGS.add(BoolFlag('use_cuda', default=False))
+FLAGS.add(IntFlag('local_block_bytes', default=256 * 1024,
+                  help='Approximate size of the chunks in which blocked local expressions are evaluated'))
+FLAGS.add(BoolFlag('use_numexpr', default=True,
+                   help='Use numexpr (if installed) to evaluate blocked local expressions'))
 
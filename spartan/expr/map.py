@@ -19,6 +19,7 @@ from traits.api import Instance
 
 from spartan import rpc
 from .. import util, blob_ctx
+from ..config import FLAGS
 from ..array import distarray, tile, extent
 from ..core import LocalKernelResult
 from ..node import indent
@@ -26,7 +27,7 @@ from ..util import Assert
 from .base import ListExpr, TupleExpr, PythonValue, Expr, as_array, NotShapeable
 from .broadcast import Broadcast, broadcast
 from .local import (FnCallExpr, LocalInput, LocalCtx, LocalExpr, LocalMapExpr,
-                    LocalMapLocationExpr, make_var)
+                    LocalMapLocationExpr, make_var, is_elementwise)
 import time
 
 
@@ -45,7 +46,14 @@ def get_local_values(ex, children, child_to_var):
   return local_values
 
 
-def tile_mapper(ex, children, child_to_var, op):
+def _elementwise_kernel(kw):
+  return is_elementwise(kw['op'])
+
+
+@distarray.splittable
+@distarray.side_effect_free
+@distarray.batchable(_elementwise_kernel)
+def tile_mapper(ex, children, child_to_var, op, _batch=None):
   '''
   Run for each tile of a `Map` operation.
 
@@ -55,6 +63,8 @@ def tile_mapper(ex, children, child_to_var, op):
   :param children: Input arrays for this operation.
   :param child_to_var: Map from a child to the varname.
   :param op: `LocalExpr` to evaluate.
+  :param _batch: Optional list of tile extents covered by ``ex``; the result
+    is split back into one tile per extent.
   '''
   local_values = get_local_values(ex, children, child_to_var)
   local_values['extent'] = ex
@@ -73,7 +83,7 @@ def tile_mapper(ex, children, child_to_var, op):
   #util.log_info('Inputs: %s', local_values)
   result = op.evaluate(op_ctx)
 
-  if id(result) == id(local_values[child_to_var[0]]):
+  if id(result) == id(local_values[child_to_var[0]]) and ex in children[0].tiles:
     return LocalKernelResult(result=[(ex, children[0].tiles[ex])])
 
   #util.log_info('Result: %s', result)
@@ -81,6 +91,14 @@ def tile_mapper(ex, children, child_to_var, op):
             'Bad shape -- source = %s, result = %s, op = (%s)',
             local_values, result, op)
 
+  if _batch is not None:
+    ctx = blob_ctx.get()
+    tiles = []
+    for sub_ex in _batch:
+      sub_tile = tile.from_data(result[extent.offset_slice(ex, sub_ex)])
+      tiles.append((sub_ex, ctx.create(sub_tile).wait().tile_id))
+    return LocalKernelResult(result=tiles)
+
   # make a new tile and return it
   result_tile = tile.from_data(result)
   tile_id = blob_ctx.get().create(result_tile).wait().tile_id
@@ -88,6 +106,30 @@ def tile_mapper(ex, children, child_to_var, op):
   return LocalKernelResult(result=[(ex, tile_id)])
 
 
+def pipelined_tile_mapper(ex, children, child_to_var, op, out_tiles):
+  '''
+  Run for each tile of a pipelined `Map` operation (see ``--pipeline_kernels``).
+
+  Like `tile_mapper`, but the result is always stored in the tile
+  reserved for it in ``out_tiles``.
+  '''
+  local_values = get_local_values(ex, children, child_to_var)
+  local_values['extent'] = ex
+  result = op.evaluate(LocalCtx(inputs=local_values))
+
+  if id(result) == id(local_values[child_to_var[0]]):
+    # don't share data with the input tile.
+    result = result.copy()
+
+  Assert.eq(ex.shape, result.shape,
+            'Bad shape -- source = %s, result = %s, op = (%s)',
+            local_values, result, op)
+
+  result_tile = tile.from_data(result)
+  tile_id = blob_ctx.get().create(result_tile, tile_id=out_tiles[ex]).wait().tile_id
+  return LocalKernelResult(result=[(ex, tile_id)])
+
+
 class MapExpr(Expr):
   '''Represents mapping an operator over one or more inputs.
 
@@ -164,9 +206,10 @@ class MapExpr(Expr):
 
     #util.log_info('Mapping %s over %d inputs; largest = %s', op, len(children), largest.shape)
 
-    return largest.map_to_array(tile_mapper, kw={'children': children,
-                                                 'child_to_var': child_to_var,
-                                                 'op': self.op})
+    kw = {'children': children, 'child_to_var': child_to_var, 'op': self.op}
+    if FLAGS.pipeline_kernels and isinstance(largest, distarray.DistArrayImpl):
+      return largest.pipelined_map_to_array(pipelined_tile_mapper, kw=kw)
+    return largest.map_to_array(tile_mapper, kw=kw)
 
 
 def map(inputs, fn, numpy_expr=None, fn_kw=None):
@@ -316,10 +359,12 @@ class Map2Expr(Expr):
     if dtype is None:
       dtype = arrays[0].dtype
 
+    mapper = join_mapper if update_region is None else region_join_mapper
     target = distarray.create(shape, dtype,
                               sharder=None, reducer=reducer,
                               tile_hint=tile_hint,
-                              sparse=(arrays[0].sparse and arrays[1].sparse))
+                              sparse=(arrays[0].sparse and arrays[1].sparse),
+                              kernel_type=mapper.__name__)
 
     if update_region is None:
       arrays[0].foreach_tile(mapper_fn=join_mapper,
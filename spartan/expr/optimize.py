@@ -7,29 +7,43 @@ Optimization passes take as input an expression graph, and return a
 (hopefully) simpler, equivalent graph.  This module defines the
 pass infrastructure, the fusion passes and an optimization pass to
 lower code to Parakeet.
+
+Optimized plans are cached by the structure of the graph (see
+`PlanFingerprint`): iterative programs which rebuild the same expression
+every iteration reuse the plan built for the first iteration, re-bound to
+the new input arrays, instead of re-running the passes.
 '''
-from collections import namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
 import operator
 import math
-from tiling import mincost_tiling
+import types
+from tiling import mincost_layouts
 import weakref
 
-from ..config import FLAGS, BoolFlag
+import numpy as np
+from traits.api import PythonValue
+
+from ..config import FLAGS, BoolFlag, IntFlag
+from ..array import extent
 from ..array.distarray import DistArray
 from . import local
 from .filter import FilterExpr
 from .slice import SliceExpr
-from .local import LocalInput, LocalMapExpr, LocalMapLocationExpr, make_var, ParakeetExpr
+from .local import (LocalInput, LocalConst, LocalMapExpr, LocalMapLocationExpr, make_var,
+                    ParakeetExpr, BlockedExpr, is_elementwise)
 from .reduce import ReduceExpr, LocalReduceExpr
 from ..util import Assert
 
 from .. import util
-from .base import Expr, Val, AsArray, ListExpr, lazify, expr_like, ExprTrace, NotShapeable, CollectionExpr
+from .base import (Expr, Val, AsArray, ListExpr, DictExpr, lazify, expr_like, ExprTrace, NotShapeable,
+                   CollectionExpr)
+from .base import symbolic_shapes, no_truncation, user_held
 from .map import MapExpr
 from .ndarray import NdArrayExpr
-from .shuffle import ShuffleExpr
-from .dot import DotExpr
+from .shuffle import ShuffleExpr, _tile_loaders
+from .dot import DotExpr, GramExpr
 from .write_array import WriteArrayExpr
+from .checkpoint import CheckpointExpr
 
 try:
   import numexpr
@@ -45,6 +59,11 @@ except:
 _parakeet_blacklist = set()
 _tiled_exprlist = {}
 _not_idempotent_list = set()
+# expression ids of not idempotent results; unlike ``_not_idempotent_list``
+# these also match the copies made by optimization.
+_not_idempotent_ids = set()
+# map functions which generate tiles from their shape (see `tile_generator`).
+_generators = set()
 
 
 def disable_parakeet(fn):
@@ -60,19 +79,42 @@ def not_idempotent(fn):
     if isinstance(result, Expr):
       result.needs_cache = True
       _not_idempotent_list.add(id(result))
+      _not_idempotent_ids.add(result.expr_id)
     return result
   return wrapped
 
+
+def is_not_idempotent(expr):
+  '''True if evaluating ``expr`` again may give a different result.'''
+  return id(expr) in _not_idempotent_list or expr.expr_id in _not_idempotent_ids
+
+
+def tile_generator(fn):
+  '''
+  Mark the map function ``fn`` as filling a tile from its shape (and,
+  for `map_with_location`, its location) alone, so that slices of the
+  array it generates are generated directly (see `SlicePushdown`).
+  '''
+  _generators.add(fn)
+  return fn
+
 visited_expr = {'map_fusion': weakref.WeakValueDictionary(),
                 'reduce_fusion': weakref.WeakValueDictionary(),
                 'collapse_cached': weakref.WeakValueDictionary(),
                 'parakeet_gen': weakref.WeakValueDictionary(),
                 'rotate_slice': weakref.WeakValueDictionary(),
-                'auto_tiling': weakref.WeakValueDictionary()
+                'slice_pushdown': weakref.WeakValueDictionary(),
+                'auto_tiling': weakref.WeakValueDictionary(),
+                'blocked_eval': weakref.WeakValueDictionary(),
+                'constant_folding': weakref.WeakValueDictionary(),
                 }
 
 
 class OptimizePass(object):
+  # False for passes which depend on the values of leaves, not only their
+  # class (see `PlanFingerprint`): they are re-run after a cached plan is bound.
+  plan_cached = True
+
   def __init__(self):
     self.visited = visited_expr[self.name]
 
@@ -242,6 +284,99 @@ class CollapsedCachedExpressions(OptimizePass):
       return expr.visit(self)
 
 
+def _structure_key(value, var_names, pinned=None):
+  '''
+  Return a hashable key describing the structure of ``value``.
+
+  Values with equal keys compute the same result.  `Expr` children are
+  identified by id (children are merged before their users), local variable
+  names by their position in ``var_names``, and functions by their code,
+  defaults and closure.  Other values are compared by value if hashable,
+  and by identity otherwise.
+
+  Objects identified by id are appended to ``pinned`` (if given), so that
+  a key which outlives the expression can keep them alive.
+  '''
+  if isinstance(value, Expr):
+    return ('expr', value.expr_id)
+  if isinstance(value, LocalInput):
+    return ('input', var_names.get(value.idx, value.idx))
+  if isinstance(value, basestring) and value in var_names:
+    return ('input', var_names[value])
+  if isinstance(value, local.LocalExpr):
+    return (value.__class__.__name__,) + tuple(
+      (k, _structure_key(getattr(value, k, None), var_names, pinned)) for k in value.members)
+  if isinstance(value, (list, tuple)):
+    return (type(value).__name__,) + tuple(_structure_key(v, var_names, pinned) for v in value)
+  if isinstance(value, dict):
+    return ('dict',) + tuple(sorted((_structure_key(k, var_names, pinned),
+                                     _structure_key(v, var_names, pinned))
+                                    for k, v in value.iteritems()))
+  if isinstance(value, types.FunctionType):
+    closure = tuple(c.cell_contents for c in value.func_closure or ())
+    if pinned is not None:
+      pinned.append(value)
+    return ('function', id(value.func_code),
+            _structure_key(value.func_defaults, var_names, pinned),
+            _structure_key(closure, var_names, pinned))
+  if not isinstance(value, (np.ndarray, DistArray)):
+    try:
+      hash(value)
+      return (type(value).__name__, value)
+    except TypeError:
+      pass
+  if pinned is not None:
+    pinned.append(value)
+  return ('id', id(value))
+
+
+class CommonSubexpressionElimination(OptimizePass):
+  '''Merge structurally identical expressions.
+
+  x = transpose(A); dot(x, B) + dot(x, C) -> evaluate transpose(A) once
+  even if it was written twice.
+
+  Expressions which are not idempotent (e.g. ``rand``), or which create
+  or modify arrays in place, are never merged.
+  '''
+  name = 'cse'
+
+  def __init__(self):
+    # the mapping from structure to expression is only valid within one
+    # pass, so do not share visited expressions between passes.
+    self.visited = {}
+    self.exprs = {}
+
+  def _mergeable(self, expr):
+    if isinstance(expr, (NdArrayExpr, WriteArrayExpr, CheckpointExpr)):
+      return False
+    if isinstance(expr, ShuffleExpr) and expr.target is not None:
+      return False
+    return True
+
+  def visit_default(self, expr):
+    if id(expr) in _not_idempotent_list:
+      # keep the original node, so later passes still recognize it.
+      return expr
+    if not self._mergeable(expr):
+      return expr.visit(self)
+
+    new_expr = expr.visit(self)
+    var_names = {}
+    if hasattr(new_expr, 'child_to_var'):
+      var_names = dict((v, 'v%d' % i) for i, v in enumerate(new_expr.child_to_var))
+
+    key = (new_expr.typename(),) + tuple(
+      (k, _structure_key(getattr(new_expr, k, None), var_names))
+      for k in new_expr.members if k not in ('expr_id', 'stack_trace'))
+
+    if key in self.exprs:
+      util.log_debug('CSE: %s.%d -> %d', expr.typename(), expr.expr_id, self.exprs[key].expr_id)
+      return self.exprs[key]
+    self.exprs[key] = new_expr
+    return new_expr
+
+
 def _find_modules(op):
   '''Find any modules referenced by the given `LocalOp` or its dependencies'''
   modules = set()
@@ -385,6 +520,191 @@ class ParakeetGeneration(OptimizePass):
 #       return expr.visit(self)
 
 
+FLAGS.add(IntFlag('inline_const_bytes', default=4096,
+                  help='Largest array inlined into local operations as a constant'))
+
+
+def _constant(child):
+  '''The value of ``child`` if it can be inlined as a `LocalConst`, else None.'''
+  if not isinstance(child, (Val, AsArray)):
+    return None
+  val = child.val
+  if isinstance(val, (bool, int, long, float, complex, np.number, np.bool_)):
+    # workers see scalars as 0-d arrays: keep their numpy type.
+    return np.asarray(val)[()]
+  if isinstance(val, np.ndarray) and val.nbytes <= FLAGS.inline_const_bytes:
+    return val if val.ndim > 0 else val[()]
+  return None
+
+
+def _broadcast_shape(shapes):
+  ndim = max(len(s) for s in shapes)
+  padded = [(1,) * (ndim - len(s)) + tuple(s) for s in shapes]
+  return tuple(max(dims) for dims in zip(*padded))
+
+
+def _is_constant(op):
+  return isinstance(op, LocalConst)
+
+
+def _inline(op, consts):
+  '''Replace the inputs of ``op`` named in ``consts`` by constants, and fold constant calls.'''
+  if isinstance(op, LocalInput):
+    return LocalConst(val=consts[op.idx]) if op.idx in consts else op
+  if not op.deps:
+    return op
+  deps = [_inline(d, consts) for d in op.deps]
+  if (type(op) is LocalMapExpr and isinstance(op.fn, np.ufunc) and not op.kw and
+      all(_is_constant(d) for d in deps)):
+    # numpy's type rules apply as they would have on the workers.
+    return LocalConst(val=op.fn(*[d.val for d in deps]))
+  if all(new is old for new, old in zip(deps, op.deps)):
+    return op
+  if isinstance(op, local.FnCallExpr):
+    return op.__class__(fn=op.fn, kw=op.kw, pretty_fn=op.pretty_fn, deps=deps)
+  return op.__class__(deps=deps)
+
+
+def _split_constants(children, child_to_var, keep_first):
+  '''
+  Return the children and variables which are not inlined, and a dict from
+  variable to the constants which are.
+
+  Array constants are only inlined if they do not broadcast the result to
+  a larger shape.
+  '''
+  values = [_constant(c) for c in children]
+  if keep_first:
+    values[0] = None
+  kept = [i for i, v in enumerate(values) if v is None]
+  if not kept:
+    return children, child_to_var, {}
+
+  try:
+    shapes = [children[i].shape for i in kept]
+  except NotShapeable:
+    shapes = None
+
+  consts = {}
+  for i, v in enumerate(values):
+    if v is None:
+      continue
+    if np.ndim(v) > 0 and (shapes is None or
+                           _broadcast_shape(shapes + [v.shape]) != _broadcast_shape(shapes)):
+      kept.append(i)
+      continue
+    consts[child_to_var[i]] = v
+  kept.sort()
+  return [children[i] for i in kept], [child_to_var[i] for i in kept], consts
+
+
+class ConstantFolding(OptimizePass):
+  '''
+  Inline scalars and small arrays into the local operation of maps and
+  reductions, and evaluate operations on constants once.
+
+  ``1 + x`` is a map over ``(AsArray(1), x)``: the scalar is otherwise
+  broadcast, and fetched for every tile like an array input.  Inlined, it
+  is a `LocalConst` of the map function.  Ufuncs whose inputs are all
+  constants are evaluated here with numpy's type rules, so the result
+  has the dtype it would have had on the workers (e.g.
+  ``dtype(10) * dtype(m / 10)`` stays ``dtype``).
+
+  Arrays up to ``--inline_const_bytes`` are inlined if they do not change
+  the shape of the result.  The constants are values of the graph, not
+  part of its structure, so this pass runs after cached plans are bound.
+  '''
+  name = 'constant_folding'
+  plan_cached = False
+  after = [MapMapFusion, ReduceMapFusion]
+
+  def _fold(self, expr, keep_first):
+    children = self.visit(expr.children)
+    if isinstance(expr.op, ParakeetExpr):
+      return None
+    new_children, child_to_var, consts = _split_constants(
+        children.vals, expr.child_to_var, keep_first)
+    if not consts:
+      return None
+    return ListExpr(vals=new_children), child_to_var, _inline(expr.op, consts)
+
+  def visit_MapExpr(self, expr):
+    folded = self._fold(expr, False)
+    if folded is None or id(expr) in _not_idempotent_list:
+      return expr.visit(self)
+    children, child_to_var, op = folded
+    return expr_like(expr, children=children, child_to_var=child_to_var, op=op)
+
+  def visit_ReduceExpr(self, expr):
+    # the dtype of a reduction is taken from its first input.
+    folded = self._fold(expr, True)
+    if folded is None:
+      return expr.visit(self)
+    children, child_to_var, op = folded
+    return expr_like(expr,
+                     children=children,
+                     child_to_var=child_to_var,
+                     axis=expr.axis,
+                     dtype_fn=expr.dtype_fn,
+                     accumulate_fn=expr.accumulate_fn,
+                     op=op,
+                     tile_hint=expr.tile_hint)
+
+
+def _count_calls(op):
+  if not isinstance(op, local.FnCallExpr):
+    return 0
+  return 1 + sum(_count_calls(d) for d in op.deps)
+
+
+def _block(op):
+  '''Wrap the elementwise subtrees of ``op`` with more than one call in a `BlockedExpr`.'''
+  if isinstance(op, (LocalInput, LocalConst, BlockedExpr, ParakeetExpr)):
+    return op
+  if is_elementwise(op):
+    if _count_calls(op) > 1:
+      return BlockedExpr(deps=[op])
+    return op
+  deps = [_block(d) for d in op.deps]
+  if all(new is old for new, old in zip(deps, op.deps)):
+    return op
+  return op.__class__(fn=op.fn, kw=op.kw, pretty_fn=op.pretty_fn, deps=deps)
+
+
+class BlockedEvaluation(OptimizePass):
+  '''
+  Evaluate fused elementwise operations in cache-sized chunks (see
+  `BlockedExpr`), instead of allocating a temporary tile per operation.
+  '''
+  name = 'blocked_eval'
+  plan_cached = False
+  after = [MapMapFusion, ReduceMapFusion, ConstantFolding]
+
+  def visit_MapExpr(self, expr):
+    op = _block(expr.op)
+    if op is expr.op:
+      return expr.visit(self)
+    blocked = expr_like(expr,
+                        op=op,
+                        children=self.visit(expr.children),
+                        child_to_var=expr.child_to_var)
+    if id(expr) in _not_idempotent_list: _not_idempotent_list.add(id(blocked))
+    return blocked
+
+  def visit_ReduceExpr(self, expr):
+    op = _block(expr.op)
+    if op is expr.op:
+      return expr.visit(self)
+    return expr_like(expr,
+                     children=self.visit(expr.children),
+                     child_to_var=expr.child_to_var,
+                     axis=expr.axis,
+                     dtype_fn=expr.dtype_fn,
+                     accumulate_fn=expr.accumulate_fn,
+                     op=op,
+                     tile_hint=expr.tile_hint)
+
+
 class RotateSlice(OptimizePass):
   '''
   This pass rotates slice operations to the bottom of the expression graph.
@@ -451,13 +771,250 @@ class RotateSlice(OptimizePass):
                        trace=map_expr.stack_trace)
 
 
+def _slice_region(slice_expr, src):
+  '''
+  Return the extent of ``src`` selected by ``slice_expr``, or None if it is
+  not a plain (unit step, no broadcast) slice of an array of known shape.
+  '''
+  if slice_expr.broadcast_to is not None:
+    return None
+  idx = slice_expr.idx
+  for i in idx if isinstance(idx, tuple) else (idx,):
+    if isinstance(i, slice):
+      if i.step not in (None, 1):
+        return None
+    elif not isinstance(i, (int, long)) or i < 0:
+      return None
+
+  try:
+    shape = src.shape
+  except NotShapeable:
+    return None
+  region = extent.compute_slice(extent.from_shape(shape), idx)
+  if region is None or 0 in region.shape:
+    return None
+  return region
+
+
+def _sliced_ndarray(array, region, **kw):
+  tile_hint = array.tile_hint
+  if tile_hint is not None:
+    tile_hint = tuple(min(h, s) for h, s in zip(tile_hint, region.shape))
+  return NdArrayExpr(_shape=region.shape,
+                     dtype=array.dtype,
+                     sparse=array.sparse,
+                     reduce_fn=array.reduce_fn,
+                     tile_hint=tile_hint,
+                     **kw)
+
+
+@disable_parakeet
+def _offset_location(tile, ex, _fn=None, _offset=None, _shape=None, **kw):
+  '''Call the location mapper ``_fn`` for the extent ``ex`` of a slice at ``_offset``.'''
+  ul, lr, _ = ex
+  ul = tuple(u + o for u, o in zip(ul, _offset))
+  lr = tuple(l + o for l, o in zip(lr, _offset))
+  return _fn(tile, (ul, lr, _shape), **kw)
+
+
+class SlicePushdown(OptimizePass):
+  '''
+  Push slices into the expressions which generate or load their source,
+  so that only the selected region is created:
+
+    ndarray(shape)[s]   -> ndarray(shape of s)
+    ones(shape)[s]      -> ones(shape of s), likewise for zeros, arange, rand...
+    load(prefix)[s]     -> load of the saved tiles overlapping s
+
+  Generators are marked with `tile_generator`, and loaders with
+  `shuffle.tile_loader`.
+  Random arrays are generated whole, as a slice generated alone would not
+  match the rest of the array.  Uninitialized arrays are only sliced if the
+  slice is the only expression using them.
+  '''
+  name = 'slice_pushdown'
+
+  def visit_SliceExpr(self, expr):
+    src = self.visit(expr.src)
+    region = _slice_region(expr, src)
+    if region is None:
+      return expr.visit(self)
+
+    new_expr = None
+    if isinstance(src, NdArrayExpr):
+      if expr.private_src:
+        new_expr = _sliced_ndarray(src, region, expr_id=expr.expr_id,
+                                   stack_trace=expr.stack_trace)
+    elif isinstance(src, MapExpr):
+      new_expr = self._slice_generator(expr, src, region)
+    elif isinstance(src, ShuffleExpr):
+      new_expr = self._slice_loader(expr, src, region)
+
+    if new_expr is None:
+      return expr.visit(self)
+    util.log_debug('Pushed slice %s into %s', expr.expr_id, src.typename())
+    return new_expr
+
+  def _slice_generator(self, expr, src, region):
+    op = src.op
+    if (type(op) not in (LocalMapExpr, LocalMapLocationExpr) or op.fn not in _generators or
+        len(src.children) != 1 or not isinstance(src.children[0], NdArrayExpr) or
+        not all(isinstance(d, LocalInput) for d in op.deps)):
+      return None
+
+    if isinstance(op, LocalMapLocationExpr):
+      kw = dict(op.kw or {})
+      kw.update(_fn=op.fn, _offset=region.ul, _shape=src.children[0].shape)
+      op = LocalMapLocationExpr(fn=_offset_location, kw=kw, pretty_fn=op.pretty_fn,
+                                deps=list(op.deps))
+
+    return MapExpr(expr_id=expr.expr_id,
+                   stack_trace=expr.stack_trace,
+                   children=ListExpr(vals=[_sliced_ndarray(src.children[0], region)]),
+                   child_to_var=list(src.child_to_var),
+                   op=op)
+
+  def _slice_loader(self, expr, src, region):
+    if (src.map_fn not in _tile_loaders or src.target is not None or
+        not isinstance(src.array, NdArrayExpr) or not isinstance(src.fn_kw, DictExpr)):
+      return None
+    kw = dict(src.fn_kw.vals)
+    if kw.get('offset') is not None:
+      # already a slice: offsets are relative to the saved array.
+      kw['offset'] = tuple(a + b for a, b in zip(kw['offset'], region.ul))
+    else:
+      kw['offset'] = region.ul
+      kw['shape'] = src.array.shape
+    return ShuffleExpr(expr_id=expr.expr_id,
+                       stack_trace=expr.stack_trace,
+                       array=_sliced_ndarray(src.array, region),
+                       map_fn=src.map_fn,
+                       cost_hint={},
+                       shape_hint=region.shape,
+                       fn_kw=DictExpr(vals=kw))
+
+
+# Layouts are the tuple of axes an array is split along.
+ROWS = (0,)
+COLS = (1,)
+BLOCKS = (0, 1)
+REPLICATED = ()
+
+# Cost of an impossible layout combination.
+_INFEASIBLE = 10 ** 15
+
+
+def _size(shape):
+  return reduce(operator.mul, shape, 1)
+
+
+def _block_grid(num_workers):
+  '''Return the (rows, cols) grid of workers for block layouts, or None if it is 1-D.'''
+  rows = int(math.sqrt(num_workers))
+  while rows > 1 and num_workers % rows:
+    rows -= 1
+  if rows <= 1:
+    return None
+  return rows, num_workers / rows
+
+
+def _candidate_layouts(shape, num_workers):
+  '''The layouts considered for a new array of ``shape``.'''
+  layouts = [(axis,) for axis in range(min(len(shape), 2)) if shape[axis] > 1]
+  if len(shape) >= 2 and shape[0] > 1 and shape[1] > 1 and _block_grid(num_workers):
+    layouts.append(BLOCKS)
+  layouts.append(REPLICATED)
+  return layouts
+
+
+def _array_layout(array):
+  '''The layout of an existing array, or None if it cannot be determined.'''
+  if not hasattr(array, 'tile_shape') or len(array.shape) == 0:
+    return None
+  tile_shape = array.tile_shape()
+  return tuple(axis for axis in range(min(len(array.shape), 2))
+               if tile_shape[axis] < array.shape[axis])
+
+
+def _tile_hint(shape, layout, num_workers):
+  tile_hint = list(shape)
+  if layout == BLOCKS:
+    rows, cols = _block_grid(num_workers) or (num_workers, 1)
+    tile_hint[0] = int(math.ceil(float(shape[0]) / rows))
+    tile_hint[1] = int(math.ceil(float(shape[1]) / cols))
+  else:
+    for axis in layout:
+      tile_hint[axis] = int(math.ceil(float(shape[axis]) / num_workers))
+  return tile_hint
+
+
+def _serial_cost(shape, layout, num_workers):
+  '''Penalty for keeping a whole array in one tile: one worker does all its work.'''
+  if layout != REPLICATED or num_workers <= 1:
+    return 0
+  return _size(shape) * (num_workers - 1) / num_workers
+
+
+def _move_cost(size):
+  '''Cost function for an input which is moved whenever its layout differs.'''
+  return lambda src, dst: 0 if src == dst else size
+
+
+def _forced(src, dst):
+  return 0 if src == dst else _INFEASIBLE
+
+
+def _transposed(layout, ndim):
+  return tuple(sorted(ndim - 1 - axis for axis in layout))
+
+
+def _dot_result_cost(shape, layout, num_workers):
+  '''Cost of a dot result layout: a replicated result sums the partial products of all workers.'''
+  cost = _serial_cost(shape, layout, num_workers)
+  if layout == REPLICATED:
+    cost += _size(shape) * (num_workers - 1)
+  return cost
+
+
+def _dot_costs(size, num_workers, aligned, contracted):
+  '''
+  Cost function for one operand of a dot, as a function of (operand layout,
+  result layout).  ``aligned`` is the operand layout which needs no
+  communication for a result split the same way (rows of A, columns of B),
+  ``contracted`` the one splitting the summed axis.
+  '''
+  grid = _block_grid(num_workers) or (1, num_workers)
+  # the number of result blocks which need each part of the operand.
+  copies = grid[1] if aligned == ROWS else grid[0]
+
+  def cost(src, dst):
+    if dst == aligned:
+      return 0 if src == aligned else size
+    if dst == BLOCKS:
+      return size * (copies - 1) if src in (aligned, BLOCKS) else size * copies
+    if dst == REPLICATED:
+      # partial products are computed where the operands are, and summed.
+      return 0 if src == contracted else size
+    # every worker needs all of the operand.
+    return size * (num_workers - 1)
+  return cost
+
+
 class AutomaticTiling(OptimizePass):
   '''
   Automatically partition all the arrays.
-  We build a min cost max flow DAG for the expr graph, where the cost is the communication cost
-  through network. We estimate the cost according to the behavior of each expr. For _builtin_ expr
-  and simple map and reduce expr, we can easily estimate the cost. However, for the user defined shuffle
-  expr, we can only guess the cost or let users define the cost for us.
+
+  Every array in the expression graph becomes a variable with a set of
+  candidate layouts: split along rows, columns, in 2-D blocks over a grid of
+  workers, or kept whole in one tile (replicated to its readers).  Arrays
+  which already exist have their current layout.  Edges between an input
+  and its user carry the communication cost (in elements moved) of each
+  pair of layouts; `tiling.mincost_layouts` chooses the layouts with the
+  lowest total cost, and the result is applied as tile hints.
+
+  For _builtin_ exprs and simple maps and reductions we can estimate the
+  cost; for user defined shuffles we can only guess, or use the
+  ``cost_hint`` given by the user.
 
   All Exprs:
     [Val, AsArray, DistArray]: Already partitioned array
@@ -467,7 +1024,7 @@ class AutomaticTiling(OptimizePass):
     [MapExpr]: self.children
     [ReduceExpr]: self.children
     [ShuffleExpr]: self.array, self.fn_kw
-    [DotExpr]: self.matrix_a, self.matrix_b
+    [DotExpr, GramExpr]: self.matrix_a, self.matrix_b
 
     [SliceExpr, FilterExpr, CheckpointExpr, TileOpExpr]: self.src or self.array
     [WriteArrayExpr]: self.array, self.data
@@ -476,356 +1033,256 @@ class AutomaticTiling(OptimizePass):
   '''
 
   name = 'auto_tiling'
-  node_type = namedtuple('node_type', ['expr', 'tiling', 'children', 'parents'])
-  inited = False
-
-  def init(self, expr):
-    self.cur_node_id = 1
-    self.edges = {}
-    self.nodes = {0: self.node_type([], -1, [], [])}
-    self.expr_to_nodes = {}
-    self.split_nodes = {}
-    self.init_expr = id(expr)
-    self.inited = True
-
-  def add_edge(self, edge_from, edge_to, edge_cost=0):
-    #util.log_warn('add_edge:%d %d cost:%d', edge_from, edge_to, edge_cost)
-    if (edge_from, edge_to) not in self.edges:
-      self.nodes[edge_from].parents.append(edge_to)
-      self.nodes[edge_to].children.append(edge_from)
-    self.edges[(edge_from, edge_to)] = edge_cost
-
-  def remove_edge(self, edge_from, edge_to):
-    del self.edges[(edge_from, edge_to)]
-    self.nodes[edge_from].parents.remove(edge_to)
-    self.nodes[edge_to].children.remove(edge_from)
-
-  def add_split_nodes(self, node1, node2):
-    self.split_nodes[node1] = node2
-    self.split_nodes[node2] = node1
+
+  def init(self):
+    self.num_workers = FLAGS.num_workers
+    self.layouts = []
+    self.node_costs = []
+    self.var_exprs = []
+    self.edges = []
+    self.expr_to_var = {}
+
+  def new_var(self, exprs, layouts, costs=None):
+    self.layouts.append(list(layouts))
+    self.node_costs.append(costs or [0] * len(layouts))
+    self.var_exprs.append(list(exprs))
+    return len(self.layouts) - 1
+
+  def add_edge(self, child, parent, cost_fn):
+    if child is None or child == parent:
+      return
+    costs = [min(int(cost_fn(src, dst)), _INFEASIBLE)
+             for src in self.layouts[child] for dst in self.layouts[parent]]
+    self.edges.append((child, parent, costs))
+
+  def derived_var(self, expr, child, layout_fn=lambda l: l):
+    '''A variable for ``expr`` whose layout follows from that of ``child``.'''
+    layouts = [layout_fn(l) for l in self.layouts[child]]
+    var = self.new_var([expr], layouts)
+    self.add_edge(child, var, lambda src, dst: 0 if layout_fn(src) == dst else _INFEASIBLE)
+    return var
+
+  def share_var(self, expr, var):
+    if var is not None:
+      self.var_exprs[var].append(expr)
+    return var
 
   def visit_children(self, children, except_child=None):
-    child_ids = []
+    child_vars = []
     for child in children:
       if isinstance(child, (Expr, DistArray)) and id(child) != id(except_child):
-        child_ids.extend(self.visit_default(child))
-    return child_ids
+        child_vars.append(self.visit_expr(child))
+    return [v for v in child_vars if v is not None]
 
   def visit_NdArrayExpr(self, expr):
     # new array need to be partitioned
-    if len(expr.shape) > 1 and expr.shape[1] > 1:
-      self.nodes[self.cur_node_id] = self.node_type([expr], 0, [], [])
-      self.add_edge(0, self.cur_node_id, 0)
-      self.cur_node_id += 1
-
-      self.nodes[self.cur_node_id] = self.node_type([expr], 1, [], [])
-      self.add_edge(0, self.cur_node_id, 0)
-      self.cur_node_id += 1
-
-      self.add_split_nodes(self.cur_node_id - 2, self.cur_node_id - 1)
-      return [self.cur_node_id - 2, self.cur_node_id - 1]
-    else:
-      self.nodes[self.cur_node_id] = self.node_type([expr], 0, [], [])
-      self.add_edge(0, self.cur_node_id, 0)
-      self.cur_node_id += 1
-      return [self.cur_node_id - 1]
+    layouts = _candidate_layouts(expr.shape, self.num_workers)
+    return self.new_var([expr], layouts, [_serial_cost(expr.shape, l, self.num_workers) for l in layouts])
 
   def visit_MapExpr(self, expr):
-    largest = max(expr.children.vals, key=lambda v: reduce(operator.mul, v.shape, 1))
+    largest = max(expr.children.vals, key=lambda v: _size(v.shape))
 
-    child_ids = self.visit_children([largest])
-    other_child_ids = self.visit_children(expr.children.vals, largest)
-    kw_ids = self.visit_children(expr.op.kw['fn_kw'].itervalues()) if 'fn_kw' in expr.op.kw else []
+    child_vars = self.visit_children([largest])
+    other_vars = self.visit_children(expr.children.vals, largest)
+    kw_vars = self.visit_children(expr.op.kw['fn_kw'].itervalues()) if 'fn_kw' in expr.op.kw else []
+    if not child_vars:
+      return None
     # one input map, reuse child expr
-    if len(other_child_ids) == 0:
-      for child_id in child_ids: self.nodes[child_id].expr.append(expr)
-      return child_ids
-
-    if child_ids[0] in self.split_nodes:
-      tiling_types = (0, 1)
-      self.add_split_nodes(self.cur_node_id, self.cur_node_id + 1)
-      expr_node_ids = [self.cur_node_id, self.cur_node_id + 1]
-    else:
-      tiling_types = (self.nodes[child_ids[0]].tiling,)
-      expr_node_ids = [self.cur_node_id]
-
-    for i in xrange(len(tiling_types)):
-      tiling_type = tiling_types[i]
-      self.nodes[self.cur_node_id] = self.node_type([expr], tiling_type, [], [])
-      self.add_edge(child_ids[i], self.cur_node_id, 0)
-
-      for child_id in other_child_ids:
-        child = self.nodes[child_id]
-        e_cost = reduce(operator.mul, child.expr[0].shape, 1) if child.tiling != tiling_type else 0
-        self.add_edge(child_id, self.cur_node_id, e_cost)
-
-      for child_id in kw_ids:
-        self.add_edge(child_id, self.cur_node_id, reduce(operator.mul, self.nodes[child_id].expr[0].shape, 1))
-      self.cur_node_id += 1
-
-    return expr_node_ids
+    if not other_vars and not kw_vars:
+      return self.share_var(expr, child_vars[0])
+
+    # the result is laid out like the largest input.
+    var = self.derived_var(expr, child_vars[0])
+    for child in other_vars:
+      self.add_edge(child, var, _move_cost(self.var_size(child)))
+    for child in kw_vars:
+      size = self.var_size(child)
+      self.add_edge(child, var, lambda src, dst, size=size: size)
+    return var
 
   def visit_ReduceExpr(self, expr):
-    child_ids = self.visit_children(expr.children.vals)
-    cost = reduce(operator.mul, expr.shape, 1)
-    self.nodes[self.cur_node_id] = self.node_type([expr], 0, [], [])
-    for child_id in child_ids:
-      child = self.nodes[child_id]
-      e_cost = 0 if expr.axis is None or (1-expr.axis) == child.tiling else cost
-      self.add_edge(child_id, self.cur_node_id, e_cost)
-    self.cur_node_id += 1
-    return [self.cur_node_id - 1]
+    child_vars = self.visit_children(expr.children.vals)
+    layouts = _candidate_layouts(expr.shape, self.num_workers)
+    var = self.new_var([expr], layouts, [_serial_cost(expr.shape, l, self.num_workers) for l in layouts])
+    size = _size(expr.shape)
+    for child, child_expr in zip(child_vars, expr.children.vals):
+      ndim = len(child_expr.shape)
+      if expr.axis is None:
+        reduced = set(range(ndim))
+      else:
+        reduced = set([expr.axis % ndim if ndim else 0])
+
+      def cost(src, dst, reduced=reduced):
+        # partial results are combined if the reduced axis is split.
+        combine = size if reduced & set(src) else 0
+        kept = tuple(axis - len([r for r in reduced if r < axis])
+                     for axis in src if axis not in reduced)
+        return combine + (0 if kept == dst else size)
+      self.add_edge(child, var, cost)
+    return var
 
   def visit_Map2Expr(self, expr):
     #TODO: Apply the algorithm to Map2
-    child_ids = self.visit_children(expr.arrays)
-    for child_id in child_ids: self.nodes[child_id].expr.append(expr)
-    return child_ids
+    child_vars = self.visit_children(expr.arrays)
+    for child in child_vars: self.share_var(expr, child)
+    return child_vars[0] if child_vars else None
 
   def visit_OuterProductExpr(self, expr):
     #TODO: Apply the algorithm to Outer
-    child_ids = self.visit_children(expr.arrays)
-    for child_id in child_ids: self.nodes[child_id].expr.append(expr)
-    return child_ids
+    child_vars = self.visit_children(expr.arrays)
+    for child in child_vars: self.share_var(expr, child)
+    return child_vars[0] if child_vars else None
+
+  def _hint_cost(self, expr, child):
+    '''Cost function for ``child`` of a shuffle from the (old style) ``cost_hint``.'''
+    hint = expr.cost_hint[hash(child)]
+    default = _size(child.shape)
+    def cost(src, dst):
+      if src in (ROWS, COLS) and dst in (ROWS, COLS):
+        return hint.get('%d%d' % (src[0], dst[0]), default)
+      return 0 if src == dst else default
+    return cost
 
   def visit_ShuffleExpr(self, expr):
     for child in expr.fn_kw.itervalues():
       if isinstance(child, (Expr, DistArray)) and hash(child) not in expr.cost_hint:
-        cost = reduce(operator.mul, child.shape, 1)
+        cost = _size(child.shape)
         expr.cost_hint[hash(child)] = {'00': cost, '01': cost, '10': cost, '11': cost}
     if expr.target is not None and hash(expr.target) not in expr.cost_hint:
-      cost = reduce(operator.mul, expr.target.shape, 1)
+      cost = _size(expr.target.shape)
       expr.cost_hint[hash(expr.target)] = {'00': cost, '01': cost, '10': cost, '11': cost}
 
-    child_ids = self.visit_children([expr.array])
-    other_child_ids = self.visit_children(expr.fn_kw.itervalues())
+    child_vars = self.visit_children([expr.array])
+    kw_children = [(child, self.visit_expr(child)) for child in expr.fn_kw.itervalues()
+                   if isinstance(child, (Expr, DistArray))]
+    if not child_vars:
+      return None
+    var = child_vars[0]
 
     # calc the copy cost
-    if len(other_child_ids) == 0:
-      expr_node_ids = child_ids
-    else:
-      if child_ids[0] in self.split_nodes:
-        tiling_types = (0, 1)
-        self.add_split_nodes(self.cur_node_id, self.cur_node_id + 1)
-        expr_node_ids = [self.cur_node_id, self.cur_node_id + 1]
-      else:
-        tiling_types = (self.nodes[child_ids[0]].tiling,)
-        expr_node_ids = [self.cur_node_id]
-
-      for i in xrange(len(tiling_types)):
-        tiling_type = tiling_types[i]
-        self.nodes[self.cur_node_id] = self.node_type([expr], tiling_type, [], [])
-        self.add_edge(child_ids[i], self.cur_node_id, 0)
-
-        for child in expr.fn_kw.itervalues():
-          if isinstance(child, (Expr, DistArray)):
-            for child_id in self.expr_to_nodes[hash(child)]:
-              self.add_edge(child_id, self.cur_node_id, expr.cost_hint[hash(child)]['%d%d' % (self.nodes[child_id].tiling, tiling_type)])
-        self.cur_node_id += 1
+    if kw_children:
+      var = self.derived_var(expr, var)
+      for child, child_var in kw_children:
+        self.add_edge(child_var, var, self._hint_cost(expr, child))
 
     # calculate update cost
     if expr.target is not None:
-      other_child_ids = expr_node_ids
-      child_ids = self.visit_children([expr.target])
-
-      if child_ids[0] in self.split_nodes:
-        tiling_types = (0, 1)
-        self.add_split_nodes(self.cur_node_id, self.cur_node_id + 1)
-        expr_node_ids = [self.cur_node_id, self.cur_node_id + 1]
-      else:
-        tiling_types = (self.nodes[child_ids[0]].tiling,)
-        expr_node_ids = [self.cur_node_id]
-
-      for i in xrange(len(tiling_types)):
-        tiling_type = tiling_types[i]
-        self.nodes[self.cur_node_id] = self.node_type([expr], tiling_type, [], [])
-        self.add_edge(child_ids[i], self.cur_node_id, 0)
-
-        for child_id in other_child_ids:
-          self.add_edge(child_id, self.cur_node_id, expr.cost_hint[hash(expr.target)]['%d%d' % (self.nodes[child_id].tiling, tiling_type)])
-        self.cur_node_id += 1
-      return expr_node_ids
-
-    if expr.shape == expr.array.shape or len(other_child_ids) > 0:
-      if len(other_child_ids) == 0:
-        for child_id in expr_node_ids: self.nodes[child_id].expr.append(expr)
-      return expr_node_ids
-
-    # fix result tiling
-    if len(expr.shape) <= 1 or 1 in expr.shape[:2]:
-      tiling_type = 0 if len(expr.shape) <= 1 else 1 - expr.shape.index(1)
-      self.nodes[self.cur_node_id] = self.node_type([expr], tiling_type, [], [])
-      for child_id in expr_node_ids: self.add_edge(child_id, self.cur_node_id, 0)
-      self.cur_node_id += 1
-      return [self.cur_node_id - 1]
-    else:
-      child_ids = expr_node_ids
-      expr_node_ids = []
-      for child_id in child_ids:
-        self.nodes[self.cur_node_id] = self.node_type([expr], self.nodes[child_id].tiling, [], [])
-        expr_node_ids.append(self.cur_node_id)
-        self.add_edge(child_id, self.cur_node_id, 0)
-        self.cur_node_id += 1
-      if len(expr_node_ids) > 1: self.add_split_nodes(*expr_node_ids)
-    return expr_node_ids
+      target_vars = self.visit_children([expr.target])
+      if target_vars:
+        source = var
+        var = self.derived_var(expr, target_vars[0])
+        self.add_edge(source, var, self._hint_cost(expr, expr.target))
+      return var
+
+    if kw_children or expr.shape == expr.array.shape:
+      if not kw_children:
+        self.share_var(expr, var)
+      return var
+
+    # the result has a new shape: any layout may be chosen.
+    layouts = _candidate_layouts(expr.shape, self.num_workers)
+    result = self.new_var([expr], layouts, [_serial_cost(expr.shape, l, self.num_workers) for l in layouts])
+    self.add_edge(var, result, lambda src, dst: 0)
+    return result
 
   def visit_DotExpr(self, expr):
-    child_ids = self.visit_children([expr.matrix_a])
-    other_child_ids = self.visit_children([expr.matrix_b])
-
-    # calc copy cost
-    if len(other_child_ids) != 0:
-      if child_ids[0] in self.split_nodes:
-        tiling_types = (0, 1)
-        self.add_split_nodes(self.cur_node_id, self.cur_node_id + 1)
-        expr_node_ids = [self.cur_node_id, self.cur_node_id + 1]
-      else:
-        tiling_types = (self.nodes[child_ids[0]].tiling,)
-        expr_node_ids = [self.cur_node_id]
-
-      for i in xrange(len(tiling_types)):
-        tiling_type = tiling_types[i]
-        self.nodes[self.cur_node_id] = self.node_type([expr], tiling_type, [], [])
-        self.add_edge(child_ids[i], self.cur_node_id, 0)
-
-        for child_id in other_child_ids:
-          child = self.nodes[child_id]
-          e_cost = reduce(operator.mul, child.expr[0].shape, 1) if tiling_type == 0 or child.tiling == tiling_type else 0
-          self.add_edge(child_id, self.cur_node_id, e_cost)
-        self.cur_node_id += 1
-
-      child_ids = expr_node_ids
-
-    # calc update cost
-    if len(expr.shape) == 1 or expr.shape[1] == 1:
-      tiling_types = (0,)
-      expr_node_ids = [self.cur_node_id]
-    else:
-      tiling_types = (0, 1)
-      self.add_split_nodes(self.cur_node_id, self.cur_node_id + 1)
-      expr_node_ids = [self.cur_node_id, self.cur_node_id + 1]
-
-    for tiling_type in tiling_types:
-      self.nodes[self.cur_node_id] = self.node_type([expr], tiling_type, [], [])
-      for child_id in child_ids:
-        e_cost = reduce(operator.mul, expr.shape, 1) if self.nodes[child_id].tiling != tiling_type else 0
-        self.add_edge(child_id, self.cur_node_id, e_cost)
-      self.cur_node_id += 1
-    return expr_node_ids
+    a = self.visit_expr(expr.matrix_a)
+    b = self.visit_expr(expr.matrix_b)
+
+    layouts = _candidate_layouts(expr.shape, self.num_workers)
+    var = self.new_var([expr], layouts, [_dot_result_cost(expr.shape, l, self.num_workers) for l in layouts])
+
+    self.add_edge(a, var, _dot_costs(_size(expr.matrix_a.shape), self.num_workers, ROWS, COLS))
+    self.add_edge(b, var, _dot_costs(_size(expr.matrix_b.shape), self.num_workers, COLS, ROWS))
+    return var
+
+  def visit_GramExpr(self, expr):
+    # the output is summed on the workers and kept in a single tile.
+    var = self.new_var([expr], [REPLICATED])
+    # tiles split only along the summed axis read their slab of b locally.
+    split = (expr.axis,)
+    b = expr.matrix_a if expr.matrix_b is None else expr.matrix_b
+    size = _size(b.shape)
+    for child in self.visit_children([expr.matrix_a, expr.matrix_b]):
+      self.add_edge(child, var, lambda src, dst: 0 if src == split else size)
+    return var
 
   def visit_WriteArrayExpr(self, expr):
-    child_ids = self.visit_children([expr.array])
+    child_vars = self.visit_children([expr.array])
+    if not child_vars:
+      return None
     if isinstance(expr.data, (Expr, DistArray)):
-      data_child_ids = self.visit_children([expr.data])
-      if child_ids[0] in self.split_nodes:
-        tiling_types = (0, 1)
-        self.add_split_nodes(self.cur_node_id, self.cur_node_id + 1)
-        expr_node_ids = [self.cur_node_id, self.cur_node_id + 1]
-      else:
-        tiling_types = (self.nodes[child_ids[0]].tiling,)
-        expr_node_ids = [self.cur_node_id]
-
-      for i in xrange(len(tiling_types)):
-        self.nodes[self.cur_node_id] = self.node_type([expr], tiling_types[i], [], [])
-        self.add_edge(child_ids[i], self.cur_node_id, 0)
-
-        for child_id in data_child_ids:
-          child = self.nodes[child_id]
-          e_cost = reduce(operator.mul, child.expr[0].shape, 1) if child.tiling != tiling_types[i] else 0
-          self.add_edge(child_id, self.cur_node_id, e_cost)
-        self.cur_node_id += 1
-      return expr_node_ids
-
-    for child_id in child_ids: self.nodes[child_id].expr.append(expr)
-    return child_ids
-
-  def visit_aligned_nodes(self, expr, reverse_cost=False):
-    array = expr.src if hasattr(expr, 'src') else expr.array
-    child_ids = self.visit_children([array])
-    if child_ids[0] in self.split_nodes:
-      tiling_types = (0, 1)
-      self.add_split_nodes(self.cur_node_id, self.cur_node_id + 1)
-      expr_node_ids = [self.cur_node_id, self.cur_node_id + 1]
-    else:
-      tiling_types = (reverse_cost ^ self.nodes[child_ids[0]].tiling,)
-      expr_node_ids = [self.cur_node_id]
-
-    for i in xrange(len(tiling_types)):
-      self.nodes[self.cur_node_id] = self.node_type([expr], tiling_types[i], [], [])
-      self.add_edge(child_ids[-(reverse_cost ^ i)], self.cur_node_id, 0)
-      self.cur_node_id += 1
-    return expr_node_ids
+      data = self.visit_expr(expr.data)
+      var = self.derived_var(expr, child_vars[0])
+      self.add_edge(data, var, _move_cost(_size(expr.data.shape)))
+      return var
+    return self.share_var(expr, child_vars[0])
 
   def visit_TransposeExpr(self, expr):
-    return self.visit_aligned_nodes(expr, reverse_cost=True)
+    child_vars = self.visit_children([expr.array])
+    if not child_vars:
+      return None
+    ndim = len(expr.array.shape)
+    return self.derived_var(expr, child_vars[0], lambda l: _transposed(l, ndim))
 
   def visit_ReshapeExpr(self, expr):
-    return self.visit_aligned_nodes(expr, reverse_cost=True)
+    child_vars = self.visit_children([expr.array])
+    if not child_vars:
+      return None
+    layouts = _candidate_layouts(expr.shape, self.num_workers)
+    var = self.new_var([expr], layouts)
+    self.add_edge(child_vars[0], var, _move_cost(_size(expr.shape)))
+    return var
 
   def visit_SliceExpr(self, expr):
-    return self.visit_aligned_nodes(expr)
+    child_vars = self.visit_children([expr.src])
+    if not child_vars:
+      return None
+    return self.derived_var(expr, child_vars[0])
 
   def visit_FilterExpr(self, expr):
-    child_ids = self.visit_children([expr.src])
-    for child_id in child_ids: self.nodes[child_id].expr.append(expr)
-    return child_ids
+    child_vars = self.visit_children([expr.src])
+    return self.share_var(expr, child_vars[0]) if child_vars else None
 
   def visit_CheckpointExpr(self, expr):
-    child_ids = self.visit_children([expr.src])
-    for child_id in child_ids: self.nodes[child_id].expr.append(expr)
-    return child_ids
+    child_vars = self.visit_children([expr.src])
+    return self.share_var(expr, child_vars[0]) if child_vars else None
 
   def visit_TileOpExpr(self, expr):
-    child_ids = self.visit_children([expr.array])
-    for child_id in child_ids: self.nodes[child_id].expr.append(expr)
-    return child_ids
-
-  def generate_edges(self, s=0):
-    edges = []
-    self.nodes[s].parents.sort(key=lambda x: reduce(operator.mul, self.nodes[x].expr[0].shape, 1))
-    for parent_id in self.nodes[s].parents:
-      edges.append((s, parent_id, self.edges[(s, parent_id)]))
-      if parent_id not in self.visited_nodes:
-        edges.extend(self.generate_edges(parent_id))
-        self.visited_nodes.add(parent_id)
-    return edges
-
-  def tile_expr(self, expr, tiling):
-    if isinstance(expr, (NdArrayExpr, ReduceExpr, DotExpr)) and len(expr.shape) > 0:
-      expr.tile_hint = list(expr.shape)
-      expr.tile_hint[tiling] = int(math.ceil(float(expr.tile_hint[tiling]) / FLAGS.num_workers))
+    child_vars = self.visit_children([expr.array])
+    return self.share_var(expr, child_vars[0]) if child_vars else None
 
-  def calc_tiling(self, expr):
-    # add T node for graph
-    self.nodes[self.cur_node_id] = self.node_type([expr], -1, [], [])
-    self.add_edge(self.cur_node_id - 1, self.cur_node_id, 0)
-    if self.cur_node_id - 1 in self.split_nodes:
-      self.add_edge(self.cur_node_id - 2, self.cur_node_id, 0)
-    self.cur_node_id += 1
+  def var_size(self, var):
+    return _size(self.var_exprs[var][0].shape)
 
-    # compute best tiling for all exprs
-    self.visited_nodes = set()
-    nodes = mincost_tiling(self.cur_node_id - 1, self.generate_edges(), self.split_nodes.items())
+  def tile_expr(self, expr, layout):
+    if isinstance(expr, (NdArrayExpr, ReduceExpr, DotExpr)) and len(expr.shape) > 0:
+      expr.tile_hint = _tile_hint(expr.shape, layout, self.num_workers)
 
-    # give expr the best tiling hint
-    for node_id in nodes:
-      node = self.nodes[node_id]
-      for cur_expr in node.expr:
-        _tiled_exprlist[hash(cur_expr)] = node.tiling
-        self.tile_expr(cur_expr, node.tiling)
+  def calc_tiling(self):
+    if not self.layouts:
+      return
+    # compute best layout for all exprs
+    choices = mincost_layouts(self.node_costs, self.edges)
 
-    self.inited = False
-    return expr
+    # give expr the best tiling hint
+    for var, choice in enumerate(choices):
+      layout = self.layouts[var][choice]
+      for cur_expr in self.var_exprs[var]:
+        if isinstance(cur_expr, Expr):
+          _tiled_exprlist[hash(cur_expr)] = layout
+        self.tile_expr(cur_expr, layout)
 
   def tile_cached_expr(self, expr):
     if not isinstance(expr, Expr) or isinstance(expr, (Val, AsArray)): return
+    if hash(expr) not in _tiled_exprlist: return
 
     self.tile_expr(expr, _tiled_exprlist[hash(expr)])
 
     if hasattr(expr, 'array'): self.tile_cached_expr(expr.array)
     if hasattr(expr, 'src'): self.tile_cached_expr(expr.src)
     if hasattr(expr, 'target'): self.tile_cached_expr(expr.target)
-    if isinstance(expr, DotExpr):
+    if isinstance(expr, (DotExpr, GramExpr)):
       self.tile_cached_expr(expr.matrix_a)
       self.tile_cached_expr(expr.matrix_b)
 
@@ -839,55 +1296,261 @@ class AutomaticTiling(OptimizePass):
       for child in expr.op.kw['fn_kw'].itervalues():
         self.tile_cached_expr(child)
 
-  def visit_default(self, expr):
-    if not self.inited: self.init(expr)
+  def visit_expr(self, expr):
+    '''Add ``expr`` and its inputs to the layout graph; returns its variable (or None).'''
+    if hash(expr) in self.expr_to_var:
+      # cached expr
+      return self.expr_to_var[hash(expr)]
 
-    if hash(expr) in _tiled_exprlist:
+    if isinstance(expr, Expr) and hash(expr) in _tiled_exprlist:
+      # tiled by an earlier optimization.
       self.tile_cached_expr(expr)
-      tiling = _tiled_exprlist[hash(expr)]
-      self.nodes[self.cur_node_id] = self.node_type([expr], tiling, [], [])
-      expr_node_ids = [self.cur_node_id]
-      self.add_edge(0, self.cur_node_id, 0)
-      self.cur_node_id += 1
-
-    elif hash(expr) in self.expr_to_nodes:
-      # cached expr
-      expr_node_ids = self.expr_to_nodes[hash(expr)]
-      for node_id in expr_node_ids:
-        node = self.nodes[node_id]
-        node.expr.append(expr)
+      var = self.new_var([expr], [_tiled_exprlist[hash(expr)]])
 
     elif isinstance(expr, DistArray) or isinstance(expr, (Val, AsArray)) and isinstance(expr.val, DistArray):
       # already partitioned array
       array = expr if isinstance(expr, DistArray) else expr.val
-      tiling = array.tile_shape()[0] == array.shape[0]
-      self.nodes[self.cur_node_id] = self.node_type([expr], tiling, [], [])
-      expr_node_ids = [self.cur_node_id]
-      self.add_edge(0, self.cur_node_id, 0)
-      self.cur_node_id += 1
+      layout = _array_layout(array)
+      var = self.new_var([expr], [layout]) if layout is not None else None
 
     elif isinstance(expr, CollectionExpr):
       # DictExpr, ListExpr, TupleExpr
       children = expr.itervalues() if expr.typename() == 'DictExpr' else expr.vals
-      child_ids = self.visit_children(children)
-      self.nodes[self.cur_node_id] = self.node_type([expr], -1, [], [])
-      expr_node_ids = [self.cur_node_id]
-      for child_id in child_ids:
-        self.add_edge(child_id, self.cur_node_id, 0)
-      self.cur_node_id += 1
+      self.visit_children(children)
+      var = None
 
     elif hasattr(self, 'visit_%s' % expr.typename()):
-      expr_node_ids = getattr(self, 'visit_%s' % expr.typename())(expr)
+      try:
+        var = getattr(self, 'visit_%s' % expr.typename())(expr)
+      except NotShapeable:
+        # a data dependent shape: the layout is left to the evaluation.
+        util.log_debug('Skip expr:%s, shape unknown', expr.typename())
+        self.visit_children(expr.dependencies().itervalues())
+        var = None
 
     else:
       util.log_debug("Skip expr:%s", expr.typename())
-      expr_node_ids = []
+      var = None
+
+    self.expr_to_var[hash(expr)] = var
+    return var
+
+  def visit_default(self, expr):
+    self.init()
+    self.visit_expr(expr)
+    self.calc_tiling()
+    return expr
+
+
+FLAGS.add(IntFlag('plan_cache_size', default=64,
+                  help='Number of optimized plans reused by expression structure (0 to disable)'))
+
+
+class _Uncachable(Exception):
+  pass
+
 
-    # add T node for graph and compute the min cost flow
-    if id(expr) == self.init_expr: return self.calc_tiling(expr)
+def _leaf_class(value):
+  '''The properties of a leaf value the optimization passes depend on.'''
+  if isinstance(value, DistArray):
+    tile_shape = value.tile_shape() if hasattr(value, 'tiles') else None
+    return (type(value).__name__, value.shape, str(value.dtype),
+            getattr(value, 'sparse', False), tile_shape)
+  if isinstance(value, np.ndarray):
+    return ('ndarray', value.shape, str(value.dtype))
+  if np.isscalar(value):
+    return ('scalar', type(value).__name__)
+  return None
 
-    self.expr_to_nodes[hash(expr)] = expr_node_ids
-    return expr_node_ids
+
+class PlanFingerprint(object):
+  '''
+  The structure of an expression graph, independent of the arrays it reads.
+
+  Leaves (`Val` and `AsArray` nodes, and expressions which already have a
+  cached value) are described by the class of their value: type, shape,
+  dtype, sparsity and tiling for arrays, and the type for scalars.  Which
+  leaves are the same value is part of the structure, since the optimizer
+  merges them.  Everything else is described as in `_structure_key`.
+
+  :ivar key: hashable key; graphs with equal keys optimize to the same plan.
+  :ivar nodes: the non-leaf expressions, in a deterministic order.
+  :ivar leaves: the leaf expressions, in a deterministic order.
+  :ivar values: the value of each leaf.
+  '''
+  def __init__(self, root):
+    self.nodes = []
+    self.leaves = []
+    self.values = []
+    self.collapsed = []
+    self.pinned = []
+    self._leaf_keys = []
+    self._refs = {}
+    self.key = self._walk(root)
+
+  @staticmethod
+  def create(root):
+    '''Return the fingerprint of ``root``, or None if its plan cannot be reused.'''
+    if not FLAGS.opt_collapse_cached:
+      return None
+    try:
+      fingerprint = PlanFingerprint(root)
+    except _Uncachable:
+      return None
+    if not fingerprint.nodes or fingerprint.nodes[-1] is not root:
+      return None
+    return fingerprint
+
+  def _leaf(self, node, value, collapsed):
+    cls = _leaf_class(value)
+    if cls is None:
+      if collapsed:
+        raise _Uncachable
+      cls = ('value', _structure_key(value, {}, self.pinned))
+    same = _structure_key(value, {})
+    equal_to = self._leaf_keys.index(same) if same in self._leaf_keys else None
+    self.leaves.append(node)
+    self.values.append(value)
+    self.collapsed.append(collapsed)
+    self._leaf_keys.append(same)
+    return ('leaf', cls, equal_to)
+
+  def _walk(self, node):
+    if id(node) in self._refs:
+      return self._refs[id(node)]
+
+    cached = node.cache()
+    if cached is not None:
+      key = self._leaf(node, cached, True)
+    elif isinstance(node, (Val, AsArray)):
+      key = self._leaf(node, node.val, False)
+    else:
+      if id(node) in _not_idempotent_list:
+        raise _Uncachable
+      var_names = {}
+      if hasattr(node, 'child_to_var'):
+        var_names = dict((v, 'v%d' % i) for i, v in enumerate(node.child_to_var))
+      key = (node.typename(),) + tuple(
+        (k, self._walk_value(getattr(node, k, None), var_names))
+        for k in node.members if k not in ('expr_id', 'stack_trace'))
+      self.nodes.append(node)
+
+    self._refs[id(node)] = ('ref', len(self._refs))
+    return key
+
+  def _walk_value(self, value, var_names):
+    if isinstance(value, Expr):
+      return self._walk(value)
+    if isinstance(value, (list, tuple)):
+      return (type(value).__name__,) + tuple(self._walk_value(v, var_names) for v in value)
+    if isinstance(value, dict):
+      return ('dict',) + tuple(sorted((k, self._walk_value(v, var_names))
+                                      for k, v in value.iteritems()))
+    key = _structure_key(value, var_names, self.pinned)
+    if _refers_to_expr(key):
+      # expressions inside local operations (e.g. region_map keywords) are
+      # replaced by their values when evaluated.
+      raise _Uncachable
+    return key
+
+
+def _refers_to_expr(key):
+  if not isinstance(key, tuple):
+    return False
+  if len(key) == 2 and key[0] == 'expr':
+    return True
+  return any(_refers_to_expr(k) for k in key)
+
+
+def _copy_dag(value, copy_expr, memo):
+  '''Copy ``value``, replacing each `Expr` by ``copy_expr(expr, copy)``.'''
+  if isinstance(value, Expr):
+    if id(value) not in memo:
+      memo[id(value)] = copy_expr(value, lambda v: _copy_dag(v, copy_expr, memo))
+    return memo[id(value)]
+  if isinstance(value, list):
+    return [_copy_dag(v, copy_expr, memo) for v in value]
+  if type(value) is tuple:
+    return tuple([_copy_dag(v, copy_expr, memo) for v in value])
+  if isinstance(value, dict):
+    return dict((k, _copy_dag(v, copy_expr, memo)) for k, v in value.iteritems())
+  return value
+
+
+class PlanSlot(Expr):
+  '''Placeholder for the ``index``-th leaf in a cached plan.'''
+  index = PythonValue(None, desc="Integer")
+
+  def visit(self, visitor):
+    return self
+
+
+class CachedPlan(object):
+  '''
+  An optimized graph with its leaves replaced by `PlanSlot` placeholders.
+
+  The template does not reference the arrays of the graph it was built
+  from.  `bind` copies it for a new graph with the same fingerprint: slots
+  are filled with the new leaves, and copied expressions take the ids of the
+  corresponding expressions of the new graph, so their results are cached
+  for the user's expressions as if the new graph had been optimized.
+  '''
+  def __init__(self, dag, fingerprint):
+    self.pinned = fingerprint.pinned
+    positions = dict((n.expr_id, k) for k, n in enumerate(fingerprint.nodes))
+    slots = dict((id(leaf), i) for i, leaf in enumerate(fingerprint.leaves))
+    collapsed = {}
+    for i, value in enumerate(fingerprint.values):
+      if fingerprint.collapsed[i]:
+        collapsed.setdefault(id(value), i)
+
+    self.positions = {}
+    self.tiling = {}
+
+    def copy_expr(node, copy):
+      if id(node) in slots:
+        return PlanSlot(index=slots[id(node)])
+      if isinstance(node, Val) and id(node.val) in collapsed:
+        return PlanSlot(index=collapsed[id(node.val)])
+      new_node = node.__class__(**dict((k, copy(getattr(node, k)))
+                                       for k in node.members if k != 'expr_id'))
+      if node.expr_id in positions:
+        self.positions[new_node.expr_id] = positions[node.expr_id]
+      if node.expr_id in _tiled_exprlist:
+        self.tiling[new_node.expr_id] = _tiled_exprlist[node.expr_id]
+      return new_node
+
+    self.template = _copy_dag(dag, copy_expr, {})
+
+  def bind(self, fingerprint):
+    '''Return a copy of this plan evaluating the graph described by ``fingerprint``.'''
+    def copy_expr(node, copy):
+      if isinstance(node, PlanSlot):
+        if fingerprint.collapsed[node.index]:
+          return Val(val=fingerprint.values[node.index])
+        return fingerprint.leaves[node.index]
+      kw = dict((k, copy(getattr(node, k))) for k in node.members if k != 'expr_id')
+      if node.expr_id in self.positions:
+        kw['expr_id'] = fingerprint.nodes[self.positions[node.expr_id]].expr_id
+      new_node = node.__class__(**kw)
+      if node.expr_id in self.tiling:
+        _tiled_exprlist[new_node.expr_id] = self.tiling[node.expr_id]
+      return new_node
+
+    return _copy_dag(self.template, copy_expr, {})
+
+
+_plans = OrderedDict()
+
+
+def _plan_key(fingerprint):
+  enabled = tuple(getattr(FLAGS, 'opt_' + p.name) for p in passes)
+  return (fingerprint.key, enabled, FLAGS.num_workers)
+
+
+def clear_plan_cache():
+  '''Forget all cached optimized plans.'''
+  _plans.clear()
 
 
 def apply_pass(klass, dag):
@@ -897,7 +1560,9 @@ def apply_pass(klass, dag):
 
   util.log_debug('Starting pass %s', klass.name)
   p = klass()
-  result = p.visit(dag)
+  # passes only use shapes which are known without evaluating anything.
+  with symbolic_shapes():
+    result = p.visit(dag)
   util.log_debug('Finished pass %s', klass.name)
   return result
 
@@ -905,15 +1570,141 @@ def apply_pass(klass, dag):
 passes = []
 
 
-def optimize(dag):
+def dag_nodes(root, collections=False):
+  '''
+  Return the expressions reachable from ``root``, dependencies first.
+
+  Collections (`ListExpr` etc.) are looked through, and only returned if
+  ``collections`` is True.
+  '''
+  order, seen = [], set()
+  stack = [(root, False)]
+  while stack:
+    node, expanded = stack.pop()
+    if expanded:
+      if collections or not isinstance(node, CollectionExpr):
+        order.append(node)
+      continue
+    if id(node) in seen:
+      continue
+    seen.add(id(node))
+    stack.append((node, True))
+    for d in node.dependencies().itervalues():
+      if isinstance(d, Expr) and id(d) not in seen:
+        stack.append((d, False))
+  return order
+
+
+def _member_key(value, var_names):
+  if isinstance(value, CollectionExpr):
+    # passes copy collections; compare their elements instead.
+    if isinstance(value.vals, dict):
+      return ('dict',) + tuple(sorted((k, _member_key(v, var_names))
+                                      for k, v in value.vals.iteritems()))
+    return (type(value.vals).__name__,) + tuple(_member_key(v, var_names) for v in value.vals)
+  return _structure_key(value, var_names)
+
+
+def _node_key(node):
+  '''A key which changes when a pass rewrites ``node`` (or one of its members).'''
+  var_names = {}
+  if hasattr(node, 'child_to_var'):
+    var_names = dict((v, 'v%d' % i) for i, v in enumerate(node.child_to_var))
+  return (node.typename(),) + tuple(
+    (k, _member_key(getattr(node, k, None), var_names))
+    for k in node.members if k not in ('expr_id', 'stack_trace'))
+
+
+def _record_rewrites(name, before, dag, rewrites):
+  '''Append ``name`` to ``rewrites[expr_id]`` for each node of ``dag`` not in ``before``.'''
+  after = {}
+  for node in dag_nodes(dag):
+    key = _node_key(node)
+    after[node.expr_id] = key
+    if before.get(node.expr_id) != key:
+      rewrites.setdefault(node.expr_id, []).append(name)
+  return after
+
+
+def optimize(dag, rewrites=None):
+  '''
+  Apply the enabled optimization passes to ``dag``.
+
+  If a graph with the same fingerprint was optimized before, its cached
+  plan is re-bound to ``dag`` instead.
+
+  :param rewrites: Optional dict.  If given, the plan cache is bypassed,
+    and the names of the passes which created or changed each node of the
+    result are listed under its expression id.
+  '''
   if not FLAGS.optimization:
     util.log_debug('Optimizations disabled')
     return dag
 
-  util.log_debug('Optimization: applying %d passes', len(passes))
-  for p in passes:
-    dag = apply_pass(p, dag)
+  with no_truncation():
+    return _optimize(dag, rewrites)
+
+
+def _mark_private_slices(dag):
+  '''
+  Set `SliceExpr.private_src` for the slices in ``dag``: True if their
+  source is used by nothing else in the graph, is not held by user code
+  (see `base.keep`) and has not been evaluated.
+
+  This is decided before looking up a cached plan, so that it is part of
+  the plan's fingerprint.
+  '''
+  nodes = dag_nodes(dag, collections=True)
+  held = user_held(nodes)
+  parents = defaultdict(int)
+  for node in nodes:
+    for child in node.dependencies().itervalues():
+      if isinstance(child, Expr):
+        parents[child.expr_id] += 1
+
+  for node in nodes:
+    if isinstance(node, SliceExpr):
+      src = node.src
+      node.private_src = (parents[src.expr_id] == 1 and src.expr_id not in held and
+                          src.cache() is None)
+
+
+def _optimize(dag, rewrites):
+  _mark_private_slices(dag)
+  if rewrites is not None:
+    before = dict((node.expr_id, _node_key(node)) for node in dag_nodes(dag))
+    for p in passes:
+      dag = apply_pass(p, dag)
+      if getattr(FLAGS, 'opt_' + p.name):
+        before = _record_rewrites(p.name, before, dag, rewrites)
+    return dag
+
+  fingerprint, plan = None, None
+  if FLAGS.plan_cache_size > 0:
+    fingerprint = PlanFingerprint.create(dag)
+
+  if fingerprint is not None:
+    key = _plan_key(fingerprint)
+    plan = _plans.pop(key, None)
+    if plan is not None:
+      _plans[key] = plan
+
+  if plan is not None:
+    util.log_debug('Optimization: reusing cached plan')
+    dag = plan.bind(fingerprint)
+  else:
+    util.log_debug('Optimization: applying %d passes', len(passes))
+    for p in passes:
+      if p.plan_cached:
+        dag = apply_pass(p, dag)
+    if fingerprint is not None:
+      _plans[key] = CachedPlan(dag, fingerprint)
+      while len(_plans) > FLAGS.plan_cache_size:
+        _plans.popitem(last=False)
 
+  for p in passes:
+    if not p.plan_cached:
+      dag = apply_pass(p, dag)
   return dag
 
 
@@ -927,11 +1718,16 @@ def add_optimization(klass, default):
   #util.log_info('Passes: %s', passes)
 
 add_optimization(CollapsedCachedExpressions, True)
+add_optimization(CommonSubexpressionElimination, True)
+add_optimization(SlicePushdown, True)
 add_optimization(AutomaticTiling, True)
 add_optimization(RotateSlice, False)
 add_optimization(MapMapFusion, True)
 if parakeet is not None:
   add_optimization(ParakeetGeneration, False)
 add_optimization(ReduceMapFusion, True)
+# passes which are not plan_cached must come last.
+add_optimization(ConstantFolding, True)
+add_optimization(BlockedEvaluation, True)
 
 FLAGS.add(BoolFlag('optimization', default=True))
@@ -93,7 +93,8 @@ class OuterProductExpr(Expr):
     target = distarray.create(shape, dtype,
                               sharder=None, reducer=reducer,
                               tile_hint=tile_hint,
-                              sparse=(arrays[0].sparse and arrays[1].sparse))
+                              sparse=(arrays[0].sparse and arrays[1].sparse),
+                              kernel_type=outer_mapper.__name__)
 
     arrays[0].foreach_tile(mapper_fn=outer_mapper,
                            kw=dict(arrays=arrays, axes=axes, local_user_fn=fn,
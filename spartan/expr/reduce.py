@@ -8,7 +8,7 @@ import numpy as np
 import collections
 
 from ..array import extent, distarray
-from ..expr.local import make_var, LocalExpr, LocalReduceExpr, LocalInput, LocalCtx
+from ..expr.local import make_var, LocalExpr, LocalReduceExpr, LocalInput, LocalCtx, is_elementwise
 from spartan.node import indent
 from ..util import Assert
 from . import broadcast
@@ -16,10 +16,19 @@ from .base import Expr, ListExpr
 from ..core import LocalKernelResult
 from traits.api import Instance, Function, PythonValue
 
-def _reduce_mapper(ex, children, child_to_var, op, axis, output):
+def _elementwise_input(kw):
+  return all(isinstance(d, LocalInput) or is_elementwise(d) for d in kw['op'].deps)
+
+
+@distarray.splittable
+@distarray.batchable(_elementwise_input)
+def _reduce_mapper(ex, children, child_to_var, op, axis, output, _batch=None):
   '''Run a local reducer for a tile, and update the appropiate
   portion of the output array.
 
+  Reducers work on any extent, so batched calls (``_batch``) reduce
+  the union of the tiles at once.
+
   N.B. Scipy sparse matrices DO NOT support dimensions != 2.
   As a result, naive reductions over these matrices will fail
   as the local reduction value will not have the correct
@@ -112,7 +121,8 @@ class ReduceExpr(Expr):
     shape = extent.shape_for_reduction(children[0].shape, axis)
 
     output_array = distarray.create(shape, dtype,
-                                    reducer=tile_accum, tile_hint=self.tile_hint)
+                                    reducer=tile_accum, tile_hint=self.tile_hint,
+                                    kernel_type=_reduce_mapper.__name__)
 
   # util.log_info('Reducing into array %s', output_array)
     largest.foreach_tile(_reduce_mapper, kw={'children' : children,
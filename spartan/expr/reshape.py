@@ -125,7 +125,7 @@ class Reshape(distarray.DistArray):
                                                   self.shape)
     return extent.create(unravelled_ul, np.array(unravelled_lr) + 1, self.shape)
 
-  def foreach_tile(self, mapper_fn, kw=None):
+  def foreach_tile(self, mapper_fn, kw=None, combiner=None):
     if kw is None: kw = {}
     kw['array'] = self
     kw['user_fn'] = mapper_fn
@@ -140,7 +140,7 @@ class Reshape(distarray.DistArray):
                                             sparse=self.base.sparse)
       tiles = self.shape_array.tiles.values()
 
-    return blob_ctx.get().map(tiles, mapper_fn=_tile_mapper, kw=kw)
+    return blob_ctx.get().map(tiles, mapper_fn=_tile_mapper, kw=kw, combiner=combiner)
 
   def extent_for_blob(self, id):
     base_ex = self.base.blob_to_ex[id]
@@ -0,0 +1,337 @@
+'''
+Evaluation of expression graphs.
+
+`evaluate_dag` sorts the expressions an `Expr` depends on topologically,
+and evaluates them in dependency order.  Expressions which do not depend on
+each other (e.g. both operands of a `dot`) may be evaluated concurrently,
+up to ``--max_concurrent_kernels`` at a time; this keeps the cluster busy
+when a single kernel does not saturate it.
+
+Evaluations started from inside an expression (e.g. keyword arguments
+of a map function) are run serially in the calling thread.
+
+Kernels started without waiting (see ``--pipeline_kernels``) are joined
+before the evaluation returns.
+
+With ``--release_intermediates``, the result of an intermediate expression
+is dropped (and its tiles freed) as soon as the last expression using it
+has been evaluated, so peak memory is bounded by the live frontier of the
+graph rather than the whole graph.  Results of the expression being
+evaluated, of expressions the user has evaluated before or marked with
+`base.keep`, and of random or uninitialized arrays, stay cached.
+
+Cached results record how long they took to compute, which the cache
+uses to choose victims under ``--eval_cache_bytes``.
+
+`profile_nodes` records the wall time and kernels of each expression
+evaluated (see `explain`).
+'''
+
+import collections
+import Queue
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from .. import blob_ctx, util
+from ..array import distarray
+from ..config import FLAGS, BoolFlag, IntFlag
+from ..rpc import TimeoutException
+from .base import Expr, eval_cache, user_held
+
+FLAGS.add(IntFlag('max_concurrent_kernels', default=1,
+                  help='Maximum number of independent expressions evaluated at the same time'))
+FLAGS.add(BoolFlag('release_intermediates', default=False,
+                   help='Free intermediate results once no remaining expression needs them'))
+
+_state = threading.local()
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+
+def _get_pool(size):
+  '''Return a pool of ``size`` threads, replacing the old pool if its size differs.'''
+  global _pool, _pool_size
+  with _pool_lock:
+    if _pool is None or _pool_size != size:
+      if _pool is not None:
+        # evaluations still using the old pool finish their work on it.
+        _pool.close()
+      _pool = ThreadPool(processes=size)
+      _pool_size = size
+    return _pool
+
+
+def _children(node):
+  '''Return the `Expr` dependencies of ``node``.'''
+  return [v for v in node.dependencies().itervalues() if isinstance(v, Expr)]
+
+
+def topological_sort(root):
+  '''
+  Return the expressions which must be evaluated to compute ``root``.
+
+  Expressions with a valid cached value are not descended into.
+
+  :param root: `Expr`
+  :rtype: (order, children, values): ``order`` lists expressions to evaluate
+    with dependencies before their users, ``children`` maps from expression
+    id to the ids of its dependencies, and ``values`` holds the cached values
+    found, keyed by expression id.
+  '''
+  order, children, values = [], {}, {}
+  visited = set()
+  stack = [(root, False)]
+  while stack:
+    node, expanded = stack.pop()
+    if expanded:
+      order.append(node)
+      continue
+    if node.expr_id in visited:
+      continue
+    visited.add(node.expr_id)
+
+    cached = node.cache()
+    if cached is not None:
+      values[node.expr_id] = cached
+      continue
+
+    deps = _children(node)
+    children[node.expr_id] = [d.expr_id for d in deps]
+    stack.append((node, True))
+    for d in reversed(deps):
+      if d.expr_id not in visited:
+        stack.append((d, False))
+  return order, children, values
+
+
+def _must_keep(node):
+  '''Expressions whose results are never released: re-evaluating them would differ.'''
+  from .optimize import is_not_idempotent
+  from .ndarray import NdArrayExpr
+  from .checkpoint import CheckpointExpr
+  return isinstance(node, (NdArrayExpr, CheckpointExpr)) or is_not_idempotent(node)
+
+
+def _releasable(order, root):
+  '''
+  Return the ids of expressions in ``order`` whose results may be dropped
+  after their last use.
+
+  Cached results are kept for ``root``, and for expressions user code
+  holds on to (see `base.keep`).
+  '''
+  if not FLAGS.release_intermediates:
+    return set()
+  held = user_held(order)
+  releasable = set()
+  for node in order:
+    if node is root or _must_keep(node):
+      continue
+    if node.needs_cache and node.expr_id in held:
+      continue
+    releasable.add(node.expr_id)
+  return releasable
+
+
+def _shares_tiles(a, b):
+  if not isinstance(a, distarray.DistArrayImpl) or not isinstance(b, distarray.DistArrayImpl):
+    return False
+  return not set(a.tiles.itervalues()).isdisjoint(b.tiles.itervalues())
+
+
+class _LastUse(object):
+  '''Releases the results of intermediate expressions after their last use.'''
+  def __init__(self, order, children, values, root):
+    self.values = values
+    self.children = children
+    self.releasable = _releasable(order, root)
+    self.users = collections.defaultdict(list)
+    for node in order:
+      for c in set(children[node.expr_id]):
+        self.users[c].append(node.expr_id)
+    self.remaining = dict((c, len(u)) for c, u in self.users.iteritems())
+
+  def done(self, node):
+    '''Called once ``node`` has been evaluated.'''
+    for c in set(self.children[node.expr_id]):
+      self.remaining[c] -= 1
+      if self.remaining[c] > 0 or c not in self.releasable:
+        continue
+      value = self.values.get(c)
+      # a user may reuse the tiles of its input (e.g. identity maps).
+      if any(_shares_tiles(value, self.values.get(u)) for u in self.users[c]):
+        continue
+      del self.values[c]
+      eval_cache.release(c)
+
+
+def profile_nodes(stats):
+  '''
+  Record the evaluation of each expression evaluated by the calling thread
+  into ``stats`` (None stops recording).
+
+  ``stats`` maps from expression id to a dict with the wall time
+  (``seconds``) of the evaluation and the ``kernels`` it ran (see
+  `BlobCtx.collect_kernel_stats`).  Returns the previous value.
+  '''
+  previous = getattr(_state, 'profile', None)
+  _state.profile = stats
+  return previous
+
+
+def evaluate_node(node, values):
+  '''
+  Evaluate a single expression, given the values of its dependencies.
+
+  :param node: `Expr`
+  :param values: dictionary from expression id to value.
+  '''
+  profile = getattr(_state, 'profile', None)
+  if profile is None:
+    return _evaluate_node(node, values)
+
+  ctx = blob_ctx.get()
+  kernels = []
+  previous = ctx.collect_kernel_stats(kernels)
+  start = time.time()
+  try:
+    return _evaluate_node(node, values)
+  finally:
+    ctx.collect_kernel_stats(previous)
+    profile[node.expr_id] = {'seconds': time.time() - start, 'kernels': kernels}
+
+
+def _evaluate_node(node, values):
+  ctx = blob_ctx.get()
+  deps = {}
+  for k, vs in node.dependencies().iteritems():
+    if isinstance(vs, Expr):
+      deps[k] = values[vs.expr_id]
+    else:
+      deps[k] = vs
+
+  start = time.time()
+  try:
+    value = node._evaluate(ctx, deps)
+  except TimeoutException:
+    util.log_info('%s %d need to retry', node.__class__, node.expr_id)
+    return node.evaluate()
+  except Exception:
+    print >>sys.stderr, 'Error executing expression'
+    node.stack_trace.dump()
+    raise
+
+  if node.needs_cache:
+    #util.log_info('Caching %s -> %s', node.expr_id, value)
+    eval_cache.set(node.expr_id, value, cost=time.time() - start,
+                   recomputable=not _must_keep(node))
+  return value
+
+
+def _run_serial(order, values, last_use):
+  for node in order:
+    values[node.expr_id] = evaluate_node(node, values)
+    last_use.done(node)
+
+
+def _join_pending(ctx, failed=False):
+  '''Wait for the pipelined kernels started by this thread.'''
+  if not failed:
+    ctx.join_pending()
+    return
+  try:
+    ctx.join_pending()
+  except Exception:
+    util.log_warn('Pipelined kernel failed', exc_info=1)
+
+
+def _run_task(ctx, job, profile, node, values, done):
+  blob_ctx.set(ctx)
+  blob_ctx.set_job(job)
+  _state.active = True
+  _state.profile = profile
+  try:
+    value = evaluate_node(node, values)
+    _join_pending(ctx)
+    done.put((node, value, None))
+  except:
+    exc_info = sys.exc_info()
+    _join_pending(ctx, failed=True)
+    done.put((node, None, exc_info))
+
+
+def _run_concurrent(order, children, values, last_use):
+  '''Evaluate ``order``, launching expressions as soon as their dependencies are done.'''
+  ctx = blob_ctx.get()
+  job = blob_ctx.current_job()
+  profile = getattr(_state, 'profile', None)
+  limit = FLAGS.max_concurrent_kernels
+  pool = _get_pool(limit)
+  done = Queue.Queue()
+
+  waiting = dict((node.expr_id, set(c for c in children[node.expr_id] if c not in values))
+                 for node in order)
+  users = {}
+  for node in order:
+    for c in waiting[node.expr_id]:
+      users.setdefault(c, []).append(node)
+
+  ready = [node for node in order if not waiting[node.expr_id]]
+  running = 0
+  error = None
+  while ready or running:
+    while ready and error is None and running < limit:
+      node = ready.pop(0)
+      pool.apply_async(_run_task, args=(ctx, job, profile, node, values, done))
+      running += 1
+    if running == 0:
+      break
+
+    node, value, exc_info = done.get()
+    running -= 1
+    if exc_info is not None:
+      # stop launching new work; wait for the expressions already running.
+      error = error or exc_info
+      continue
+    values[node.expr_id] = value
+    last_use.done(node)
+    for user in users.get(node.expr_id, []):
+      waiting[user.expr_id].discard(node.expr_id)
+      if not waiting[user.expr_id]:
+        ready.append(user)
+
+  if error is not None:
+    raise error[0], error[1], error[2]
+
+
+def evaluate_dag(root):
+  '''
+  Evaluate ``root`` and all of its (uncached) dependencies.
+
+  :param root: `Expr`
+  '''
+  order, children, values = topological_sort(root)
+  if root.expr_id in values:
+    return values[root.expr_id]
+
+  last_use = _LastUse(order, children, values, root)
+  nested = getattr(_state, 'active', False)
+  if FLAGS.max_concurrent_kernels <= 1 or nested or len(order) == 1:
+    _state.active = True
+    try:
+      _run_serial(order, values, last_use)
+    except:
+      exc_info = sys.exc_info()
+      if not nested:
+        _join_pending(blob_ctx.get(), failed=True)
+      raise exc_info[0], exc_info[1], exc_info[2]
+    finally:
+      _state.active = nested
+    if not nested:
+      _join_pending(blob_ctx.get())
+  else:
+    _run_concurrent(order, children, values, last_use)
+  return values[root.expr_id]
@@ -9,15 +9,34 @@ from .base import Expr, lazify
 from traits.api import Instance, Function, PythonValue, HasTraits
 from .base import DictExpr, NotShapeable
 
-def shuffle(v, fn, cost_hint=None, shape_hint=None, target=None, kw=None):
+_tile_loaders = set()
+
+def tile_loader(fn):
+  '''
+  Mark the `shuffle` function ``fn`` as loading the extent it is given of
+  a saved array.  Given the ``offset`` and ``shape`` keywords, it must load
+  the extent moved by ``offset`` in the saved array of ``shape`` instead,
+  so that slices of the array can be loaded directly (see
+  `optimize.SlicePushdown`).
+  '''
+  _tile_loaders.add(fn)
+  return fn
+
+def shuffle(v, fn, cost_hint=None, shape_hint=None, target=None, kw=None, shape_fn=None):
   '''
   Evaluate ``fn`` over each extent of ``v``.
 
+  Without a ``target``, the shape of the result depends on the extents
+  ``fn`` returns; declare it with ``shape_hint`` or ``shape_fn`` so that it
+  can be known without evaluating the shuffle.
+
   Args:
     v (Expr or DistArray): Source array to map over.
     fn (function): Function from  ``(DistArray, extent, **kw)`` to list of ``(new_extent, new_data)``
+    shape_hint (tuple): Optional. The shape of the result.
     target (Expr): Optional. If specified, the output of ``fn`` will be written into ``target``.
     kw (dict): Optional. Keyword arguments to pass to ``fn``.
+    shape_fn (function): Optional. Function from the shape of ``v`` to the shape of the result.
   Returns:
     ShuffleExpr:
   '''
@@ -35,7 +54,8 @@ def shuffle(v, fn, cost_hint=None, shape_hint=None, target=None, kw=None):
                      cost_hint=cost_hint,
                      shape_hint=shape_hint,
                      target=target,
-                     fn_kw=kw)
+                     fn_kw=kw,
+                     shape_fn=shape_fn)
 
 def target_mapper(ex, map_fn=None, source=None, target=None, fn_kw=None):
   '''
@@ -103,6 +123,7 @@ class ShuffleExpr(Expr):
   cost_hint = PythonValue(None, desc='Dict or None')
   shape_hint = PythonValue(None, desc='Tuple or None')
   fn_kw = PythonValue(None, desc='DictExpr')
+  shape_fn = PythonValue(None, desc='Function or None')
 
   def __str__(self):
     cost_str = '{ %s }' % ',\n'.join(['%s: %s' % (hash(k), v) for k, v in self.cost_hint.iteritems()])
@@ -130,6 +151,8 @@ class ShuffleExpr(Expr):
       return self.target.shape
     elif self.shape_hint != None:
       return self.shape_hint
+    elif self.shape_fn is not None:
+      return tuple(self.shape_fn(self.array.shape))
     else:
       # We don't know the shape after shuffle.
       raise NotShapeable
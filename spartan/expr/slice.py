@@ -3,7 +3,7 @@ from . import broadcast
 from ..util import Assert
 from ..array import distarray, extent
 from . import base
-from traits.api import Instance, Tuple, PythonValue
+from traits.api import Bool, Instance, Tuple, PythonValue
 
 
 def _slice_mapper(ex, **kw):
@@ -69,11 +69,12 @@ class Slice(distarray.DistArray):
   def tile_shape(self):
     return self._tile_shape
 
-  def foreach_tile(self, mapper_fn, kw):
+  def foreach_tile(self, mapper_fn, kw, combiner=None):
     return self.base.foreach_tile(mapper_fn = _slice_mapper,
                                     kw={'fn_kw' : kw,
                                         '_slice_extent' : self.slice,
-                                        '_slice_fn' : mapper_fn })
+                                        '_slice_fn' : mapper_fn },
+                                    combiner=combiner)
 
   def extent_for_blob(self, id):
     base_ex = self.base.blob_to_ex[id]
@@ -91,10 +92,13 @@ class SliceExpr(base.Expr):
     src: `Expr` to index into
     idx: `tuple` (for slicing) or `Expr` (for bool/integer indexing)
     broadcast_to: shape to broadcast to before slicing
+    private_src: True if nothing but this slice uses ``src``, so its value
+      may be computed for the slice only; set by `optimize`.
   '''
   src = Instance(base.Expr)
   idx = PythonValue(None, desc="Tuple or Expr")
   broadcast_to = PythonValue
+  private_src = Bool(False)
 
   def __init__(self, *args, **kw):
     super(SliceExpr, self).__init__(*args, **kw)
@@ -104,7 +108,7 @@ class SliceExpr(base.Expr):
 
   def compute_shape(self):
     if isinstance(self.idx, (int, long, slice, tuple)):
-      src_shape = self.src.compute_shape()
+      src_shape = self.src.shape
       ex = extent.from_shape(src_shape)
       slice_ex = extent.compute_slice(ex, self.idx)
       return slice_ex.shape
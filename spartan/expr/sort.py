@@ -27,6 +27,13 @@ def _sample_sort_mapper(array, ex, sample_rate, local_sorted_array):
   yield None, samples
 
 
+def _concat_samples(a, b):
+  '''
+  combine the sample lists of two sets of tiles into a single sample array.
+  '''
+  return [np.concatenate(a + b)]
+
+
 def _partition_count_mapper(array, ex, partition_keys):
   '''
   given the partition keys, calculate the index of each partition key in the local tile.
@@ -94,7 +101,9 @@ def sort(array, axis=-1, sample_rate=0.1):
 
   # sample the original array
   local_sorted_array = ndarray(array.shape, dtype=array.dtype, tile_hint=array.tile_shape()).force()
-  samples = tile_operation(array, fn=_sample_sort_mapper, kw={'sample_rate': sample_rate, 'local_sorted_array': local_sorted_array}).force().values()
+  samples = tile_operation(array, fn=_sample_sort_mapper,
+                           kw={'sample_rate': sample_rate, 'local_sorted_array': local_sorted_array},
+                           combiner=_concat_samples).force()
   sorted_samples = np.sort(np.concatenate(samples), axis=None)
 
   # calculate the partition keys, generate the index of each partition key in each tile.
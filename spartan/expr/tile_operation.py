@@ -5,7 +5,7 @@ from .base import Expr, lazify
 from traits.api import Instance, Function, PythonValue
 from .base import DictExpr, NotShapeable
 
-def tile_operation(v, fn, kw=None):
+def tile_operation(v, fn, kw=None, combiner=None, shape_fn=None):
   '''
   Evaluate ``fn`` over each extent of ``v`` and directly return results to master when it is evaluated.
   
@@ -13,6 +13,12 @@ def tile_operation(v, fn, kw=None):
     v (Expr or DistArray): Source array to map over.
     fn (function): Function from  ``(DistArray, extent, **kw)`` to list of ``(new_data)``
     kw (dict): Optional. Keyword arguments to pass to ``fn``.    
+    combiner (function): Optional. Function from ``(result, result)`` to ``result``, 
+      used to merge the per-tile result lists on the workers (e.g. `blob_ctx.concat`). 
+      If specified, the expression evaluates to the single combined result instead 
+      of a dictionary from tile to result.
+    shape_fn (function): Optional. Function from the shape of ``v`` to the shape
+      of the (combined) result, so that it is known without evaluation.
   Returns:
     TileOpExpr:
   '''
@@ -25,7 +31,9 @@ def tile_operation(v, fn, kw=None):
   
   return TileOpExpr(array=v,
                     map_fn=fn,
-                    fn_kw=kw)
+                    fn_kw=kw,
+                    combiner=combiner,
+                    shape_fn=shape_fn)
   
 def tile_op_mapper(ex, map_fn=None, source=None, fn_kw=None):
   '''
@@ -55,6 +63,8 @@ class TileOpExpr(Expr):
   array = PythonValue(None, desc="DistArray or Expr")
   map_fn = Function
   fn_kw = Instance(DictExpr) 
+  combiner = PythonValue(None)
+  shape_fn = PythonValue(None)
   
   def __str__(self):
     return 'tile_operation[%d](%s, %s)' % (self.expr_id, self.map_fn, self.array)
@@ -68,9 +78,12 @@ class TileOpExpr(Expr):
     map_fn = self.map_fn
     
     return v.foreach_tile(mapper_fn = tile_op_mapper,
-                          kw = dict(map_fn=map_fn, source=v, fn_kw=fn_kw))
+                          kw = dict(map_fn=map_fn, source=v, fn_kw=fn_kw),
+                          combiner = self.combiner)
       
 
   def compute_shape(self):
-      # We don't know the shape after the tile operation.
-      raise NotShapeable
+    if self.shape_fn is not None:
+      return tuple(self.shape_fn(self.array.shape))
+    # We don't know the shape after the tile operation.
+    raise NotShapeable
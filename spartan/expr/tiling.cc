@@ -1,144 +1,308 @@
+/*
+ * Min-cost layout assignment for `AutomaticTiling` (see optimize.py).
+ *
+ * The expression graph is given as a DAG of nodes, each with a list of
+ * candidate layouts and the cost of choosing each one, and edges from a
+ * child to a parent carrying the cost of every (child layout, parent
+ * layout) pair.  We choose one layout per node, minimizing the sum of the
+ * node and edge costs.
+ *
+ * The solver is exact on trees: a bottom-up pass computes, for each node
+ * and layout, the cheapest cost of its subtree, and a top-down pass picks
+ * the layouts.  Nodes shared by several parents are assigned once, taking
+ * all of their (already assigned) parents into account, and the result is
+ * then improved by re-choosing single nodes until no choice lowers the
+ * total cost.
+ *
+ * Identical subgraphs (same costs, and identical children) are hash-consed
+ * into one class, so their subtree tables are computed once.
+ *
+ * All state lives in a `Solver` created per call, and the GIL is released
+ * while solving, so concurrent optimizations can share this module.
+ */
 #include <Python.h>
-#include <unordered_map>
-#include <list>
 
-const int eMax = 1000000;
-const int nMax = 5000;
-const int INF = 1000000000;
+#include <algorithm>
+#include <limits>
+#include <map>
+#include <utility>
+#include <vector>
 
-struct Edge {
-    int u, v, next;
-    long cost;
-} edge[eMax];
-
-std::unordered_map<int, int> split_nodes;
-int e, head[nMax];
-long mincost, dis[nMax];
-bool vis[nMax];
-
-void add_edge(int u, int v, long cost) {
-	edge[e].u = u; edge[e].v = v; edge[e].cost = cost;
-    edge[e].next = head[u]; head[u] = e++;
+typedef long long cost_t;
+typedef std::vector<cost_t> Costs;
+
+static const cost_t INF = std::numeric_limits<cost_t>::max() / 4;
+static const int MAX_SWEEPS = 16;
+
+static inline cost_t add_cost(cost_t a, cost_t b) {
+  cost_t s = a + b;
+  return s > INF ? INF : s;
 }
 
-void print_choices(int s, int t, bool* vis, long mincost) {
-	printf("%d choose (cost=%ld):", s, mincost);
-	for (int u = 0; u <= t; u++)
-		if (vis[u]) printf("%d ", u);
-	printf("\n");
+struct Edge {
+  int child, parent;
+  Costs costs;  // costs[child_layout * parent_layouts + parent_layout]
+};
+
+struct Graph {
+  std::vector<Costs> node_costs;
+  std::vector<Edge> edges;
+
+  int num_nodes() const { return (int)node_costs.size(); }
+  int layouts(int node) const { return (int)node_costs[node].size(); }
+  cost_t edge_cost(const Edge& e, int child_layout, int parent_layout) const {
+    return e.costs[child_layout * layouts(e.parent) + parent_layout];
+  }
+};
+
+class Solver {
+ public:
+  explicit Solver(const Graph& g) : g_(g) {
+    int n = g_.num_nodes();
+    in_edges_.resize(n);
+    out_edges_.resize(n);
+    for (size_t i = 0; i < g_.edges.size(); i++) {
+      in_edges_[g_.edges[i].parent].push_back((int)i);
+      out_edges_[g_.edges[i].child].push_back((int)i);
+    }
+  }
+
+  // Returns false if the graph has a cycle.
+  bool solve(std::vector<int>* choice) {
+    if (!topological_order()) return false;
+    compute_tables();
+    assign(choice);
+    improve(choice);
+    return true;
+  }
+
+ private:
+  typedef std::pair<int, Costs> ChildKey;
+  typedef std::pair<Costs, std::vector<ChildKey> > ClassKey;
+
+  bool topological_order() {
+    int n = g_.num_nodes();
+    std::vector<int> pending(n);
+    order_.clear();
+    for (int v = 0; v < n; v++) {
+      pending[v] = (int)in_edges_[v].size();
+      if (pending[v] == 0) order_.push_back(v);
+    }
+    for (size_t i = 0; i < order_.size(); i++) {
+      const std::vector<int>& out = out_edges_[order_[i]];
+      for (size_t j = 0; j < out.size(); j++) {
+        int p = g_.edges[out[j]].parent;
+        if (--pending[p] == 0) order_.push_back(p);
+      }
+    }
+    return (int)order_.size() == n;
+  }
+
+  // Cost of the cheapest subtree below edge ``e`` if its parent takes ``parent_layout``.
+  cost_t child_cost(const Edge& e, int parent_layout) const {
+    const Costs& table = tables_[class_[e.child]];
+    cost_t best = INF;
+    for (int l = 0; l < g_.layouts(e.child); l++)
+      best = std::min(best, add_cost(table[l], g_.edge_cost(e, l, parent_layout)));
+    return best;
+  }
+
+  void compute_tables() {
+    class_.assign(g_.num_nodes(), -1);
+    for (size_t i = 0; i < order_.size(); i++) {
+      int v = order_[i];
+      ClassKey key;
+      key.first = g_.node_costs[v];
+      for (size_t j = 0; j < in_edges_[v].size(); j++) {
+        const Edge& e = g_.edges[in_edges_[v][j]];
+        key.second.push_back(ChildKey(class_[e.child], e.costs));
+      }
+      std::sort(key.second.begin(), key.second.end());
+
+      std::map<ClassKey, int>::iterator it = classes_.find(key);
+      if (it != classes_.end()) {
+        class_[v] = it->second;
+        continue;
+      }
+
+      Costs table(g_.node_costs[v]);
+      for (int l = 0; l < g_.layouts(v); l++)
+        for (size_t j = 0; j < in_edges_[v].size(); j++)
+          table[l] = add_cost(table[l], child_cost(g_.edges[in_edges_[v][j]], l));
+      class_[v] = (int)tables_.size();
+      tables_.push_back(table);
+      classes_[key] = class_[v];
+    }
+  }
+
+  void assign(std::vector<int>* choice) {
+    choice->assign(g_.num_nodes(), -1);
+    for (size_t i = order_.size(); i-- > 0;) {
+      int v = order_[i];
+      const Costs& table = tables_[class_[v]];
+      cost_t best = INF + 1;
+      for (int l = 0; l < g_.layouts(v); l++) {
+        cost_t c = table[l];
+        for (size_t j = 0; j < out_edges_[v].size(); j++) {
+          const Edge& e = g_.edges[out_edges_[v][j]];
+          c = add_cost(c, g_.edge_cost(e, l, (*choice)[e.parent]));
+        }
+        if (c < best) {
+          best = c;
+          (*choice)[v] = l;
+        }
+      }
+    }
+  }
+
+  cost_t local_cost(int v, int l, const std::vector<int>& choice) const {
+    cost_t c = g_.node_costs[v][l];
+    for (size_t j = 0; j < in_edges_[v].size(); j++) {
+      const Edge& e = g_.edges[in_edges_[v][j]];
+      c = add_cost(c, g_.edge_cost(e, choice[e.child], l));
+    }
+    for (size_t j = 0; j < out_edges_[v].size(); j++) {
+      const Edge& e = g_.edges[out_edges_[v][j]];
+      c = add_cost(c, g_.edge_cost(e, l, choice[e.parent]));
+    }
+    return c;
+  }
+
+  void improve(std::vector<int>* choice) {
+    for (int sweep = 0; sweep < MAX_SWEEPS; sweep++) {
+      bool changed = false;
+      for (size_t i = 0; i < order_.size(); i++) {
+        int v = order_[i];
+        cost_t current = local_cost(v, (*choice)[v], *choice);
+        for (int l = 0; l < g_.layouts(v); l++) {
+          cost_t c = local_cost(v, l, *choice);
+          if (c < current) {
+            current = c;
+            (*choice)[v] = l;
+            changed = true;
+          }
+        }
+      }
+      if (!changed) break;
+    }
+  }
+
+  const Graph& g_;
+  std::vector<std::vector<int> > in_edges_, out_edges_;
+  std::vector<int> order_;
+  std::vector<int> class_;
+  std::vector<Costs> tables_;
+  std::map<ClassKey, int> classes_;
+};
+
+static bool parse_costs(PyObject* obj, Costs* costs) {
+  PyObject* seq = PySequence_Fast(obj, "expected a sequence of costs");
+  if (seq == NULL) return false;
+  Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+  costs->resize(n);
+  for (Py_ssize_t i = 0; i < n; i++) {
+    PyObject* num = PyNumber_Long(PySequence_Fast_GET_ITEM(seq, i));
+    if (num == NULL) {
+      Py_DECREF(seq);
+      return false;
+    }
+    cost_t c = PyLong_AsLongLong(num);
+    Py_DECREF(num);
+    if (c == -1 && PyErr_Occurred()) {
+      Py_DECREF(seq);
+      return false;
+    }
+    (*costs)[i] = std::max((cost_t)0, std::min(c, INF));
+  }
+  Py_DECREF(seq);
+  return true;
 }
 
-long find_mincost_tiling(int s, int t, bool* vis) {
-	long mincost = 0;
-    int i, j, v, sp_v, size;
-	std::list<int> child_edges;
-	for (i = head[s]; i != -1; i = edge[i].next) child_edges.push_back(i);
-	size = child_edges.size();
-
-	while (!child_edges.empty()) {
-		i = child_edges.front(); child_edges.pop_front(); size --;
-		v = edge[i].v;
-
-		if (split_nodes.find(v) != split_nodes.end()) { // splited node
-			sp_v = split_nodes[v];
-
-			// find split edge j
-			for (j = edge[i].next; j != -1 && edge[j].v != sp_v; j=edge[j].next);
-
-			if (j < 0) {   // not a two-edges-choose-one case
-				if (vis[v] or vis[sp_v])
-					mincost += (vis[v])? edge[i].cost : INF;
-				else {
-					dis[v] = find_mincost_tiling(v, t, vis);
-					mincost += dis[v] + edge[i].cost;
-					vis[v] = true;
-				}
-			} else {      // two edges we can only choose one
-				child_edges.remove(j); size --;
-				if (vis[v] or vis[sp_v])
-					mincost += (vis[v])? edge[i].cost : edge[j].cost;
-				else {
-					bool vis1[nMax], vis2[nMax];
-					memcpy(vis1, vis, t * sizeof(bool));
-					memcpy(vis2, vis, t * sizeof(bool));
-					dis[v] = find_mincost_tiling(v, t, vis1);
-					dis[sp_v] = find_mincost_tiling(sp_v, t, vis2);
-					long cmp = dis[v] + edge[i].cost - dis[sp_v] - edge[j].cost;
-                    if (cmp == 0 && size > 0) {
-						child_edges.push_back(i);
-						child_edges.push_back(j);
-					} else if (cmp < 0) {
-						mincost += dis[v] + edge[i].cost;
-						memcpy(vis, vis1, t * sizeof(bool));
-						vis[v] = true;
-					} else {
-						mincost += dis[sp_v] + edge[j].cost;
-						memcpy(vis, vis2, t * sizeof(bool));
-						vis[sp_v] = true;
-					}
-				}
-			}
-		} else { // all must be chosen case
-			if (vis[v]) mincost += edge[i].cost;
-			else {
-				dis[v] = find_mincost_tiling(v, t, vis);
-				mincost += dis[v] + edge[i].cost;
-				vis[v] = true;
-			}
-		}
-	}
-	//print_choices(s, t, vis, mincost);
-	return mincost;
+static bool parse_graph(PyObject* node_costs, PyObject* edges, Graph* g) {
+  PyObject* seq = PySequence_Fast(node_costs, "node_costs must be a sequence");
+  if (seq == NULL) return false;
+  Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+  g->node_costs.resize(n);
+  for (Py_ssize_t i = 0; i < n; i++) {
+    if (!parse_costs(PySequence_Fast_GET_ITEM(seq, i), &g->node_costs[i])) {
+      Py_DECREF(seq);
+      return false;
+    }
+    if (g->node_costs[i].empty()) {
+      Py_DECREF(seq);
+      PyErr_Format(PyExc_ValueError, "node %zd has no layouts", i);
+      return false;
+    }
+  }
+  Py_DECREF(seq);
+
+  seq = PySequence_Fast(edges, "edges must be a sequence");
+  if (seq == NULL) return false;
+  Py_ssize_t m = PySequence_Fast_GET_SIZE(seq);
+  g->edges.resize(m);
+  for (Py_ssize_t i = 0; i < m; i++) {
+    Edge& e = g->edges[i];
+    PyObject* costs;
+    if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(seq, i), "iiO", &e.child, &e.parent, &costs) ||
+        !parse_costs(costs, &e.costs)) {
+      Py_DECREF(seq);
+      return false;
+    }
+    if (e.child < 0 || e.child >= n || e.parent < 0 || e.parent >= n) {
+      Py_DECREF(seq);
+      PyErr_Format(PyExc_ValueError, "edge %zd refers to an unknown node", i);
+      return false;
+    }
+    if ((Py_ssize_t)e.costs.size() != (Py_ssize_t)g->layouts(e.child) * g->layouts(e.parent)) {
+      Py_DECREF(seq);
+      PyErr_Format(PyExc_ValueError, "edge %zd needs %d x %d costs", i,
+                   g->layouts(e.child), g->layouts(e.parent));
+      return false;
+    }
+  }
+  Py_DECREF(seq);
+  return true;
 }
 
-static PyObject* mincost_tiling(PyObject *self, PyObject *args) {
-	PyObject *list, *ans;
-	Py_ssize_t pos;
-	int t, u, v;
-    long cost;
-
-	// init t node
-	t = (int)PyInt_AsLong(PyTuple_GetItem(args, 0));
-
-	// init edges
-	e = 0;
-	memset(head, -1, sizeof(head));
-	list = PyTuple_GetItem(args, 1);
-	for (pos = 0; pos < PyList_Size(list); pos++) {
-		PyArg_ParseTuple(PyList_GetItem(list, pos), "iik", &u, &v, &cost);
-		add_edge(u, v, cost);
-		//printf("add edge:(%d, %d, cost=%ld)\n", u, v, cost);
-	}
-
-	// init splited nodes
-	split_nodes.clear();
-	list = PyTuple_GetItem(args, 2);
-	for (pos = 0; pos < PyList_Size(list); pos++) {
-		PyArg_ParseTuple(PyList_GetItem(list, pos), "ii", &u, &v);
-		split_nodes[u] = v;
-		split_nodes[v] = u;
-		//printf("add split nodes:(%d, %d)\n", u, v);
-	}
-
-	memset(vis, false, sizeof(vis));
-	mincost = find_mincost_tiling(0, t, vis);
-
-	ans = PyList_New(0);
-	for (u = 0; u < t; u++)
-		if (vis[u]) PyList_Append(ans, Py_BuildValue("i", u));
-
-	//printf("mincost:%ld\n", mincost);
-	return ans;
+static PyObject* mincost_layouts(PyObject* self, PyObject* args) {
+  PyObject *node_costs, *edges;
+  if (!PyArg_ParseTuple(args, "OO", &node_costs, &edges)) return NULL;
+
+  Graph g;
+  if (!parse_graph(node_costs, edges, &g)) return NULL;
+
+  std::vector<int> choice;
+  bool ok;
+  Py_BEGIN_ALLOW_THREADS
+  Solver solver(g);
+  ok = solver.solve(&choice);
+  Py_END_ALLOW_THREADS
+
+  if (!ok) {
+    PyErr_SetString(PyExc_ValueError, "layout graph has a cycle");
+    return NULL;
+  }
+
+  PyObject* ans = PyList_New(choice.size());
+  if (ans == NULL) return NULL;
+  for (size_t i = 0; i < choice.size(); i++)
+    PyList_SET_ITEM(ans, i, PyInt_FromLong(choice[i]));
+  return ans;
 }
 
 static PyMethodDef TilingMethods[] = {
-	{"mincost_tiling", mincost_tiling, METH_VARARGS, NULL},
-	{NULL, NULL, 0, NULL}
+  {"mincost_layouts", mincost_layouts, METH_VARARGS,
+   "mincost_layouts(node_costs, edges) -> list\n\n"
+   "Choose one layout per node minimizing the total cost.\n\n"
+   "node_costs[i] lists the cost of each layout of node i; each edge is a\n"
+   "(child, parent, costs) tuple, with costs[lc * len(node_costs[parent]) + lp]\n"
+   "the cost of the child taking layout lc and the parent layout lp.\n"
+   "Returns the chosen layout index for each node."},
+  {NULL, NULL, 0, NULL}
 };
 
 PyMODINIT_FUNC inittiling(void) {
-	PyObject *m;
-	m = Py_InitModule("tiling", TilingMethods);
-	if (m == NULL) return;
+  PyObject *m;
+  m = Py_InitModule("tiling", TilingMethods);
+  if (m == NULL) return;
 }
-
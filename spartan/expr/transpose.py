@@ -49,11 +49,12 @@ class Transpose(distarray.DistArray):
   def view_extent(self, ex):
     return extent.create(ex.ul[::-1], ex.lr[::-1], self.shape)
 
-  def foreach_tile(self, mapper_fn, kw=None):
+  def foreach_tile(self, mapper_fn, kw=None, combiner=None):
     return self.base.foreach_tile(mapper_fn=_tile_mapper,
                                   kw={'_fn_kw': kw,
                                       '_base': self,
-                                      '_fn': mapper_fn})
+                                      '_fn': mapper_fn},
+                                  combiner=combiner)
 
   def extent_for_blob(self, id):
     base_ex = self.base.blob_to_ex[id]
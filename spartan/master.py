@@ -13,10 +13,15 @@ import weakref
 
 import time
 from spartan import util, rpc, core, blob_ctx
+from spartan.array import extent
 from spartan.config import FLAGS
 
 MASTER = None
 
+# Victims on the same host as the thief are preferred unless a remote
+# worker has this many times more remaining tiles.
+LOCAL_STEAL_PREFERENCE = 2
+
 def _dump_profile():
   import yappi
   yappi.get_func_stats().save('master_prof.out', type='pstat')
@@ -41,7 +46,12 @@ class Master(object):
 
     self._worker_statuses = {}
     self._worker_scores = {}
+    self._worker_hosts = {}
+    self._status_times = {}
     self._available_workers = []
+    # (kernel_id, tile) -> worker running the original copy of a backup tile
+    # (None once the backup has finished).
+    self._backups = {}
 
     self._arrays = weakref.WeakSet()
 
@@ -87,6 +97,7 @@ class Master(object):
     '''
     id = len(self._workers)
     self._workers[id] = rpc.connect(req.host, req.port)
+    self._worker_hosts[id] = req.host
     self._available_workers.append(id)
     util.log_info('Registered %s:%s (%d/%d)', req.host, req.port, id, self.num_workers)
 
@@ -123,9 +134,47 @@ class Master(object):
 
   def update_worker_score(self, worker_id, worker_status):
     self._worker_statuses[worker_id] = worker_status
+    self._status_times[worker_id] = time.time()
 
-  def get_worker_scores(self):
-    return sorted(self._worker_scores.iteritems(), key=lambda x: x[1], reverse=True)
+  def worker_speed(self, worker_id, kernel_type=None):
+    '''
+    Return the measured rate (bytes/s) at which ``worker_id`` processes tiles 
+    of ``kernel_type`` (or of all kernel types), or None if it is not known.
+    '''
+    status = self._worker_statuses.get(worker_id)
+    if status is None or not status.tile_throughput:
+      return None
+    rates = status.tile_throughput
+    if kernel_type in rates:
+      return rates[kernel_type]
+    return sum(rates.values()) / len(rates)
+
+  def _relative_speeds(self, kernel_type=None):
+    '''
+    Return a dictionary from available worker to its measured speed; workers
+    without measurements are assumed to run at the median speed.  Returns
+    None if no worker has been measured yet.
+    '''
+    speeds = dict((worker_id, self.worker_speed(worker_id, kernel_type))
+                  for worker_id in self._available_workers)
+    known = sorted(s for s in speeds.itervalues() if s)
+    if not known:
+      return None
+    median = known[len(known) / 2]
+    return dict((worker_id, s or median) for worker_id, s in speeds.iteritems())
+
+  def get_worker_scores(self, kernel_type=None):
+    '''
+    Return ``(worker_id, score)`` pairs, fastest first.  Scores are the measured
+    tile throughput (for ``kernel_type``, if known) once available, and based 
+    on free memory before that.
+    '''
+    speeds = self._relative_speeds(kernel_type)
+    if speeds is not None:
+      return sorted(speeds.iteritems(), key=lambda x: x[1], reverse=True)
+    scores = [(worker_id, score) for worker_id, score in self._worker_scores.iteritems()
+              if worker_id in self._available_workers]
+    return sorted(scores, key=lambda x: x[1], reverse=True)
 
   def mark_failed_worker(self, worker_id):
     util.log_info('Marking worker %s as failed.', worker_id)
@@ -141,48 +190,169 @@ class Master(object):
       if now - self._worker_statuses[worker_id].last_report_time > FLAGS.heartbeat_interval * FLAGS.worker_failed_heartbeat_threshold:
         self.mark_failed_worker(worker_id)
 
-  def maybe_steal_tile(self, req, handle):
+  def _find_victim(self, thief_id, speeds):
+    '''
+    Return the worker with the most (locality weighted) remaining work, or None.
+
+    If worker ``speeds`` are known, remaining work is measured in time
+    rather than tiles.
+    '''
+    thief_host = self._worker_hosts.get(thief_id)
+    victim, victim_load = None, 0
+    for worker_id, status in self._worker_statuses.iteritems():
+      if worker_id == thief_id or worker_id not in self._available_workers:
+        continue
+      load = float(len(status.kernel_remain_tiles))
+      if speeds is not None:
+        load /= speeds[worker_id]
+      if self._worker_hosts.get(worker_id) == thief_host:
+        load *= LOCAL_STEAL_PREFERENCE
+      if load > victim_load:
+        victim, victim_load = worker_id, load
+    return victim
+
+  def _steal_share(self, thief_id, victim, speeds):
+    '''
+    Return the fraction of the victim's remaining tiles the thief should take.
+
+    Stolen tiles must be read over the network, so the thief's effective
+    speed combines its tile and network throughput.
+    '''
+    if speeds is None:
+      return 0.5
+    thief_speed = speeds[thief_id]
+    net = self._worker_statuses[thief_id].net_throughput
+    if net > 0 and self._worker_hosts.get(thief_id) != self._worker_hosts.get(victim):
+      thief_speed = 1.0 / (1.0 / thief_speed + 1.0 / net)
+    return thief_speed / (thief_speed + speeds[victim])
+
+  def _find_straggler(self, thief_id, kernel_id):
+    '''
+    Return ``(worker_id, tile)`` for the running tile of ``kernel_id`` which is 
+    furthest behind, or None if no tile has been running for more than
+    ``--speculation_slowdown`` times the median tile time.
+    '''
+    times = sorted(status.avg_tile_time for status in self._worker_statuses.itervalues()
+                   if status.kernel_id == kernel_id and status.avg_tile_time > 0)
+    if not times:
+      return None
+    threshold = times[len(times) / 2] * FLAGS.speculation_slowdown
+
+    now = time.time()
+    straggler, straggler_time = None, threshold
+    for worker_id, status in self._worker_statuses.iteritems():
+      if (worker_id == thief_id or worker_id not in self._available_workers or
+          status.kernel_id != kernel_id):
+        continue
+      # time elapsed since the status was reported.
+      since = now - self._status_times.get(worker_id, now)
+      for tile, elapsed in status.kernel_running_tiles:
+        if (kernel_id, tile) in self._backups:
+          continue
+        if elapsed + since > straggler_time:
+          straggler, straggler_time = (worker_id, tile), elapsed + since
+    return straggler
+
+  def _tile_extent(self, tile):
+    if isinstance(tile, tuple):
+      return tile[1]
+    for array in self._arrays:
+      ex = array.blob_to_ex.get(tile)
+      if ex is not None:
+        return ex
+    return None
+
+  def _split_last_tile(self, victim, kernel_id, tile):
+    '''
+    Split ``tile``, the last queued tile of ``victim``, in two along its largest axis.
+
+    Returns the half to be processed by the thief, or None if the tile could not be split.
+    '''
+    ex = self._tile_extent(tile)
+    if ex is None:
+      return None
+    axis = extent.largest_dim_axis(ex.shape)
+    if ex.shape[axis] < 2:
+      return None
+
+    mid = ex.ul[axis] + ex.shape[axis] / 2
+    keep_lr = list(ex.lr)
+    keep_lr[axis] = mid
+    steal_ul = list(ex.ul)
+    steal_ul[axis] = mid
+    keep = extent.create(ex.ul, keep_lr, ex.array_shape)
+    steal = extent.create(steal_ul, ex.lr, ex.array_shape)
+
+    tile_id = tile[0] if isinstance(tile, tuple) else tile
+    if not self._ctx.split_tile(victim, kernel_id, tile, keep):
+      return None
+    self._worker_statuses[victim].kernel_remain_tiles = [(tile_id, keep)]
+    return (tile_id, steal)
+
+  def maybe_steal_tiles(self, req, handle):
     '''
     This is called when a worker has finished processing all of it's current tiles,
     and is looking for more work to do.
-    We check if there are any outstanding tiles on existing workers to steal from.
+
+    We steal outstanding tiles of the most loaded worker, preferring workers on
+    the same host as the thief.  The thief takes half of the tiles, or once
+    worker speeds have been measured, a share proportional to its speed.  If the victim only has a single tile 
+    left, it may be split between the two workers (see ``--steal_split_tiles``).
+
+    If there is nothing left to steal, the thief may run a backup copy of a
+    straggling tile (see ``--speculative_execution``); whichever copy finishes
+    first is used, and the other worker is told to abandon its copy.
 
     Args:
-      req (UpdateAndStealTileReq):
+      req (StealTilesReq):
       handle (PendingRequest):
     '''
     self._worker_statuses[req.worker_id].kernel_remain_tiles = []
 
-    # update the migrated tile
-    if req.old_tile_id is not None:
-      util.log_debug('worker(%s) update old_tile:%s new_tile:%s', req.worker_id, req.old_tile_id, req.new_tile_id)
-      for array in self._arrays:
-        ex = array.blob_to_ex.get(req.old_tile_id)
-        if ex is not None:
-          array.tiles[ex] = req.new_tile_id
-          array.blob_to_ex[req.new_tile_id] = ex
-
-          del array.blob_to_ex[req.old_tile_id]
-          self._ctx.destroy(req.old_tile_id)
-          break
-
-    # apply a new tile for execution
-    slow_workers = sorted(self._worker_statuses.iteritems(),
-                          key=lambda x: len(x[1].kernel_remain_tiles),
-                          reverse=True)
-    for slow_worker in slow_workers:
-      if len(slow_worker[1].kernel_remain_tiles) == 0: break
-
-      tile_id = slow_worker[1].kernel_remain_tiles[0]
-      if self._ctx.cancel_tile(slow_worker[0], tile_id):
-        util.log_debug('move tile:%s from worker(%s) to worker(%s)', tile_id, slow_worker[0], req.worker_id)
-        slow_worker[1].kernel_remain_tiles.remove(tile_id)
-        resp = core.TileIdMessage(tile_id=tile_id)
-        handle.done(resp)
+    for tile in req.finished_backups:
+      # finished tiles stay in _backups (with no straggler), so they are not
+      # backed up or abandoned again.
+      straggler = self._backups.get((req.kernel_id, tile))
+      self._backups[(req.kernel_id, tile)] = None
+      if straggler is not None and straggler in self._available_workers:
+        self._ctx.abandon_tiles(straggler, req.kernel_id, [tile])
+    # forget backups of earlier kernels.
+    for key in self._backups.keys():
+      if key[0] != req.kernel_id:
+        del self._backups[key]
+
+    stolen = []
+    speeds = self._relative_speeds(req.kernel_type or None)
+    victim = self._find_victim(req.worker_id, speeds)
+    if victim is not None:
+      remain = self._worker_statuses[victim].kernel_remain_tiles
+      if len(remain) == 1 and FLAGS.steal_split_tiles:
+        # share the last tile rather than moving it to the thief.
+        half = self._split_last_tile(victim, req.kernel_id, remain[0])
+        if half is not None:
+          stolen = [half]
+
+      if not stolen:
+        # victims process their tiles from the end of the list; steal from the front.
+        share = self._steal_share(req.worker_id, victim, speeds)
+        batch = remain[:max(1, int(len(remain) * share))]
+        stolen = self._ctx.cancel_tiles(victim, req.kernel_id, batch)
+        for tile in stolen:
+          remain.remove(tile)
+
+      if stolen:
+        util.log_debug('move tiles:%s from worker(%s) to worker(%s)', stolen, victim, req.worker_id)
+
+    if not stolen and req.allow_backup and FLAGS.speculative_execution:
+      straggler = self._find_straggler(req.worker_id, req.kernel_id)
+      if straggler is not None:
+        worker_id, tile = straggler
+        self._backups[(req.kernel_id, tile)] = worker_id
+        util.log_debug('backup tile:%s of worker(%s) on worker(%s)', tile, worker_id, req.worker_id)
+        handle.done(core.TileListMessage(kernel_id=req.kernel_id, tiles=[tile], backup=True))
         return
 
-    resp = core.TileIdMessage(tile_id=None)
-    handle.done(resp)
+    handle.done(core.TileListMessage(kernel_id=req.kernel_id, tiles=stolen))
 
   def heartbeat(self, req, handle):
     '''RPC method.
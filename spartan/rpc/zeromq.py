@@ -13,7 +13,10 @@ from .common import Group
 from spartan import util
 from spartan.util import FLAGS
 from zmq.eventloop import zmqstream, ioloop 
-from rlock import FastRLock
+
+# Maximum number of bytes sent per call to ServerSocket.handle_write, so
+# that the poll thread keeps servicing incoming requests under heavy load.
+WRITE_BATCH_BYTES = 16 * 1024 * 1024
 
 #for client socket, we have one poller per thread.
 _poller = threading.local()
@@ -92,8 +95,9 @@ class ZMQServerLoop(object):
     return self._running_thread 
 
   def modify(self, direction):
-    self._direction = direction
-    self.wakeup()
+    if direction != self._direction:
+      self._direction = direction
+      self.wakeup()
 
   def wakeup(self):
     os.write(self._pipe[1], 'x')
@@ -140,8 +144,30 @@ class Socket(object):
     data = self._zmq.recv()
     self._handler(data)
 
+def _msg_size(msg):
+  if isinstance(msg, Group):
+    return sum([len(part) for part in msg])
+  return len(msg)
+
+def _msg_peer(msg):
+  if isinstance(msg, Group):
+    source = msg[0]
+    return getattr(source, 'bytes', source)
+  return None
+
 class ServerSocket(Socket):
-  ''' ServerSocket use its own loop and use its own handle_read/handle_write functions. '''
+  ''' 
+  ServerSocket use its own loop and use its own handle_read/handle_write functions. 
+
+  Outgoing messages are queued per peer and sent round-robin by the poll
+  thread.  Once more than ``send_queue_high_watermark`` bytes are queued, 
+  the socket is *congested*: incoming requests are no longer read, and 
+  senders in other threads whose peer holds more than its fair share of 
+  ``send_queue_low_watermark`` block until that share drains (or the 
+  queue drains below the low watermark).  Replies sent from the poll 
+  thread itself (e.g. tile fetches) are queued and counted too, but never
+  block.
+  '''
   def __init__(self, ctx, sock_type, hostport):
     ctx.set(zmq.MAX_SOCKETS, FLAGS.max_zeromq_sockets)
     #Socket.__init__(self, ctx, sock_type, hostport, event_loop)
@@ -149,10 +175,23 @@ class ServerSocket(Socket):
     self._listening = False
     self.addr = hostport
     self._event_loop = ZMQServerLoop(self)
-    self._out = collections.deque() 
-    self._out_lock = FastRLock()
+    # peer -> deque of pending messages, visited in round-robin order.
+    self._out = collections.OrderedDict()
+    self._out_bytes = 0
+    self._peer_bytes = collections.defaultdict(int)
+    self._congested = False
+    self._out_lock = threading.Lock()
+    self._out_cond = threading.Condition(self._out_lock)
     self.bind()
 
+  @property
+  def congested(self):
+    '''True if the outgoing queue is above the high watermark; senders should slow down.'''
+    return self._congested
+
+  def queued_bytes(self):
+    return self._out_bytes
+
   def listen(self):
     self._listening = True
   
@@ -164,33 +203,89 @@ class ServerSocket(Socket):
     stub_socket = StubSocket(source, self, rest)
     self._handler(stub_socket)
 
+  def _send_now(self, msg):
+    if isinstance(msg, Group):
+      self._zmq.send_multipart(msg, copy=False)
+    else:
+      self._zmq.send(msg, copy=False)
+
+  def _update_direction(self):
+    # Called with _out_lock held.
+    if self._congested:
+      # stop accepting new requests until the queue drains.
+      self._event_loop.modify(zmq.POLLOUT)
+    elif self._out:
+      self._event_loop.modify(zmq.POLLIN | zmq.POLLOUT)
+    else:
+      self._event_loop.modify(zmq.POLLIN)
+
+  def _enqueue(self, peer, msg, size):
+    # Called with _out_lock held.
+    if peer not in self._out:
+      self._out[peer] = collections.deque()
+    self._out[peer].append((msg, size))
+    self._out_bytes += size
+    self._peer_bytes[peer] += size
+    if self._out_bytes >= FLAGS.send_queue_high_watermark:
+      self._congested = True
+    self._update_direction()
+
+  def _must_wait(self, peer):
+    # Called with _out_lock held.
+    if not self._congested:
+      return False
+    # Hot peers wait for the queue to drain; others may still queue up to
+    # twice the high watermark.  Shares are of the low watermark, so a hot
+    # peer does not resume as soon as one of its messages is sent.
+    fair_share = FLAGS.send_queue_low_watermark / max(1, len(self._out))
+    return (self._peer_bytes.get(peer, 0) >= fair_share or
+            self._out_bytes >= 2 * FLAGS.send_queue_high_watermark)
+
   def handle_write(self):
     ''' 
     This function is called from inside of the poll thread.
-    It sends out any messages which were enqueued by other threads. 
+    It sends out messages which were enqueued by other threads, 
+    taking one message from each peer in turn. 
     '''
     with self._out_lock:
-      while self._out:
-        msg = self._out.popleft()
-        if isinstance(msg, Group):
-          self._zmq.send_multipart(msg, copy=False)
-        else:
-          self._zmq.send(msg, copy=False)
-      self._event_loop.modify(zmq.POLLIN)
+      sent = 0
+      while self._out and sent < WRITE_BATCH_BYTES:
+        for peer in self._out.keys():
+          queue = self._out[peer]
+          msg, size = queue.popleft()
+          self._send_now(msg)
+          sent += size
+          self._out_bytes -= size
+          self._peer_bytes[peer] -= size
+          if not queue:
+            del self._out[peer]
+            del self._peer_bytes[peer]
+
+      if self._congested and self._out_bytes <= FLAGS.send_queue_low_watermark:
+        self._congested = False
+      self._out_cond.notify_all()
+      self._update_direction()
 
   def send(self, msg):
-    # We put the msg in queue and let the polling thread send the message.
-    # An alternative way is that we send the message directly if it is in
-    # polling thread, otherwise we put the message in queue.
+    # All messages are put in the queue and sent by the polling thread, so
+    # that replies sent from the polling thread count towards the
+    # watermarks.  Other threads block first if the queue is congested; the
+    # polling thread can't, as it is the one draining the queue.
+    peer = _msg_peer(msg)
+    size = _msg_size(msg)
     if threading.current_thread() == self._event_loop.running_thread():
-      if isinstance(msg, Group):
-        self._zmq.send_multipart(msg, copy=False)
-      else:
-        self._zmq.send(msg, copy=False)
+      with self._out_lock:
+        self._enqueue(peer, msg, size)
     else: 
       with self._out_lock:
-        self._out.append(msg)
-        self._event_loop.modify(zmq.POLLIN | zmq.POLLOUT)
+        while self._must_wait(peer):
+          self._out_cond.wait()
+        self._enqueue(peer, msg, size)
+
+  def flush(self):
+    '''Send all queued messages.  Must be called from the poll thread.'''
+    while self._out:
+      self.handle_write()
 
   def bind(self):
     host, port = self.addr
@@ -393,6 +393,13 @@ def join_tuple(tuple_a, tuple_b):
   return tuple(list(tuple_a) + list(tuple_b))
 
 
+def ewma(old, sample, alpha=0.3):
+  '''Exponentially weighted moving average; ``old`` of None starts the average at ``sample``.'''
+  if old is None:
+    return sample
+  return alpha * sample + (1 - alpha) * old
+
+
 def divup(a, b):
   if isinstance(a, tuple):
     return tuple([divup(ta, b) for ta in a])
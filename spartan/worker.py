@@ -13,6 +13,7 @@ master cannot be contacted for a sufficiently long interval, workers
 shut themselves down.   
 '''
 
+import collections
 import multiprocessing
 from multiprocessing.pool import ThreadPool
 import os
@@ -22,7 +23,9 @@ import sys
 import threading
 import time
 
-from . import config, util, rpc, core, blob_ctx
+from . import affinity, config, util, rpc, core, blob_ctx
+from .array import distarray
+from .array.tile import TYPE_DENSE
 from .config import FLAGS, StrFlag, IntFlag, BoolFlag
 from .rpc import zeromq, TimeoutException, rlock
 from .util import Assert
@@ -35,6 +38,18 @@ import numpy as np
 HEARTBEAT_TIMEOUT=100
 _init_lock = rlock.FastRLock()
 
+FLAGS.add(IntFlag('worker_tile_threads', default=1,
+                  help='Number of tiles of a kernel that each worker runs concurrently'))
+FLAGS.add(IntFlag('tile_batch_size', default=0,
+                  help='Run kernels once over contiguous local tiles with fewer elements than this, '
+                       'up to this many elements per batch (0 disables)'))
+
+def _kernel_type(req):
+  '''The name tile throughput is measured under for kernel ``req``: that of its user function.'''
+  user_fn = req.kw.get('user_fn', None)
+  return getattr(user_fn, '__name__', None) or req.mapper_fn.__name__
+
+
 class Worker(object):
   '''
   Spartan workers generally correspond to one core of a machine.
@@ -74,8 +89,54 @@ class Worker(object):
     if not hasattr(threading.current_thread(), "_children"):
       threading.current_thread()._children = weakref.WeakKeyDictionary()
     
-    self._kernel_threads = ThreadPool(processes=1)
+    # kernels waiting to run, as (sequence number, req, handle); see _next_kernel.
+    self._kernel_queue = []
+    self._kernel_seq = 0
+    self._queue_cond = threading.Condition()
+    # seconds of tile time used by each job, for fair sharing.
+    self._job_usage = collections.defaultdict(float)
+    # kernel type -> moving average of bytes/s processed; guarded by _kernel_lock.
+    self._tile_throughput = {}
+    # tiles of the current kernel which have not started yet; guarded by _kernel_lock.
     self._kernel_remain_tiles = []
+    self._kernel_lock = threading.Lock()
+    self._kernel_cond = threading.Condition(self._kernel_lock)
+    self._kernel_id = -1
+    self._kernel_splittable = False
+    self._kernel_speculative = False
+    # tile -> the batch of small contiguous tiles it is run with.
+    self._kernel_batches = {}
+    # (kernel_id, tile) -> start time of running tiles, and the running tiles
+    # whose result is no longer needed as a backup copy finished first.
+    self._kernel_running = {}
+    self._kernel_abandoned = set()
+    self._kernel_done_tiles = 0
+    self._kernel_done_time = 0.0
+    # kernel_id -> (tile, seconds, bytes fetched, bytes updated) of the tiles
+    # run for profiled kernels.
+    self._kernel_profiles = {}
+    if FLAGS.worker_tile_threads > 1 or FLAGS.speculative_execution:
+      # with speculation, keep a spare thread in case a tile is abandoned.
+      spare = 1 if FLAGS.speculative_execution else 0
+      self._tile_threads = ThreadPool(processes=FLAGS.worker_tile_threads + spare)
+    else:
+      self._tile_threads = None
+
+    # reads of pipelined tiles which have not been created yet: 
+    # tile id -> list of (method, req, handle).  Guarded by _lock.
+    self._pending_reads = {}
+    # pipelined tiles which will never be created as their kernel failed:
+    # tile id -> the error to answer reads with.  Guarded by _lock.
+    self._failed_tiles = {}
+
+    # partial results received from children in kernel reduction trees.
+    self._partial_results = {}
+    self._partial_cond = threading.Condition()
+
+    # started once all of the kernel state it reads exists.
+    self._kernel_dispatcher = threading.Thread(target=self._dispatch_kernels)
+    self._kernel_dispatcher.daemon = True
+    self._kernel_dispatcher.start()
     
     if FLAGS.profile_worker:
       import yappi
@@ -141,11 +202,54 @@ class Worker(object):
       else:
         id = req.tile_id
       self._blobs[id] = req.data
+      waiting = self._pending_reads.pop(id, [])
 
     resp = core.TileIdMessage(tile_id=id)
     handle.done(resp)
 
+    for method, pending_req, pending_handle in waiting:
+      method(pending_req, pending_handle)
+
+  def _defer_read(self, method, req, handle, tile_id):
+    '''
+    If ``tile_id`` is the output of a pipelined kernel which has not been 
+    created yet, queue the read until it is and return True.  If the
+    kernel failed, the read fails with its error instead.
+    '''
+    if tile_id in self._blobs or tile_id.id < blob_ctx.PIPELINED_ID_BASE:
+      return False
+    with self._lock:
+      if tile_id in self._blobs:
+        return False
+      error = self._failed_tiles.get(tile_id)
+      if error is None:
+        self._pending_reads.setdefault(tile_id, []).append((method, req, handle))
+        return True
+    handle.done(error)
+    return True
+
+  def _fail_pipelined_tiles(self, req, error):
+    '''
+    Fail the reads of the tiles of pipelined kernel ``req`` on this worker
+    which were not created before it failed.
+    '''
+    out_tiles = req.kw.get('out_tiles', None)
+    if not out_tiles:
+      return
+    waiting = []
+    with self._lock:
+      for tile_id in out_tiles.itervalues():
+        if tile_id.worker != self.id or tile_id in self._blobs:
+          continue
+        self._failed_tiles[tile_id] = error
+        waiting.extend(self._pending_reads.pop(tile_id, []))
+
+    for _, _, pending_handle in waiting:
+      pending_handle.done(error)
+
   def tile_op(self, req, handle):
+    if self._defer_read(self.tile_op, req, handle, req.tile_id):
+      return
     resp = core.RunKernelResp(result=req.fn(self._blobs[req.tile_id]))
     handle.done(resp)
 
@@ -159,6 +263,7 @@ class Worker(object):
     '''
     with self._lock:
       for id in req.ids:
+        self._failed_tiles.pop(id, None)
         if id in self._blobs:
           blob = self._blobs[id]
           blob.refcnt -= 1
@@ -192,6 +297,8 @@ class Worker(object):
     :param handle: `PendingRequest`
     
     '''
+    if self._defer_read(self.get, req, handle, req.id):
+      return
     if req.subslice is None:
       #util.log_info('GET: %s', type(self._blobs[req.id]))
       resp = core.GetResp(data=self._blobs[req.id])
@@ -208,6 +315,8 @@ class Worker(object):
     :param handle: `PendingRequest`
     
     '''
+    if self._defer_read(self.get_flatten, req, handle, req.id):
+      return
     if req.subslice is None:
       #util.log_info('GET: %s', type(self._blobs[req.id]))
       resp = core.GetResp(data=self._blobs[req.id].data.flatten())
@@ -216,18 +325,327 @@ class Worker(object):
       resp = core.GetResp(data=self._blobs[req.id].data.flatten()[req.subslice])
       handle.done(resp)
 
-  def cancel_tile(self, req, handle):
+  def cancel_tiles(self, req, handle):
     '''
-    Cancel the tile from the kernel remain tile list. The tile will not be executed in this worker.
+    Cancel tiles from the kernel remain tile list. The tiles will not be executed in this worker.
     
-    :param req: `TileIdMessage`
+    :param req: `TileListMessage`
+    :param handle: `PendingRequest`; the result is the list of tiles actually canceled.
+    '''
+    canceled = []
+    with self._kernel_lock:
+      if req.kernel_id == self._kernel_id:
+        for tile in req.tiles:
+          if tile in self._kernel_remain_tiles:
+            self._kernel_remain_tiles.remove(tile)
+            canceled.append(tile)
+    handle.done(canceled)
+
+  def abandon_tiles(self, req, handle):
+    '''
+    Stop waiting for tiles which have been completed by a backup execution
+    on another worker.  The results of the tiles are discarded.
+
+    :param req: `TileListMessage`
+    :param handle: `PendingRequest`
+    '''
+    with self._kernel_cond:
+      if req.kernel_id == self._kernel_id:
+        for tile in req.tiles:
+          if tile in self._kernel_remain_tiles:
+            self._kernel_remain_tiles.remove(tile)
+          elif (req.kernel_id, tile) in self._kernel_running:
+            self._kernel_abandoned.add((req.kernel_id, tile))
+        self._kernel_cond.notify_all()
+    handle.done()
+
+  def split_tile(self, req, handle):
+    '''
+    Only process the ``req.keep`` portion of a queued tile; the rest is
+    processed by another worker.
+
+    :param req: `SplitTileReq`
     :param handle: `PendingRequest`
     '''
+    with self._kernel_lock:
+      if (req.kernel_id == self._kernel_id and self._kernel_splittable and 
+          req.tile in self._kernel_remain_tiles):
+        idx = self._kernel_remain_tiles.index(req.tile)
+        tile_id = req.tile[0] if isinstance(req.tile, tuple) else req.tile
+        self._kernel_remain_tiles[idx] = (tile_id, req.keep)
+        handle.done(True)
+      else:
+        handle.done(False)
+
+  def aggregate(self, req, handle):
+    '''
+    Receive a partial kernel result from a child in the reduction tree.
+
+    :param req: `AggregateReq`
+    :param handle: `PendingRequest`
+    '''
+    with self._partial_cond:
+      self._partial_results.setdefault(req.kernel_id, []).append(req.result)
+      self._partial_cond.notify_all()
+    handle.done()
+
+  def _combine_results(self, req, combined):
+    '''
+    Combine ``combined`` (the result of the local tiles) with the partial
+    results of our children in the reduction tree, and forward the
+    result to our parent.
+
+    :param req: `RunKernelReq`
+    :param combined: the combined local result, or None if there is none.
+    :rtype: (is_root, value) tuple; value is only meaningful for the root.
+    '''
+    tree = req.reduce_tree
+    pos = tree.index(self.id)
+    children = tree[pos * req.tree_fanout + 1:(pos + 1) * req.tree_fanout + 1]
+
+    with self._partial_cond:
+      while len(self._partial_results.get(req.kernel_id, [])) < len(children):
+        self._partial_cond.wait()
+      partials = self._partial_results.pop(req.kernel_id, [])
+
+    for partial in partials:
+      if partial is None: continue
+      combined = partial if combined is None else req.combiner(combined, partial)
+
+    if pos == 0:
+      return True, combined
+
+    self._ctx.aggregate(tree[(pos - 1) // req.tree_fanout], req.kernel_id, combined)
+    return False, None
+
+  def _finish_combine(self, req, handle, combined):
+    '''Wait for the children of this worker in the reduction tree, and reply.'''
     try:
-      self._kernel_remain_tiles.remove(req.tile_id)
-      handle.done(True)
+      handle.done(self._combine_results(req, combined))
     except:
-      handle.done(False)
+      util.log_warn('Exception occurred while combining kernel results', exc_info=1)
+      self.worker_status.add_task_failure(req)
+      handle.exception()
+      self._forward_failed_partial(req)
+
+  def _forward_failed_partial(self, req):
+    pos = req.reduce_tree.index(self.id)
+    if pos > 0:
+      try:
+        self._ctx.aggregate(req.reduce_tree[(pos - 1) // req.tree_fanout], req.kernel_id, None)
+      except:
+        util.log_warn('Failed to forward partial result for kernel %d', req.kernel_id, exc_info=1)
+
+  def _discard_result(self, result, original_tile_id_set):
+    '''Delete the tiles created for the result of an abandoned tile.'''
+    if not isinstance(result, list):
+      return
+    with self._lock:
+      for _, tile_id in result:
+        if tile_id not in original_tile_id_set and tile_id in self._blobs:
+          del self._blobs[tile_id]
+
+  def _find_batches(self, req):
+    '''
+    Group the small local tiles of ``req`` which are contiguous along axis 0
+    into batches which are run with a single mapper call.
+
+    Call with _kernel_lock held.
+
+    :rtype: dictionary from tile to the list of tiles in its batch.
+    '''
+    if (FLAGS.tile_batch_size <= 0 or self._kernel_speculative or
+        req.mapper_fn is not distarray._tile_mapper):
+      return {}
+    check = getattr(req.kw.get('user_fn', None), 'batchable', None)
+    if check is None or not check(req.kw):
+      return {}
+
+    array = req.kw['array']
+    small = []
+    for tile_id in self._kernel_remain_tiles:
+      blob = self._blobs[tile_id]
+      if blob.type != TYPE_DENSE or np.prod(blob.shape) >= FLAGS.tile_batch_size:
+        continue
+      ex = array.extent_for_blob(tile_id)
+      # only tiles spanning all but the first axis are contiguous in memory.
+      if all(ex.ul[i] == 0 and ex.lr[i] == ex.array_shape[i] for i in range(1, len(ex.ul))):
+        small.append((ex.ul[0], ex, tile_id))
+    small.sort()
+
+    batches = {}
+    batch, batch_size = [], 0
+    for _, ex, tile_id in small + [(None, None, None)]:
+      if (tile_id is None or (batch and batch[-1][0].lr[0] != ex.ul[0]) or
+          batch_size + ex.size > FLAGS.tile_batch_size):
+        if len(batch) > 1:
+          ids = [t for _, t in batch]
+          for t in ids:
+            batches[t] = ids
+        batch, batch_size = [], 0
+      if tile_id is not None:
+        batch.append((ex, tile_id))
+        batch_size += ex.size
+    return batches
+
+  def _take_batch(self, tile):
+    '''
+    Remove the rest of the batch of ``tile`` from the remaining tiles, if
+    none of it has been stolen.  Call with _kernel_lock held.
+
+    :rtype: the tiles of the batch, or None.
+    '''
+    if isinstance(tile, tuple) or tile not in self._kernel_batches:
+      return None
+    others = [t for t in self._kernel_batches[tile] if t != tile]
+    if not all(t in self._kernel_remain_tiles for t in others):
+      return None
+    for t in others:
+      self._kernel_remain_tiles.remove(t)
+    return self._kernel_batches[tile]
+
+  def _tile_bytes(self, req, tiles):
+    '''Return the size in bytes of the input tiles (see `TileListMessage`) ``tiles``.'''
+    array = req.kw.get('array', None)
+    total = 0
+    for tile in tiles:
+      tile_id, ex = tile if isinstance(tile, tuple) else (tile, None)
+      blob = self._blobs.get(tile_id)
+      if blob is not None:
+        size = ex.size if ex is not None else np.prod(blob.shape)
+        total += size * blob.dtype.itemsize
+      elif isinstance(array, distarray.DistArrayImpl):
+        # stolen tile
+        ex = ex if ex is not None else array.extent_for_blob(tile_id)
+        total += ex.size * array.dtype.itemsize
+    return total
+
+  def _run_tiles(self, req, results, original_tile_id_set):
+    '''
+    Run ``req.mapper_fn`` over tiles from ``_kernel_remain_tiles`` until none are left.
+
+    Several threads may run this concurrently for the same kernel.
+
+    :param req: `KernelReq`
+    :param results: dictionary from tile (see `TileListMessage`) to result, 
+      filled in by this function.
+    :param original_tile_id_set: the tiles present before the kernel started.
+    '''
+    blob_ctx.set(self._ctx)
+    futures = []
+    kernel_type = _kernel_type(req)
+    while True:
+      if self._should_yield(req):
+        # leave the remaining tiles for after the higher priority kernel.
+        break
+      with self._kernel_lock:
+        # an abandoned tile may finish after the next kernel has started.
+        if len(self._kernel_remain_tiles) == 0 or req.kernel_id != self._kernel_id:
+          break
+        tile = self._kernel_remain_tiles.pop()
+        batch = self._take_batch(tile)
+        key = (req.kernel_id, tile)
+        self._kernel_running[key] = time.time()
+      nbytes = self._tile_bytes(req, batch if batch is not None else [tile])
+      if req.profile:
+        self._ctx.reset_io_counters()
+
+      try:
+        if batch is not None:
+          map_result = distarray._batch_mapper(batch, **req.kw)
+        elif isinstance(tile, tuple):
+          # part of a split tile
+          tile_id, ex = tile
+          map_result = req.mapper_fn(tile_id, self._blobs.get(tile_id), _extent=ex, **req.kw)
+        else:
+          # stolen tiles are not local: mappers fetch the data they need.
+          map_result = req.mapper_fn(tile, self._blobs.get(tile), **req.kw)
+      except:
+        # stop the other tile threads of this kernel.
+        with self._kernel_cond:
+          del self._kernel_remain_tiles[:]
+          del self._kernel_running[key]
+          self._kernel_abandoned.discard(key)
+          self._kernel_cond.notify_all()
+        raise
+
+      with self._kernel_cond:
+        start = self._kernel_running.pop(key)
+        elapsed = time.time() - start
+        abandoned = key in self._kernel_abandoned
+        if abandoned:
+          self._kernel_abandoned.remove(key)
+        else:
+          if req.kernel_id == self._kernel_id:
+            self._kernel_done_tiles += 1
+            self._kernel_done_time += elapsed
+          if nbytes > 0 and elapsed > 0:
+            self._tile_throughput[kernel_type] = util.ewma(
+                self._tile_throughput.get(kernel_type), nbytes / elapsed)
+          if req.profile:
+            io = self._ctx.io_counters()
+            self._kernel_profiles.setdefault(req.kernel_id, []).append(
+                (tile, elapsed, io['fetched'], io['updated']))
+        self._job_usage[req.job_id] += elapsed
+        self._kernel_cond.notify_all()
+
+      if abandoned:
+        self._discard_result(map_result.result, original_tile_id_set)
+        continue
+      if batch is not None:
+        # the result of the whole batch is reported under ``tile``.
+        for t in batch:
+          results[t] = []
+      results[tile] = map_result.result
+
+      if map_result.futures is not None:
+        futures.append(map_result.futures)
+
+    # wait for all kernel update operations to finish.  Futures must be waited
+    # for in the thread which created them.
+    rpc.wait_for_all(futures)
+
+  def _only_abandoned_running(self, kernel_id):
+    '''True if the only tiles left of ``kernel_id`` are abandoned ones.  Call with _kernel_lock held.'''
+    if self._kernel_remain_tiles:
+      return False
+    running = [key for key in self._kernel_running if key[0] == kernel_id]
+    return len(running) > 0 and all(key in self._kernel_abandoned for key in running)
+
+  def _run_all_tiles(self, req, results, original_tile_id_set):
+    '''
+    Run the tiles in ``_kernel_remain_tiles``, pausing to run higher
+    priority kernels when they arrive.
+    '''
+    while True:
+      self._run_local_tiles(req, results, original_tile_id_set)
+      with self._kernel_lock:
+        if not self._kernel_remain_tiles:
+          return
+      self._run_preempting_kernels(req)
+
+  def _run_local_tiles(self, req, results, original_tile_id_set):
+    '''Run the tiles in ``_kernel_remain_tiles`` using the tile threads.'''
+    args = (req, results, original_tile_id_set)
+    if self._tile_threads is None:
+      self._run_tiles(*args)
+      return
+
+    pending = [self._tile_threads.apply_async(self._run_tiles, args=args)
+               for i in range(FLAGS.worker_tile_threads)]
+    if self._kernel_speculative:
+      # don't wait for tiles whose backup copy has already finished elsewhere.
+      with self._kernel_cond:
+        while (not all(p.ready() for p in pending) and
+               not self._only_abandoned_running(req.kernel_id)):
+          self._kernel_cond.wait(0.1)
+      pending = [p for p in pending if p.ready()]
+
+    for p in pending:
+      p.wait()
+    # get() re-raises any exception from the tile threads.
+    for p in pending:
+      p.get()
 
   def _run_kernel(self, req, handle):
     '''
@@ -240,47 +658,47 @@ class Worker(object):
     
     '''
     start_time = time.time()
-    futures = []
-    original_tile_id_set = set(self._blobs.iterkeys())
+    with self._lock:
+      original_tile_id_set = set(self._blobs.keys())
     try:
       blob_ctx.set(self._ctx)
       results = {}
-      for tile_id in req.blobs:
-        if tile_id.worker == self.id:
-          self._kernel_remain_tiles.append(tile_id)
-    
-      # sort all tiles
-      self._kernel_remain_tiles.sort(key=lambda x: np.size(self._blobs[x].data))
-      
-      while len(self._kernel_remain_tiles) > 0:
-        tile_id = self._kernel_remain_tiles.pop()
-
-        blob = self._blobs[tile_id]
-        map_result = req.mapper_fn(tile_id, blob, **req.kw)
-        results[tile_id] = map_result.result
-          
-        if map_result.futures is not None:
-          futures.append(map_result.futures)
+      with self._kernel_lock:
+        self._kernel_id = req.kernel_id
+        self._kernel_done_tiles = 0
+        self._kernel_done_time = 0.0
+        user_fn = req.kw.get('user_fn', None)
+        self._kernel_splittable = (req.mapper_fn is distarray._tile_mapper and
+                                   getattr(user_fn, 'splittable', False))
+        # combined results can't tell a tile computed twice apart.
+        self._kernel_speculative = (FLAGS.speculative_execution and req.combiner is None and
+                                    req.mapper_fn is distarray._tile_mapper and
+                                    getattr(user_fn, 'side_effect_free', False))
+        for tile_id in req.blobs:
+          if tile_id.worker == self.id:
+            self._kernel_remain_tiles.append(tile_id)
+    
+        # sort all tiles
+        self._kernel_remain_tiles.sort(key=lambda x: np.size(self._blobs[x].data))
+        self._kernel_batches = self._find_batches(req)
       
-      # wait for all kernel update operations to finish
-      rpc.wait_for_all(futures) 
+      self._run_all_tiles(req, results, original_tile_id_set)
       
       # We've finished processing our local set of tiles.  
       # If we are load balancing, check with the master if it's possible to steal
-      # a tile from another worker.
-      if FLAGS.load_balance:
-        tile_id = self._ctx.maybe_steal_tile(None, None).tile_id
-        while tile_id is not None:
-          blob = self._ctx.get(tile_id, None)
-          map_result = req.mapper_fn(tile_id, blob, **req.kw)
-          with self._lock:
-            id = self._ctx.new_tile_id()
-            self._blobs[id] = blob
-          results[id] = map_result.result
-          if map_result.futures is not None:
-            rpc.wait_for_all(map_result.futures)
-             
-          tile_id = self._ctx.maybe_steal_tile(tile_id, id).tile_id
+      # a batch of tiles from another worker, or to run a backup copy of a
+      # straggling tile.
+      if FLAGS.load_balance and not req.pinned:
+        finished_backups = []
+        while True:
+          stolen = self._ctx.maybe_steal_tiles(req.kernel_id, self._kernel_speculative,
+                                               finished_backups, _kernel_type(req))
+          if not stolen.tiles:
+            break
+          with self._kernel_lock:
+            self._kernel_remain_tiles.extend(stolen.tiles)
+          self._run_all_tiles(req, results, original_tile_id_set)
+          finished_backups = stolen.tiles if stolen.backup else []
 
       # Some expression reuse tiles from previous distarray. In such cases, 
       # the results contain tile_id this worker already has.
@@ -294,14 +712,37 @@ class Worker(object):
         for tile_id in result_tile_id_set.intersection(original_tile_id_set):
           self._blobs[tile_id].refcnt += 1
 
-      finish_time = time.time()
-      handle.done(results)
+      if req.combiner is not None:
+        combined = None
+        for result in results.itervalues():
+          combined = result if combined is None else req.combiner(combined, result)
+        # Workers may receive concurrent kernels in different orders; waiting 
+        # for our children here would block the kernel thread and could deadlock.
+        threading.Thread(target=self._finish_combine, args=(req, handle, combined)).start()
+      elif req.profile:
+        with self._kernel_lock:
+          tiles = self._kernel_profiles.pop(req.kernel_id, [])
+        handle.done(core.KernelProfileResp(result=results, tiles=tiles))
+      else:
+        handle.done(results)
     except:
       util.log_warn('Exception occurred during kernel call', exc_info=1)
+      with self._kernel_lock:
+        self._kernel_profiles.pop(req.kernel_id, None)
+        # don't leak the tiles we didn't get to into the next kernel.
+        self._kernel_id = -1
+        self._kernel_remain_tiles = []
+        self._kernel_batches = {}
       self.worker_status.add_task_failure(req)
-      handle.exception()
-      
-    util.log_debug('worker(%s) kernel run time:%s', self.id, finish_time - start_time)
+      error = rpc.capture_exception()
+      handle.done(error)
+      # consumers of our output would otherwise wait for it forever.
+      self._fail_pipelined_tiles(req, error)
+      if req.combiner is not None:
+        # unblock our parent; the master sees the failure via our reply.
+        self._forward_failed_partial(req)
+    finally:
+      util.log_debug('worker(%s) kernel run time:%s', self.id, time.time() - start_time)
      
   def run_kernel(self, req, handle):
     '''
@@ -312,7 +753,83 @@ class Worker(object):
     
     '''
     #threading.Thread(target=self._run_kernel, args=(req, handle)).start()
-    self._kernel_threads.apply_async(self._run_kernel, args=(req, handle))
+    with self._queue_cond:
+      self._kernel_seq += 1
+      self._kernel_queue.append((self._kernel_seq, req, handle))
+      self._queue_cond.notify()
+
+  def _next_kernel(self, min_priority=None):
+    '''
+    Remove and return the next kernel to run from the queue, or None.
+
+    The kernel with the highest priority is chosen; between kernels of equal 
+    priority, the job which has used the least tile time relative to its
+    weight goes first.  If ``min_priority`` is given, only kernels with a
+    higher priority are considered.
+
+    Call with _queue_cond held.
+    '''
+    best, best_key = None, None
+    for entry in self._kernel_queue:
+      seq, req, _ = entry
+      if min_priority is not None and req.priority <= min_priority:
+        continue
+      key = (-req.priority, self._job_usage[req.job_id] / req.weight, seq)
+      if best is None or key < best_key:
+        best, best_key = entry, key
+    if best is None:
+      return None
+    self._kernel_queue.remove(best)
+    return best[1], best[2]
+
+  def _should_yield(self, req):
+    '''True if a kernel with a higher priority than ``req`` is waiting.'''
+    if req.pinned:
+      # pipelined consumers on this worker may be waiting for our tiles.
+      return False
+    for _, queued, _ in list(self._kernel_queue):
+      if queued.priority > req.priority:
+        return True
+    return False
+
+  def _dispatch_kernels(self):
+    '''Run queued kernels, one at a time.'''
+    while self._running:
+      with self._queue_cond:
+        next_kernel = self._next_kernel()
+        if next_kernel is None:
+          self._queue_cond.wait(0.1)
+          continue
+      try:
+        self._run_kernel(*next_kernel)
+      except:
+        # keep dispatching: later kernels would otherwise never run.
+        util.log_warn('Failed to run kernel %d', next_kernel[0].kernel_id, exc_info=1)
+
+  def _run_preempting_kernels(self, req):
+    '''
+    Run the queued kernels with a higher priority than ``req``, which has
+    been paused between tiles.
+    '''
+    with self._kernel_lock:
+      saved = (self._kernel_id, self._kernel_remain_tiles, self._kernel_splittable, 
+               self._kernel_speculative, self._kernel_batches, 
+               self._kernel_done_tiles, self._kernel_done_time)
+      self._kernel_id = -1
+      self._kernel_remain_tiles = []
+
+    while True:
+      with self._queue_cond:
+        next_kernel = self._next_kernel(min_priority=req.priority)
+      if next_kernel is None:
+        break
+      util.log_debug('Kernel %d preempted by kernel %d', req.kernel_id, next_kernel[0].kernel_id)
+      self._run_kernel(*next_kernel)
+
+    with self._kernel_lock:
+      (self._kernel_id, self._kernel_remain_tiles, self._kernel_splittable, 
+       self._kernel_speculative, self._kernel_batches, 
+       self._kernel_done_tiles, self._kernel_done_time) = saved
       
   def shutdown(self, req, handle):
     '''
@@ -357,7 +874,21 @@ class Worker(object):
         time.sleep(0.1)
         continue
       
-      self.worker_status.update_status(psutil.virtual_memory().percent, psutil.cpu_percent(), now, self._kernel_remain_tiles)
+      with self._kernel_lock:
+        kernel_id = self._kernel_id
+        remain_tiles = list(self._kernel_remain_tiles)
+        running_tiles = [(tile, now - start) 
+                         for (tile_kernel, tile), start in self._kernel_running.iteritems()
+                         if tile_kernel == kernel_id and 
+                            (tile_kernel, tile) not in self._kernel_abandoned]
+        if self._kernel_done_tiles > 0:
+          avg_tile_time = self._kernel_done_time / self._kernel_done_tiles
+        else:
+          avg_tile_time = 0.0
+        tile_throughput = dict(self._tile_throughput)
+      self.worker_status.update_status(psutil.virtual_memory().percent, psutil.cpu_percent(), now, 
+                                       remain_tiles, kernel_id, running_tiles, avg_tile_time,
+                                       tile_throughput, self._ctx.net_throughput or 0.0)
       future = self._ctx.heartbeat(self.worker_status, HEARTBEAT_TIMEOUT)  
       try:
         future.wait()
@@ -383,9 +914,8 @@ def _start_worker(master, local_id):
   util.log_info('Worker starting up... Master: %s Profile: %s', master, FLAGS.profile_worker)
   rpc.set_default_timeout(FLAGS.default_rpc_timeout)
   if FLAGS.use_single_core:
-    pid = os.getpid()
-    os.system('taskset -pc %d %d > /dev/null' % (local_id * 2, pid))
-    
+    affinity.pin_worker(local_id)
+
   master = rpc.connect(*master)
   worker = Worker(master)
   worker.wait_for_shutdown()
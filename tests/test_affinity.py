@@ -0,0 +1,30 @@
+from spartan import affinity
+from spartan.util import Assert
+
+# two nodes, two cores per node, two hyperthreads per core.
+TOPOLOGY = affinity.Topology({0: [[0, 4], [1, 5]], 1: [[2, 6], [3, 7]]})
+
+def test_parse_cpulist():
+  Assert.eq(affinity.parse_cpulist('0-3,8,10-11\n'), [0, 1, 2, 3, 8, 10, 11])
+  Assert.eq(affinity.parse_cpulist(''), [])
+
+def test_physical():
+  Assert.eq(TOPOLOGY.assign(0, 'physical'), (0, [0, 4]))
+  Assert.eq(TOPOLOGY.assign(2, 'physical'), (1, [2, 6]))
+  # more workers than cores wrap around.
+  Assert.eq(TOPOLOGY.assign(4, 'physical'), (0, [0, 4]))
+
+def test_compact():
+  Assert.eq([TOPOLOGY.assign(i, 'compact') for i in range(4)],
+            [(0, [0]), (0, [4]), (0, [1]), (0, [5])])
+
+def test_scatter():
+  # every physical core is used before any hyperthread sibling.
+  Assert.eq([TOPOLOGY.assign(i, 'scatter') for i in range(8)],
+            [(0, [0]), (1, [2]), (0, [1]), (1, [3]),
+             (0, [4]), (1, [6]), (0, [5]), (1, [7])])
+
+def test_discover():
+  topology = affinity.Topology.discover()
+  Assert.gt(len(topology.nodes), 0)
+  Assert.raises_exception(ValueError, topology.slots, 'unknown')
@@ -1,4 +1,6 @@
 from spartan import expr, blob_ctx
+from spartan.array import distarray
+from spartan.config import FLAGS
 from spartan.util import Assert
 import numpy as np
 import test_common
@@ -22,3 +24,20 @@ class TestCheckpoint(test_common.ClusterTest):
     
     res = z + z
     Assert.all_eq(res.glom(), np.ones(ARRAY_SIZE)*24)
+
+  def test_lineage_recovery(self):
+    FLAGS.lineage_depth = 3
+    try:
+      na = np.arange(100).reshape(ARRAY_SIZE)
+      a = expr.from_numpy(na)
+      b = (a + 1) * 2
+      array = b.force()
+    finally:
+      FLAGS.lineage_depth = 0
+    Assert.not_null(array.lineage)
+
+    lost = array.tiles.keys()[0]
+    array.bad_tiles.append(lost)
+    Assert.true(distarray.recover(array))
+    Assert.eq(array.bad_tiles, [])
+    Assert.all_eq(b.glom(), (na + 1) * 2)
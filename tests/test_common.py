@@ -142,7 +142,48 @@ def with_ctx(fn):
       
   test_fn.__name__ = fn.__name__
   return test_fn
-    
+
+
+class _NullHandle(object):
+  def done(self, msg=None):
+    pass
+
+
+class _NullMaster(object):
+  '''Stands in for the master's RPC client: registration goes nowhere.'''
+  def register(self, req):
+    pass
+
+
+def local_worker():
+  '''
+  Return a `Worker` which is not attached to any master, for testing
+  how it runs kernels.  Call ``_shutdown()`` on it when done.
+  '''
+  from spartan import worker
+  return worker.Worker(_NullMaster())
+
+
+def local_master(statuses, hosts, ctx):
+  '''
+  Return a `Master` with a worker registered for each entry of ``statuses``
+  (worker id -> `WorkerStatus`) on ``hosts`` (worker id -> host name),
+  whose requests to workers go to ``ctx``.
+
+  The master is never initialized and does not replace `master.get()`.
+  Call ``_server.shutdown()`` on it when done.
+  '''
+  from spartan import core, master
+  cluster_master = master.MASTER
+  # one worker never registers, so the master does not try to initialize them.
+  m = master.Master(-1, len(statuses) + 1)
+  master.MASTER = cluster_master
+  for worker_id in sorted(statuses.keys()):
+    req = core.RegisterReq(host=hosts[worker_id], port=0, worker_status=statuses[worker_id])
+    m.register(req, _NullHandle())
+  m._ctx = ctx
+  return m
+
  
 def join_profiles(dir):
   import glob
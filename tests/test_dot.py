@@ -1,6 +1,8 @@
 import test_common
 import numpy as np
 from spartan import expr
+from spartan.expr.dot import plan_dot, DotExpr, GramExpr, dot_outer_mapper
+from spartan.expr.outer import outer
 from spartan.util import Assert
 
 
@@ -101,3 +103,57 @@ class Test_Dot_with_Vec(test_common.ClusterTest):
 
     Assert.all_eq(expr.dot(av, bv).glom(),
                   np.dot(na, nb))
+
+  def test_plan(self):
+    # sparse matrix * vector uses the specialized row kernel.
+    av = expr.sparse_rand((1000, 1000), density=0.001, format='coo')
+    bv = expr.arange(stop=1000)
+    plan = plan_dot(av, bv)
+    Assert.eq(plan.strategy, 'rows')
+    Assert.true('* rows' in expr.explain_dot(av, bv))
+    Assert.all_eq(expr.dot(av, bv).glom(), av.glom().dot(np.arange(1000)), tolerance=1e-5)
+
+  def test_dense_strategies(self):
+    na = np.arange(4800.0).reshape(120, 40)
+    nb = np.arange(1200.0).reshape(40, 30)
+    a = expr.from_numpy(na)
+    b = expr.from_numpy(nb)
+
+    # the row kernel and the outer join give the same product.
+    rows = DotExpr(matrix_a=a, matrix_b=b, tile_hint=(120, 30))
+    Assert.all_eq(rows.glom(), np.dot(na, nb))
+    joined = outer((a, b), (0, 1), dot_outer_mapper, shape=(120, 30),
+                   tile_hint=(120, 30), reducer=np.add)
+    Assert.all_eq(joined.glom(), np.dot(na, nb))
+
+    # the row kernel needs a distributed ``a``.
+    Assert.true('rows' not in [strategy for _, strategy, _, _ in plan_dot(na, b).costs])
+    Assert.all_eq(expr.dot(na, b).glom(), np.dot(na, nb))
+
+  def test_gram(self):
+    ny = np.random.rand(1000, 10)
+    nz = np.random.rand(1000, 3)
+    y = expr.from_numpy(ny)
+    z = expr.from_numpy(nz)
+
+    # products with a transpose consider summing tile products on the
+    # workers; which strategy wins depends on the measured network rate.
+    Assert.true(' gram ' in expr.explain_dot(expr.transpose(y), y))
+    Assert.all_eq(expr.dot(expr.transpose(y), y).glom(), np.dot(ny.T, ny), tolerance=1e-10)
+
+    # a row-tiled tall-skinny product only sends the small outputs.
+    rows = expr.from_numpy(ny, tile_hint=(250, 10))
+    Assert.isinstance(expr.dot(expr.transpose(rows), rows), GramExpr)
+    Assert.all_eq(expr.dot(expr.transpose(rows), rows).glom(), np.dot(ny.T, ny), tolerance=1e-10)
+    Assert.all_eq(expr.dot(expr.transpose(y), z).glom(), np.dot(ny.T, nz), tolerance=1e-10)
+
+    # tiled along the summed axis, so each tile reads only itself.
+    b = expr.from_numpy(ny.T.copy(), tile_hint=(10, 250))
+    Assert.true(' gram ' in expr.explain_dot(b, expr.transpose(b)))
+    Assert.all_eq(expr.dot(b, expr.transpose(b)).glom(), np.dot(ny.T, ny), tolerance=1e-10)
+
+    na = np.arange(2400).reshape(120, 20)
+    a = expr.from_numpy(na)
+    Assert.all_eq(expr.gram(a).glom(), np.dot(na.T, na))
+    Assert.all_eq(expr.gram(a, axis=1).glom(), np.dot(na, na.T))
+    Assert.all_eq(expr.gram(a, z[:120]).glom(), np.dot(na.T, nz[:120]), tolerance=1e-10)
@@ -1,4 +1,6 @@
 from spartan import expr, util
+from spartan.array import extent
+from spartan.expr.shuffle import ShuffleExpr
 from spartan.util import Assert
 import test_common
 import numpy as np
@@ -67,6 +69,19 @@ class TestFIO(test_common.ClusterTest):
       t1.tiles[ex] = v
     Assert.all_eq(t1.glom(), t2.glom())
 
+  def test_fio_sliced_load(self):
+    self.create_path()
+    t1 = expr.arange((100, 100), tile_hint=(30, 30)).force()
+    expr.save(t1, "fiotest_sliced", self.test_dir, False)
+    t2 = expr.load("fiotest_sliced", self.test_dir, False)[10:45, 20:]
+    Assert.isinstance(t2.optimized(), ShuffleExpr)
+    Assert.all_eq(t2.glom(), t1.glom()[10:45, 20:])
+
+    # extents which were not saved as tiles are assembled from the saved ones.
+    region = {extent.create((10, 20), (45, 100), (100, 100)): 0}
+    tiles = expr.partial_load(region, "fiotest_sliced", self.test_dir, False)
+    Assert.eq(len(tiles), 1)
+
   def test_fio_partial_sparse(self):
     self.create_path()
     t1 = expr.sparse_rand((300, 300)).force()
@@ -2,6 +2,7 @@ import unittest
 
 import numpy as np
 from spartan import expr, util
+from spartan.config import FLAGS
 from spartan.util import Assert
 from test_common import with_ctx
 import test_common
@@ -61,5 +62,16 @@ class TestMapTiles(test_common.ClusterTest):
     Assert.all_eq((a / b).glom(), np.ones((2, 5)))
     Assert.all_eq((b / a).glom(), np.ones((2, 5)))
 
+  def test_batched_small_tiles(self):
+    old = FLAGS.tile_batch_size
+    FLAGS.tile_batch_size = 1000
+    try:
+      a = expr.arange((1000,), tile_hint=(10,))
+      na = np.arange(1000)
+      Assert.all_eq((a * 2 + 1).glom(), na * 2 + 1)
+      Assert.all_eq(expr.sum(a * 2).glom(), np.sum(na * 2))
+    finally:
+      FLAGS.tile_batch_size = old
+
 if __name__ == '__main__':
   unittest.main()
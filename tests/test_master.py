@@ -0,0 +1,167 @@
+'''Tests of the master's load balancing, using a fake table of worker statuses.'''
+import time
+from spartan import core
+from spartan.array import distarray, extent
+from spartan.config import FLAGS
+from spartan.util import Assert
+from test_common import local_master
+
+
+class FakeCtx(object):
+  '''Records the requests the master sends to workers.'''
+  active = False
+
+  def __init__(self):
+    self.cancelled = []
+    self.abandoned = []
+    self.split = []
+
+  def cancel_tiles(self, worker_id, kernel_id, tiles):
+    self.cancelled.append((worker_id, kernel_id, list(tiles)))
+    return list(tiles)
+
+  def abandon_tiles(self, worker_id, kernel_id, tiles):
+    self.abandoned.append((worker_id, kernel_id, list(tiles)))
+
+  def split_tile(self, worker_id, kernel_id, tile, keep):
+    self.split.append((worker_id, kernel_id, tile, keep))
+    return True
+
+
+class FakeHandle(object):
+  def done(self, msg=None):
+    self.msg = msg
+
+
+def _status(remain, **kw):
+  return core.WorkerStatus(0, 1, 0.0, 0.0, time.time(), list(remain), [], **kw)
+
+
+_masters = []
+
+def _master(statuses, hosts):
+  m = local_master(statuses, hosts, FakeCtx())
+  _masters.append(m)
+  return m
+
+
+def teardown():
+  for m in _masters:
+    m._server.shutdown()
+
+
+def _steal(m, thief_id, kernel_id=1, **kw):
+  handle = FakeHandle()
+  m.maybe_steal_tiles(core.StealTilesReq(worker_id=thief_id, kernel_id=kernel_id, **kw), handle)
+  return handle.msg
+
+
+def test_steal_victim_and_batch():
+  statuses = {0: _status([]),
+              1: _status([10, 11, 12, 13]),
+              2: _status([20, 21, 22, 23, 24, 25])}
+  m = _master(statuses, {0: 'a', 1: 'a', 2: 'b'})
+
+  # without measured speeds, a worker on the same host is preferred, and
+  # half of its tiles are taken from the front of its queue.
+  Assert.eq(_steal(m, 0).tiles, [10, 11])
+  Assert.eq(m._ctx.cancelled, [(1, 1, [10, 11])])
+  Assert.eq(statuses[1].kernel_remain_tiles, [12, 13])
+
+  # with measured speeds, the victim has the most remaining time, and the
+  # thief takes a share in proportion to its speed (including the network).
+  statuses[0].tile_throughput = {'map': 3.0}
+  statuses[0].net_throughput = 3.0
+  statuses[1].tile_throughput = {'map': 1.0}
+  statuses[2].tile_throughput = {'map': 1.0}
+  Assert.eq(_steal(m, 0).tiles, [20, 21, 22])
+  Assert.eq(statuses[2].kernel_remain_tiles, [23, 24, 25])
+
+  # speeds are those measured for the kernel being run.
+  statuses[0].tile_throughput = {'map': 3.0, 'dot': 1.0}
+  statuses[2].tile_throughput = {'map': 1.0, 'dot': 1.0}
+  statuses[2].kernel_remain_tiles = [20, 21, 22, 23, 24, 25]
+  Assert.eq(_steal(m, 0, kernel_type='dot').tiles, [20, 21])
+
+  # nothing left to steal.
+  m = _master({0: _status([]), 1: _status([])}, {0: 'a', 1: 'b'})
+  Assert.eq(_steal(m, 0).tiles, [])
+  Assert.eq(m._ctx.cancelled, [])
+
+
+def test_split_last_tile():
+  old = FLAGS.steal_split_tiles
+  FLAGS.steal_split_tiles = True
+  try:
+    tile = (10, extent.create((0, 0), (100, 10), (100, 10)))
+    statuses = {0: _status([]), 1: _status([tile])}
+    m = _master(statuses, {0: 'a', 1: 'a'})
+
+    # the victim keeps the first half of its last tile, and the thief runs the rest.
+    keep = extent.create((0, 0), (50, 10), (100, 10))
+    steal = extent.create((50, 0), (100, 10), (100, 10))
+    Assert.eq(_steal(m, 0).tiles, [(10, steal)])
+    Assert.eq(m._ctx.split, [(1, 1, tile, keep)])
+    Assert.eq(m._ctx.cancelled, [])
+    Assert.eq(statuses[1].kernel_remain_tiles, [(10, keep)])
+  finally:
+    FLAGS.steal_split_tiles = old
+
+
+def test_placement_by_throughput():
+  statuses = {0: _status([]), 1: _status([])}
+  m = _master(statuses, {0: 'a', 1: 'b'})
+  m._worker_scores = {0: 1.0, 1: 1.0}
+
+  def placement():
+    workers = distarray._assign_by_score(8, m.get_worker_scores())
+    return dict((w, workers.count(w)) for w in set(workers))
+
+  Assert.eq(placement(), {0: 4, 1: 4})
+
+  # once measured, worker 0 processes tiles three times as fast.
+  statuses[0].tile_throughput = {'map': 3e6}
+  statuses[1].tile_throughput = {'map': 1e6}
+  Assert.eq(m.get_worker_scores(), [(0, 3e6), (1, 1e6)])
+  Assert.eq(placement(), {0: 6, 1: 2})
+
+  # speeds are compared for the kernel filling the array, when given.
+  statuses[1].tile_throughput = {'map': 1e6, 'dot': 3e6}
+  statuses[0].tile_throughput = {'map': 3e6, 'dot': 1e6}
+  Assert.eq(m.get_worker_scores('dot'), [(1, 3e6), (0, 1e6)])
+  Assert.eq(m.get_worker_scores('map'), [(0, 3e6), (1, 1e6)])
+
+  # workers which have not been measured are assumed to run at the median speed.
+  statuses[0].tile_throughput = {'map': 3e6}
+  statuses[1].tile_throughput = {}
+  Assert.eq(placement(), {0: 4, 1: 4})
+
+
+def test_backup_used_once():
+  old = (FLAGS.speculative_execution, FLAGS.speculation_slowdown)
+  FLAGS.speculative_execution = True
+  FLAGS.speculation_slowdown = 3
+  try:
+    statuses = {0: _status([], kernel_id=1),
+                1: _status([], kernel_id=1, kernel_running_tiles=[(7, 100.0)], avg_tile_time=1.0),
+                2: _status([], kernel_id=1, avg_tile_time=1.0)}
+    m = _master(statuses, {0: 'a', 1: 'b', 2: 'c'})
+
+    # tile 7 has been running for far longer than the median tile time.
+    msg = _steal(m, 0, allow_backup=True)
+    Assert.true(msg.backup)
+    Assert.eq(msg.tiles, [7])
+
+    # only one backup copy is run.
+    msg = _steal(m, 2, allow_backup=True)
+    Assert.eq(msg.tiles, [])
+
+    # once the backup finishes, the original copy is abandoned, once; the
+    # (stale) status of the straggler does not cause another backup.
+    msg = _steal(m, 0, allow_backup=True, finished_backups=[7])
+    Assert.eq(msg.tiles, [])
+    Assert.eq(m._ctx.abandoned, [(1, 1, [7])])
+    _steal(m, 0, allow_backup=True, finished_backups=[7])
+    Assert.eq(m._ctx.abandoned, [(1, 1, [7])])
+  finally:
+    FLAGS.speculative_execution, FLAGS.speculation_slowdown = old
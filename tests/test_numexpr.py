@@ -1,5 +1,6 @@
 from spartan import util
 from spartan import expr
+from spartan.config import FLAGS
 from spartan.util import Assert
 from test_common import with_ctx
 import numpy as np
@@ -16,4 +17,19 @@ def test_numexpr_opt(ctx):
   f = a + b + c + d + e
   f.force()
   #print f.dag()
-  #print f.force()
\ No newline at end of file
+  #print f.force()
+
+@with_ctx
+def test_blocked_eval(ctx):
+  old = (FLAGS.use_numexpr, FLAGS.local_block_bytes)
+  FLAGS.use_numexpr = False
+  FLAGS.local_block_bytes = 4096
+  try:
+    na = np.arange(100000, dtype=np.float64).reshape(500, 200)
+    a = expr.from_numpy(na)
+    f = (a + 1) * a - a / 2 + 3
+    opt = f.optimized()
+    Assert.isinstance(opt.op, expr.local.BlockedExpr)
+    Assert.all_eq(opt.glom(), (na + 1) * na - na / 2 + 3)
+  finally:
+    FLAGS.use_numexpr, FLAGS.local_block_bytes = old
@@ -1,5 +1,7 @@
+import json
 from spartan import array, expr
 from spartan.config import FLAGS
+from spartan.expr import optimize
 from spartan.util import Assert
 import test_common
 import numpy as np
@@ -181,3 +183,48 @@ class TestOptimization(test_common.ClusterTest):
 
     for child in a.optimized().op.deps:
       Assert.true(not isinstance(child, expr.local.LocalInput))
+
+  def test_optimization_cse(self):
+    na = np.random.rand(50, 20)
+    a = expr.from_numpy(na)
+    b = expr.dot(expr.transpose(a), a) + expr.dot(expr.transpose(a), a)
+
+    opt = b.optimized()
+    Assert.eq(opt.children[0].expr_id, opt.children[1].expr_id)
+    Assert.all_eq(opt.glom(), np.dot(na.T, na) * 2, tolerance=1e-10)
+
+  def test_plan_cache(self):
+    optimize.clear_plan_cache()
+    for i in range(3):
+      na = np.random.rand(20, 20)
+      a = expr.from_numpy(na)
+      a.evaluate()
+      b = expr.sum(a * 2 + (i + 10), axis=0)
+      Assert.all_eq(b.optimized().glom(), np.sum(na * 2 + (i + 10), axis=0), tolerance=1e-10)
+    # every iteration has the same structure, so only one plan is built.
+    Assert.eq(len(optimize._plans), 1)
+
+  def test_explain(self):
+    na = np.random.rand(20, 20)
+    a = expr.from_numpy(na)
+    a.evaluate()
+    b = expr.sum(a * 2 + 1, axis=0)
+    report = expr.explain(b, analyze=True)
+    leaf, root = report.nodes[0], report.nodes[-1]
+    Assert.eq(leaf['cached'], True)
+    Assert.eq(root['evaluated'], True)
+    Assert.ge(root['kernels'], 1)
+    Assert.ge(root['tiles'], 1)
+    Assert.true('reduce_fusion' in root['passes'])
+    Assert.eq(json.loads(report.to_json())['nodes'][-1]['id'], root['id'])
+    Assert.true('kernels=' in str(report))
+
+  def test_constant_folding(self):
+    na = np.random.rand(10, 10).astype(np.float32)
+    a = expr.from_numpy(na)
+    a.evaluate()
+    b = a + expr.as_array(np.float32(2)) * 3 + np.arange(10)
+    opt = b.optimized()
+    # the scalar subtree and the small array are inlined into the map.
+    Assert.eq(len(opt.children), 1)
+    Assert.all_eq(opt.glom(), na + np.float32(2) * 3 + np.arange(10), tolerance=1e-5)
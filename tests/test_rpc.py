@@ -1,6 +1,10 @@
 ''' Test whether rpc works in a multithreads environemnt '''
 from spartan import rpc
 from spartan import util
+from spartan.config import FLAGS
+from spartan.rpc import zeromq
+from spartan.rpc.common import Group
+from spartan.util import Assert
 import threading
 from multiprocessing.pool import ThreadPool
 
@@ -64,3 +68,74 @@ def test_rpc():
   #shutdown server
   client.shutdown()
   server_thread.join()
+
+
+def test_send_backpressure():
+  old = (FLAGS.send_queue_high_watermark, FLAGS.send_queue_low_watermark, zeromq.WRITE_BATCH_BYTES)
+  FLAGS.send_queue_high_watermark = 100
+  FLAGS.send_queue_low_watermark = 40
+  # send one message per peer on each call to handle_write.
+  zeromq.WRITE_BATCH_BYTES = 1
+  sock = zeromq.server_socket_random_port(host)
+  sent = []
+  sock._send_now = lambda msg: sent.append(msg[0])
+  try:
+    for i in range(10):
+      sock.send(Group(('a', 'x' * 9)))
+    Assert.true(sock.congested)
+    Assert.eq(sock.queued_bytes(), 100)
+
+    # a peer holding more than its share of the queue blocks...
+    blocked = threading.Thread(target=sock.send, args=(Group(('a', 'x' * 9)),))
+    blocked.start()
+    blocked.join(0.2)
+    Assert.true(blocked.is_alive())
+
+    # ...while other peers may still queue messages.
+    sock.send(Group(('b', 'x' * 9)))
+    sock.send(Group(('b', 'x' * 9)))
+    Assert.eq(sock.queued_bytes(), 120)
+
+    while sock.congested:
+      Assert.true(blocked.is_alive())
+      sock.handle_write()
+    # the blocked sender resumes once the queue is below the low watermark.
+    blocked.join(1)
+    Assert.true(not blocked.is_alive())
+    Assert.eq(sock.queued_bytes(), 50)
+
+    # peers are sent to in turn.
+    Assert.eq(sent, ['a', 'b', 'a', 'b', 'a', 'a', 'a', 'a'])
+  finally:
+    FLAGS.send_queue_high_watermark, FLAGS.send_queue_low_watermark, zeromq.WRITE_BATCH_BYTES = old
+    sock.close()
+
+
+def test_poll_thread_replies_counted():
+  old = (FLAGS.send_queue_high_watermark, FLAGS.send_queue_low_watermark)
+  FLAGS.send_queue_high_watermark = 100
+  FLAGS.send_queue_low_watermark = 40
+  sock = zeromq.server_socket_random_port(host)
+  sent = []
+  sock._send_now = lambda msg: sent.append(msg[0])
+  # act as the poll thread, which answers tile fetches itself.
+  sock._event_loop._running_thread = threading.current_thread()
+  try:
+    for i in range(10):
+      sock.send(Group(('a', 'x' * 9)))
+    Assert.eq(sent, [])
+    Assert.eq(sock.queued_bytes(), 100)
+    Assert.true(sock.congested)
+
+    # the poll thread is never blocked, even when congested.
+    sock.send(Group(('b', 'x' * 9)))
+    Assert.eq(sock.queued_bytes(), 110)
+
+    sock.flush()
+    Assert.eq(len(sent), 11)
+    Assert.eq(sock.queued_bytes(), 0)
+    Assert.true(not sock.congested)
+  finally:
+    FLAGS.send_queue_high_watermark, FLAGS.send_queue_low_watermark = old
+    sock._event_loop._running_thread = None
+    sock.close()
@@ -0,0 +1,181 @@
+import test_common
+import numpy as np
+import spartan
+from spartan import blob_ctx, expr
+from spartan.config import FLAGS
+from spartan.expr import scheduler
+from spartan.expr.base import eval_cache, EvalCache
+from spartan.expr.dot import DotExpr
+from spartan.util import Assert
+
+def _failing_mapper(v):
+  raise ValueError('failing kernel')
+
+class TestScheduler(test_common.ClusterTest):
+  def test_topological_sort(self):
+    a = expr.ones((10, 10))
+    b = a + 1
+    c = a * 2
+    d = b + c
+    order, children, values = scheduler.topological_sort(d)
+    pos = dict((node.expr_id, i) for i, node in enumerate(order))
+    Assert.eq(len(pos), len(order))
+    for node in order:
+      for child in children[node.expr_id]:
+        if child in pos:
+          Assert.lt(pos[child], pos[node.expr_id])
+    Assert.eq(order[-1].expr_id, d.expr_id)
+
+  def test_concurrent_branches(self):
+    old = FLAGS.max_concurrent_kernels
+    FLAGS.max_concurrent_kernels = 4
+    try:
+      na = np.arange(100).reshape(10, 10)
+      a = expr.from_numpy(na)
+      x = expr.sum(a + 1, axis=0)
+      y = expr.sum(a * 2, axis=0)
+      z = expr.sum(a - 3, axis=0)
+      Assert.all_eq((x + y + z).glom(),
+                    np.sum(na + 1, axis=0) + np.sum(na * 2, axis=0) + np.sum(na - 3, axis=0))
+      Assert.eq(scheduler._pool_size, 4)
+
+      # the pool follows changes of the flag.
+      FLAGS.max_concurrent_kernels = 2
+      x = expr.sum(a + 2, axis=0)
+      y = expr.sum(a * 3, axis=0)
+      Assert.all_eq((x * y).glom(), np.sum(na + 2, axis=0) * np.sum(na * 3, axis=0))
+      Assert.eq(scheduler._pool_size, 2)
+    finally:
+      FLAGS.max_concurrent_kernels = old
+
+  def test_pipelined_map(self):
+    old = FLAGS.pipeline_kernels
+    FLAGS.pipeline_kernels = True
+    try:
+      na = np.arange(10000).reshape(100, 100)
+      a = expr.from_numpy(na)
+      b = expr.sum((a + 1) * 2, axis=1)
+      Assert.all_eq(b.glom(), np.sum((na + 1) * 2, axis=1))
+    finally:
+      FLAGS.pipeline_kernels = old
+
+  def test_jobs(self):
+    na = np.arange(100).reshape(10, 10)
+    a = expr.from_numpy(na)
+    with spartan.job('batch', session_id='a', priority=0):
+      Assert.all_eq((a + 1).glom(), na + 1)
+      with spartan.job('interactive', session_id='b', priority=10, weight=2):
+        Assert.eq(blob_ctx.current_job().job_id, 'interactive')
+        Assert.all_eq(expr.sum(a * 2).glom(), np.sum(na * 2))
+      Assert.eq(blob_ctx.current_job().job_id, 'batch')
+    Assert.eq(blob_ctx.current_job(), None)
+
+  def test_failed_kernel(self):
+    # a failed kernel must not stop the workers from running later ones.
+    na = np.arange(2400.0).reshape(40, 60)
+    a = expr.from_numpy(na)
+    Assert.raises_exception(Exception, lambda: expr.map(a, _failing_mapper).glom())
+    Assert.all_eq(expr.sum(a).glom(), np.sum(na))
+
+  def test_release_intermediates(self):
+    old = FLAGS.release_intermediates
+    FLAGS.release_intermediates = True
+    try:
+      na = np.arange(100).reshape(10, 10)
+      a = expr.from_numpy(na)
+      c = expr.dot(a, a) + 1
+      Assert.all_eq(c.glom(), np.dot(na, na) + 1)
+      intermediate = [v for v in c.children if isinstance(v, DotExpr)][0]
+      Assert.eq(eval_cache.get(intermediate.expr_id), None)
+      Assert.not_null(eval_cache.get(c.expr_id))
+
+      # intermediates the user keeps, or has evaluated before, stay cached.
+      b = expr.dot(a, a)
+      Assert.all_eq((b + 1).glom(), np.dot(na, na) + 1)
+      Assert.eq(eval_cache.get(b.expr_id), None)
+      b = expr.dot(a, a)
+      expr.keep(b)
+      Assert.all_eq((b + 1).glom(), np.dot(na, na) + 1)
+      Assert.not_null(eval_cache.get(b.expr_id))
+      e = expr.dot(a, a + 1)
+      Assert.all_eq(e.glom(), np.dot(na, na + 1))
+      Assert.all_eq((e * 2).glom(), np.dot(na, na + 1) * 2)
+      Assert.not_null(eval_cache.get(e.expr_id))
+    finally:
+      FLAGS.release_intermediates = old
+
+  def test_release_optimized(self):
+    old = FLAGS.release_intermediates
+    FLAGS.release_intermediates = True
+    try:
+      # the optimized graph is a copy: keeping the original keeps its result.
+      x = expr.randn(10, 10)
+      y = expr.randn(10, 10)
+      b = expr.dot(x, y)
+      expr.keep(b)
+      c = (b * 2 + 1).optimized().glom()
+      Assert.not_null(eval_cache.get(b.expr_id))
+
+      # random inputs are kept, not generated again with new values.
+      nb = b.glom()
+      Assert.all_eq(c, nb * 2 + 1, tolerance=1e-10)
+      Assert.all_eq(nb, np.dot(x.glom(), y.glom()), tolerance=1e-10)
+    finally:
+      FLAGS.release_intermediates = old
+
+  def test_eval_cache_budget(self):
+    old = FLAGS.eval_cache_bytes
+    FLAGS.eval_cache_bytes = 250
+    try:
+      cache = EvalCache()
+      cache.set(1, np.zeros(100, dtype=np.uint8), cost=1.0)
+      cache.set(2, np.zeros(100, dtype=np.uint8), cost=10.0)
+      cache.set(3, np.zeros(100, dtype=np.uint8), cost=0.1)
+      # the cheapest entry to recompute per byte goes first.
+      Assert.eq(cache.get(1), None)
+      Assert.not_null(cache.get(2))
+      Assert.not_null(cache.get(3))
+      Assert.le(cache.total_bytes, 250)
+
+      # results which cannot be recomputed are never dropped.
+      cache.set(4, np.zeros(100, dtype=np.uint8), recomputable=False)
+      cache.set(5, np.zeros(100, dtype=np.uint8), cost=100.0)
+      Assert.not_null(cache.get(4))
+      Assert.not_null(cache.get(5))
+      Assert.le(cache.total_bytes, 250)
+    finally:
+      FLAGS.eval_cache_bytes = old
+
+  def test_truncation(self):
+    old = FLAGS.max_expr_depth
+    FLAGS.max_expr_depth = 10
+    try:
+      na = np.arange(100).reshape(10, 10)
+      x = expr.from_numpy(na)
+      for i in range(50):
+        x = x + 1
+        Assert.le(x._depth, 11)
+      Assert.all_eq(x.glom(), na + 50)
+    finally:
+      FLAGS.max_expr_depth = old
+
+    # shared inputs are counted once: x = x + x does not double the size.
+    old = FLAGS.max_expr_nodes
+    FLAGS.max_expr_nodes = 40
+    try:
+      x = expr.from_numpy(na)
+      for i in range(30):
+        x = x + x
+      Assert.gt(x._depth, 30)
+      Assert.le(x._size, 41)
+      Assert.all_eq(x.glom(), na * (2 ** 30))
+    finally:
+      FLAGS.max_expr_nodes = old
+
+    # iteration boundaries marked by the user.
+    galaxy = {'x': expr.from_numpy(na), 'v': expr.ones((10, 10))}
+    for i in range(3):
+      galaxy['x'] += galaxy['v'] * 2
+      galaxy = expr.truncate(galaxy)
+      Assert.isinstance(galaxy['x'], expr.base.Val)
+    Assert.all_eq(galaxy['x'].glom(), na + 6)
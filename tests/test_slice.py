@@ -6,6 +6,9 @@ import spartan
 import numpy as np
 from spartan import expr, util
 from spartan.expr import optimize
+from spartan.expr.base import eval_cache
+from spartan.expr.map import MapExpr
+from spartan.expr.slice import SliceExpr
 from spartan.array import distarray, extent
 from spartan.util import Assert
 import test_common
@@ -79,6 +82,33 @@ class SliceTest(test_common.ClusterTest):
     nv = na[1:] - na[:-1]
     Assert.all_eq(v, nv)
 
+  def test_symbolic_shapes(self):
+    x = expr.arange((TEST_SIZE, TEST_SIZE))
+    shuffled = expr.shuffle(x, add_one_extent)
+    y = shuffled + 1
+    Assert.eq(y.static_shape(), None)
+    with expr.symbolic_shapes():
+      Assert.raises_exception(expr.NotShapeable, getattr, y, 'shape')
+    optimize.optimize(y)
+    # neither asking for the shape nor optimizing evaluated the shuffle.
+    Assert.eq(eval_cache.get(shuffled.expr_id), None)
+
+    declared = expr.shuffle(x, add_one_extent, shape_fn=lambda shape: shape)
+    Assert.eq((declared + 1).static_shape(), (TEST_SIZE, TEST_SIZE))
+    Assert.eq(x[x > 5].static_shape(), (TEST_SIZE, TEST_SIZE))
+    Assert.eq(x[expr.arange((3,))].static_shape(), (3, TEST_SIZE))
+
+  def test_slice_pushdown(self):
+    sliced = expr.arange((TEST_SIZE, TEST_SIZE))[2:5, 3:]
+    opt = sliced.optimized()
+    Assert.isinstance(opt, MapExpr)
+    Assert.eq(opt.children[0].shape, (3, TEST_SIZE - 3))
+    Assert.all_eq(opt.glom(), np.arange(TEST_SIZE * TEST_SIZE).reshape(TEST_SIZE, TEST_SIZE)[2:5, 3:])
+
+    # random arrays are generated whole.
+    sample = expr.rand(TEST_SIZE, TEST_SIZE)[:3]
+    Assert.isinstance(sample.optimized(), SliceExpr)
+
 if __name__ == '__main__':
   rest = spartan.config.initialize(sys.argv)
   unittest.main(argv=rest) 
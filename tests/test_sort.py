@@ -40,5 +40,19 @@ class Test_Sort(test_common.ClusterTest):
         Assert.all_eq(expr.argsort(a, axis).glom(),
                       np.argsort(na, axis))
 
+  def test_flatten(self):
+    na = new_ndarray((23, 17))
+    a = expr.from_numpy(na)
+    Assert.all_eq(expr.sort(a, axis=None).glom(), np.sort(na, axis=None))
+
+  def test_combined_samples(self):
+    # samples are merged on the workers; the master only sees a single array.
+    na = new_ndarray((40, 10))
+    a = expr.from_numpy(na)
+    samples = expr.tile_operation(a, fn=lambda array, ex: [(None, array.fetch(ex).flatten())],
+                                  combiner=lambda x, y: [np.concatenate(x + y)]).force()
+    Assert.eq(len(samples), 1)
+    Assert.all_eq(np.sort(samples[0]), np.sort(na, axis=None))
+
 if __name__ == '__main__':
   test_common.run(__file__)
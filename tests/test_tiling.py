@@ -0,0 +1,39 @@
+from spartan.expr import optimize
+from spartan.expr.tiling import mincost_layouts
+from spartan.util import Assert
+
+
+def test_tree():
+  # two fixed inputs feeding a node with two layouts.
+  Assert.eq(mincost_layouts([[0], [0], [0, 0]], [(0, 2, [0, 10]), (1, 2, [5, 0])]), [0, 0, 0])
+  Assert.eq(mincost_layouts([[0], [0], [0, 0]], [(0, 2, [0, 10]), (1, 2, [20, 0])]), [0, 0, 1])
+
+
+def test_shared_node():
+  # node 0 is read by both 1 and 2; 2 prefers the layout 1 of node 0.
+  edges = [(0, 1, [0, 3, 3, 0]), (0, 2, [9, 9, 0, 9]), (1, 2, [0, 1, 1, 0])]
+  Assert.eq(mincost_layouts([[0, 0], [0, 0], [0, 0]], edges), [1, 1, 0])
+
+
+def test_invalid_graph():
+  Assert.raises_exception(ValueError, mincost_layouts, [[0], [0]], [(0, 1, [0]), (1, 0, [0])])
+  Assert.raises_exception(ValueError, mincost_layouts, [[0], [0, 1]], [(0, 1, [0])])
+  Assert.raises_exception(ValueError, mincost_layouts, [[0], []], [])
+
+
+def test_square_dot_uses_blocks():
+  num_workers = 4
+  shape = (1000, 1000)
+  layouts = optimize._candidate_layouts(shape, num_workers)
+  Assert.eq(layouts, [optimize.ROWS, optimize.COLS, optimize.BLOCKS, optimize.REPLICATED])
+  Assert.eq(optimize._tile_hint(shape, optimize.BLOCKS, num_workers), [500, 500])
+
+  size = optimize._size(shape)
+  a_cost = optimize._dot_costs(size, num_workers, optimize.ROWS, optimize.COLS)
+  b_cost = optimize._dot_costs(size, num_workers, optimize.COLS, optimize.ROWS)
+  node_costs = [[optimize._serial_cost(shape, l, num_workers) for l in layouts]] * 2
+  node_costs.append([optimize._dot_result_cost(shape, l, num_workers) for l in layouts])
+  edges = [(0, 2, [a_cost(s, d) for s in layouts for d in layouts]),
+           (1, 2, [b_cost(s, d) for s in layouts for d in layouts])]
+  choice = mincost_layouts(node_costs, edges)
+  Assert.eq(layouts[choice[2]], optimize.BLOCKS)
@@ -0,0 +1,220 @@
+'''Tests of how workers run the tiles of a kernel, using a worker with no cluster attached.'''
+import threading
+import time
+import numpy as np
+from spartan import blob_ctx, core, rpc
+from spartan.array import tile
+from spartan.config import FLAGS
+from spartan.util import Assert
+from test_common import local_worker
+
+
+class FakeHandle(object):
+  msg = None
+
+  def __init__(self):
+    self.finished = threading.Event()
+
+  def done(self, msg=None):
+    self.msg = msg
+    self.finished.set()
+
+
+class FakeReq(object):
+  '''The fields of a `RunKernelReq` read while running tiles.'''
+  def __init__(self, kernel_id, mapper_fn):
+    self.kernel_id = kernel_id
+    self.mapper_fn = mapper_fn
+    self.kw = {}
+    self.profile = False
+    self.pinned = False
+    self.priority = 0
+    self.job_id = 0
+
+
+def _start_kernel(w, kernel_id, tiles):
+  '''Put ``w`` in the middle of running kernel ``kernel_id`` over ``tiles``.'''
+  with w._kernel_lock:
+    w._kernel_id = kernel_id
+    w._kernel_remain_tiles = list(tiles)
+
+
+def _local_tiles(w, ids):
+  '''Store a small tile on ``w`` for each of ``ids``, and return their tile ids.'''
+  tile_ids = [core.TileId(w.id, i) for i in ids]
+  for tile_id in tile_ids:
+    w._blobs[tile_id] = tile.from_data(np.ones((2, 2)))
+  return tile_ids
+
+
+def _recording_mapper(tile_id, blob, name, ran, **kw):
+  ran.append((name, tile_id.id))
+  time.sleep(0.02)
+  return core.LocalKernelResult(result=[])
+
+
+def test_abandoned_tile_ignored():
+  w = local_worker()
+  _start_kernel(w, 1, [1, 2])
+
+  def mapper(tile, blob):
+    w._blobs['out-%d' % tile] = tile
+    if tile == 2:
+      # a backup copy of tile 2 finished on another worker meanwhile.
+      w.abandon_tiles(core.TileListMessage(kernel_id=1, tiles=[2]), FakeHandle())
+    return core.LocalKernelResult(result=[(None, 'out-%d' % tile)])
+
+  results = {}
+  try:
+    w._run_tiles(FakeReq(1, mapper), results, set())
+
+    # only the result of the tile which was not abandoned is reported, and the
+    # output of the abandoned one is deleted.
+    Assert.eq(results, {1: [(None, 'out-1')]})
+    Assert.eq(w._blobs, {'out-1': 1})
+    Assert.eq(w._kernel_abandoned, set())
+    Assert.eq(w._kernel_done_tiles, 1)
+  finally:
+    w._shutdown()
+
+
+def test_tile_threads():
+  old = FLAGS.worker_tile_threads
+  FLAGS.worker_tile_threads = 2
+  w = local_worker()
+  _start_kernel(w, 1, range(8))
+  try:
+    threads = set()
+    def mapper(tile, blob):
+      threads.add(threading.current_thread().ident)
+      time.sleep(0.05)
+      return core.LocalKernelResult(result=[(None, tile * 10)])
+
+    results = {}
+    w._run_local_tiles(FakeReq(1, mapper), results, set())
+    Assert.eq(results, dict((t, [(None, t * 10)]) for t in range(8)))
+    Assert.eq(len(threads), 2)
+
+    # a failing tile stops the other threads, and the error reaches the kernel.
+    def failing_mapper(tile, blob):
+      if tile == 5:
+        raise ValueError('failing tile')
+      time.sleep(0.05)
+      return core.LocalKernelResult(result=[])
+
+    _start_kernel(w, 1, range(8))
+    Assert.raises_exception(ValueError, w._run_local_tiles, FakeReq(1, failing_mapper), {}, set())
+    Assert.eq(w._kernel_remain_tiles, [])
+    Assert.eq(w._kernel_running, {})
+  finally:
+    FLAGS.worker_tile_threads = old
+    w._tile_threads.terminate()
+    w._shutdown()
+
+
+def test_failed_pipelined_kernel():
+  w = local_worker()
+  w.id = 0
+  try:
+    src = core.TileId(0, 1)
+    w._blobs[src] = tile.from_data(np.ones((4, 4)))
+    out = core.TileId(0, blob_ctx.PIPELINED_ID_BASE + 1)
+
+    # a consumer reads the output tile before the pipelined kernel runs.
+    early = FakeHandle()
+    w.get(core.GetReq(id=out, subslice=None), early)
+    Assert.eq(early.msg, None)
+
+    def failing_mapper(tile_id, blob, **kw):
+      raise ValueError('failing producer')
+
+    req = core.RunKernelReq(kernel_id=1, blobs=[src], mapper_fn=failing_mapper,
+                            kw={'out_tiles': {None: out}}, pinned=True)
+    kernel = FakeHandle()
+    w._run_kernel(req, kernel)
+    Assert.isinstance(kernel.msg, rpc.RPCException)
+
+    # the waiting read, and any later one, fails with the kernel's error.
+    Assert.true(early.msg is kernel.msg)
+    late = FakeHandle()
+    w.get(core.GetReq(id=out, subslice=None), late)
+    Assert.true(late.msg is kernel.msg)
+    Assert.eq(w._pending_reads, {})
+  finally:
+    w._shutdown()
+
+
+def test_job_dispatch_order():
+  w = local_worker()
+  w.id = 0
+  try:
+    tiles = _local_tiles(w, [1])
+    ran = []
+
+    def submit(kernels):
+      handles = []
+      # hold the dispatcher until every kernel is queued.
+      with w._queue_cond:
+        for kernel_id, (job_id, priority, weight) in enumerate(kernels):
+          req = core.RunKernelReq(kernel_id=kernel_id, blobs=tiles, mapper_fn=_recording_mapper,
+                                  kw={'name': job_id, 'ran': ran}, pinned=True,
+                                  job_id=job_id, priority=priority, weight=weight)
+          handles.append(FakeHandle())
+          w.run_kernel(req, handles[-1])
+      for handle in handles:
+        Assert.true(handle.finished.wait(10))
+      names = [name for name, _ in ran]
+      del ran[:]
+      return names
+
+    # kernels of the interactive job go first, although they were queued last.
+    Assert.eq(submit([('batch', 0, 1.0)] * 3 + [('interactive', 10, 1.0)] * 2),
+              ['interactive'] * 2 + ['batch'] * 3)
+
+    # between equal priorities, jobs share the worker in proportion to their
+    # weight: b runs 2.5 times as much tile time as a.
+    w._job_usage.clear()
+    Assert.eq(submit([('a', 0, 1.0)] * 3 + [('b', 0, 2.5)] * 4),
+              ['a', 'b', 'b', 'b', 'a', 'b', 'a'])
+  finally:
+    w._shutdown()
+
+
+def test_failure_during_preemption():
+  w = local_worker()
+  w.id = 0
+  try:
+    tiles = _local_tiles(w, [1, 2, 3])
+    ran = []
+    urgent = FakeHandle()
+
+    def failing_mapper(tile_id, blob, **kw):
+      ran.append(('urgent', tile_id.id))
+      raise ValueError('failing urgent kernel')
+
+    def low_mapper(tile_id, blob, **kw):
+      if not ran:
+        # a higher priority kernel arrives while this one is running.
+        w.run_kernel(core.RunKernelReq(kernel_id=2, blobs=tiles[:1], mapper_fn=failing_mapper,
+                                       pinned=True, job_id='urgent', priority=10), urgent)
+      return _recording_mapper(tile_id, blob, 'low', ran)
+
+    low = FakeHandle()
+    w.run_kernel(core.RunKernelReq(kernel_id=1, blobs=tiles, mapper_fn=low_mapper, pinned=True,
+                                   job_id='low'), low)
+    Assert.true(low.finished.wait(10))
+
+    # the low priority kernel was paused for the urgent one, whose failure
+    # was reported, and then finished its remaining tiles.
+    Assert.isinstance(urgent.msg, rpc.RPCException)
+    Assert.eq(set(low.msg.keys()), set(tiles))
+    Assert.eq([name for name, _ in ran], ['low', 'urgent', 'low', 'low'])
+
+    # the dispatcher still runs later kernels.
+    later = FakeHandle()
+    w.run_kernel(core.RunKernelReq(kernel_id=3, blobs=tiles[:1], mapper_fn=_recording_mapper,
+                                   kw={'name': 'later', 'ran': ran}, pinned=True), later)
+    Assert.true(later.finished.wait(10))
+    Assert.eq(ran[-1], ('later', 1))
+  finally:
+    w._shutdown()